@@ -9,13 +9,20 @@ connections found in connection.py.
 Each bug has current state made up of many state variables e.g.
 priority, reported in version, etc.
       
-Unlike comments, states *are* changed. If a bug does not have a
-corresponding state then the state table simply lacks a corresponding
-entry. There are no defaults, and no NULLs.  Thus new states can be
-added and changed during the lifetime of the tracking system.
+Unlike comments, states *are* changed. Each state is a column of the
+bugs table referring to a table of the possible values of that state,
+which is NULL if the bug does not have that state. (Originally each
+state was instead a table of its own, linking bugs to values, and
+lacking an entry for a bug without the state.) Thus new values can be
+added during the lifetime of the tracking system.
 
 Note that the value_table may be shared amongst different states.
 
+The tables are created in their original form and then upgraded by
+applying every migration in MIGRATIONS. Existing databases are
+upgraded in place by applying just those migrations which are newer
+than the version recorded in the schema_version table.
+
 """
 
 import psycopg2
@@ -41,32 +48,255 @@ def run_sql(database, sql_commands):
         logger.exception()
         connection.rollback()
         success = False
+    for notice in connection.notices:
+        if notice.startswith("WARNING"):
+            logger.warn(notice.strip())
     cursor.close()
     return success
 
 
+# Each migration is a (version, description, sql) tuple, and is applied
+# (along with recording its version) in a single transaction. Never
+# change a migration once released; always add a new one.
+MIGRATIONS = (
+    (1, "Index comments, changes, progress and state tables", """
+        CREATE INDEX comments_bug_id_date_idx ON comments (bug_id, date);
+        CREATE INDEX changes_date_idx ON changes (date);
+        CREATE INDEX changes_bug_id_idx ON changes (bug_id);
+        CREATE INDEX progress_date_idx ON progress (date);
+        CREATE INDEX priorities_id_idx ON priorities (id);
+        CREATE INDEX resolutions_id_idx ON resolutions (id);
+        CREATE INDEX categories_id_idx ON categories (id);
+        CREATE INDEX keywords_id_idx ON keywords (id);
+        CREATE INDEX reported_ins_id_idx ON reported_ins (id);
+        CREATE INDEX fixed_ins_id_idx ON fixed_ins (id);
+        CREATE INDEX tested_ok_ins_id_idx ON tested_ok_ins (id);
+        """),
+    # The trigram indexes only speed up searches, so if the pg_trgm
+    # extension cannot be had (e.g. the contrib package of postgres is
+    # not installed) they are skipped with a warning, rather than
+    # failing this and every later migration.
+    (2, "Trigram indexes for regex searches of titles and comments", """
+        DO $$
+        BEGIN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            CREATE INDEX bugs_title_trgm_idx
+                   ON bugs USING gin (title gin_trgm_ops);
+            CREATE INDEX comments_comment_trgm_idx
+                   ON comments USING gin (comment gin_trgm_ops);
+        EXCEPTION WHEN OTHERS THEN
+            RAISE WARNING 'No trigram indexes, so searches are slower: %',
+                SQLERRM;
+        END $$;
+        """),
+    (3, "Sessions table for the database session store", """
+        CREATE TABLE sessions (session_id TEXT PRIMARY KEY,
+                               user_id INTEGER REFERENCES users (user_id),
+                               expires TIMESTAMP NOT NULL);
+        CREATE INDEX sessions_expires_idx ON sessions (expires);
+        """),
+    (4, "Move the states of bugs into columns of the bugs table", """
+        ALTER TABLE bugs
+            ADD COLUMN priority_id INTEGER
+                                   REFERENCES priority_values (id),
+            ADD COLUMN resolution_id INTEGER
+                                     REFERENCES resolution_values (id),
+            ADD COLUMN category_id INTEGER
+                                   REFERENCES category_values (id),
+            ADD COLUMN keyword_id INTEGER
+                                  REFERENCES keyword_values (id),
+            ADD COLUMN reported_in_id INTEGER
+                                      REFERENCES versions (id),
+            ADD COLUMN fixed_in_id INTEGER
+                                   REFERENCES versions (id),
+            ADD COLUMN tested_ok_in_id INTEGER
+                                       REFERENCES versions (id);
+        UPDATE bugs SET
+            priority_id = (SELECT id FROM priorities
+                           WHERE priorities.bug_id = bugs.bug_id),
+            resolution_id = (SELECT id FROM resolutions
+                             WHERE resolutions.bug_id = bugs.bug_id),
+            category_id = (SELECT id FROM categories
+                           WHERE categories.bug_id = bugs.bug_id),
+            keyword_id = (SELECT id FROM keywords
+                          WHERE keywords.bug_id = bugs.bug_id),
+            reported_in_id = (SELECT id FROM reported_ins
+                              WHERE reported_ins.bug_id = bugs.bug_id),
+            fixed_in_id = (SELECT id FROM fixed_ins
+                           WHERE fixed_ins.bug_id = bugs.bug_id),
+            tested_ok_in_id = (SELECT id FROM tested_ok_ins
+                               WHERE tested_ok_ins.bug_id = bugs.bug_id);
+        CREATE INDEX bugs_priority_id_idx ON bugs (priority_id);
+        CREATE INDEX bugs_resolution_id_idx ON bugs (resolution_id);
+        CREATE INDEX bugs_category_id_idx ON bugs (category_id);
+        CREATE INDEX bugs_keyword_id_idx ON bugs (keyword_id);
+        CREATE INDEX bugs_reported_in_id_idx ON bugs (reported_in_id);
+        CREATE INDEX bugs_fixed_in_id_idx ON bugs (fixed_in_id);
+        CREATE INDEX bugs_tested_ok_in_id_idx ON bugs (tested_ok_in_id);
+        DROP TABLE priorities;
+        DROP TABLE resolutions;
+        DROP TABLE categories;
+        DROP TABLE keywords;
+        DROP TABLE reported_ins;
+        DROP TABLE fixed_ins;
+        DROP TABLE tested_ok_ins;
+        """),
+    (5, "Full text search of the titles and comments of bugs", """
+        ALTER TABLE bugs ADD COLUMN search_vector tsvector;
+        CREATE FUNCTION midge_bug_search_vector(TEXT, INTEGER)
+        RETURNS tsvector AS $$
+            SELECT setweight(to_tsvector('english', coalesce($1, '')), 'A')
+                || setweight(to_tsvector('english', coalesce(
+                       (SELECT string_agg(comment, ' ' ORDER BY date)
+                        FROM comments WHERE bug_id = $2), '')), 'B');
+        $$ LANGUAGE SQL STABLE;
+        CREATE FUNCTION midge_bugs_search_trigger() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector := midge_bug_search_vector(NEW.title,
+                                                         NEW.bug_id);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        CREATE TRIGGER bugs_search_vector
+               BEFORE INSERT OR UPDATE OF title ON bugs
+               FOR EACH ROW EXECUTE PROCEDURE midge_bugs_search_trigger();
+        CREATE FUNCTION midge_comments_search_trigger() RETURNS trigger AS $$
+        BEGIN
+            UPDATE bugs
+            SET search_vector = search_vector || setweight(
+                    to_tsvector('english', coalesce(NEW.comment, '')), 'B')
+            WHERE bug_id = NEW.bug_id;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        CREATE TRIGGER comments_search_vector
+               AFTER INSERT ON comments
+               FOR EACH ROW EXECUTE PROCEDURE midge_comments_search_trigger();
+        UPDATE bugs SET search_vector = midge_bug_search_vector(title, bug_id);
+        CREATE INDEX bugs_search_vector_idx
+               ON bugs USING gin (search_vector);
+        """),
+    (6, "Number of bugs in each status, maintained by a trigger", """
+        CREATE TABLE status_counts (status_id INTEGER
+                                              PRIMARY KEY
+                                              REFERENCES statuses (status_id),
+                                    count INTEGER NOT NULL);
+        INSERT INTO status_counts (status_id, count)
+               SELECT statuses.status_id, COUNT(bugs.bug_id)
+               FROM statuses LEFT OUTER JOIN bugs ON
+                    (bugs.status_id = statuses.status_id)
+               GROUP BY statuses.status_id;
+        CREATE FUNCTION midge_status_counts_trigger() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE' AND OLD.status_id = NEW.status_id THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE status_counts SET count = count - 1
+                WHERE status_id = OLD.status_id;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                UPDATE status_counts SET count = count + 1
+                WHERE status_id = NEW.status_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        CREATE TRIGGER bugs_status_counts
+               AFTER INSERT OR DELETE OR UPDATE OF status_id ON bugs
+               FOR EACH ROW EXECUTE PROCEDURE midge_status_counts_trigger();
+        """),
+    (7, "Rendered html of comments, by the digest of the comment mappings", """
+        ALTER TABLE comments ADD COLUMN comment_id SERIAL PRIMARY KEY;
+        ALTER TABLE comments ADD COLUMN html TEXT;
+        ALTER TABLE comments ADD COLUMN html_mappings TEXT;
+        """),
+    (8, "Checkpoints of bulk imports, from which a failed import resumes", """
+        CREATE TABLE import_checkpoints (name TEXT PRIMARY KEY,
+                                         n_rows INTEGER NOT NULL);
+        """),
+    (9, "Status counts changed without deadlocks between opposite moves", """
+        CREATE OR REPLACE FUNCTION midge_status_counts_trigger()
+               RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE' THEN
+                IF OLD.status_id = NEW.status_id THEN
+                    RETURN NULL;
+                END IF;
+                -- Lock both counts in order of status_id, so that bugs
+                -- moved between the same statuses in opposite
+                -- directions at once wait rather than deadlock.
+                PERFORM 1 FROM status_counts
+                        WHERE status_id IN (OLD.status_id, NEW.status_id)
+                        ORDER BY status_id
+                        FOR UPDATE;
+                UPDATE status_counts
+                SET count = count + CASE WHEN status_id = NEW.status_id
+                                         THEN 1 ELSE -1 END
+                WHERE status_id IN (OLD.status_id, NEW.status_id);
+            ELSIF TG_OP = 'DELETE' THEN
+                UPDATE status_counts SET count = count - 1
+                WHERE status_id = OLD.status_id;
+            ELSE
+                UPDATE status_counts SET count = count + 1
+                WHERE status_id = NEW.status_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """),
+    (10, "Let bulk imports index the comments of bugs themselves", """
+        CREATE OR REPLACE FUNCTION midge_comments_search_trigger()
+        RETURNS trigger AS $$
+        BEGIN
+            -- A bulk import (see midge.io.BulkImporter) sets this for
+            -- its own transactions, and indexes the bugs afterwards.
+            IF current_setting('midge.bulk_import', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+            UPDATE bugs
+            SET search_vector = search_vector || setweight(
+                    to_tsvector('english', coalesce(NEW.comment, '')), 'B')
+            WHERE bug_id = NEW.bug_id;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """),
+    )
+
+
 def drop_tables(database):
+    drop_schema_version(database)
+    drop_import_checkpoints(database)
+    drop_sessions(database)
     drop_progress(database)
     drop_changes(database)
     drop_state(database, "tested_ok_ins")
     drop_state(database, "fixed_ins")
     drop_state(database, "reported_ins")
-    drop_state_value(database, "versions")
     drop_state(database, "keywords")
-    drop_state_value(database, "keyword_values")
     drop_state(database, "categories")
-    drop_state_value(database, "category_values")
     drop_state(database, "priorities")
-    drop_state_value(database, "priority_values")
     drop_state(database, "resolutions")
-    drop_state_value(database, "resolution_values")
     drop_comments(database)
     drop_bugs(database)
+    drop_search_functions(database)
+    drop_status_counts(database)
+    drop_state_value(database, "versions")
+    drop_state_value(database, "keyword_values")
+    drop_state_value(database, "category_values")
+    drop_state_value(database, "priority_values")
+    drop_state_value(database, "resolution_values")
     drop_statuses(database)
     drop_users(database)
 
 
-def create_tables(database):
+def create_tables(database, version=None):
+    """Create the tables, migrated to the given (or latest) version.
+
+    Returns boolean success (of the migrations).
+
+    """
     create_users(database)
     create_statuses(database)
     create_bugs(database)
@@ -85,6 +315,57 @@ def create_tables(database):
     create_state(database, "tested_ok_ins", "versions")
     create_changes(database)
     create_progress(database)
+    create_schema_version(database)
+    return migrate(database, version)
+
+
+def get_latest_version():
+    return MIGRATIONS[-1][0]
+
+
+def get_schema_version(database):
+    """Return the version of the schema (0 if never migrated)."""
+    if not have_table(database, "schema_version"):
+        return 0
+    connection = psycopg2.connect(
+        "dbname=%s user=%s password=%s" % (database,
+                                           config.Database.user,
+                                           config.Database.password))
+    cursor = connection.cursor()
+    try:
+        cursor.execute("""
+                SELECT MAX(version) FROM schema_version;
+        """)
+        return cursor.fetchone()[0] or 0
+    finally:
+        cursor.close()
+        connection.close()
+
+
+def migrate(database, latest_version=None):
+    """Apply any outstanding migrations, and return boolean success.
+
+    Migrations newer than latest_version (if given) are not applied.
+
+    """
+    if not have_table(database, "schema_version"):
+        create_schema_version(database)
+    version = get_schema_version(database)
+    for new_version, description, sql in MIGRATIONS:
+        if latest_version is not None and new_version > latest_version:
+            break
+        if new_version > version:
+            logger.info("Upgrading database %s to version %d: %s" % (
+                database, new_version, description))
+            if not run_sql(database, sql + """
+                INSERT INTO schema_version (version, description, date)
+                       VALUES (%d, '%s', 'now');
+                """ % (new_version, description)):
+                logger.error("Failed to upgrade database %s to version %d" % (
+                    database, new_version))
+                return False
+            version = new_version
+    return True
 
 
 def have_tables(database):
@@ -175,9 +456,25 @@ def drop_bugs(database):
         DROP SEQUENCE bug_ids_seq;
         """)
 
+def drop_search_functions(database):
+    # Created by a migration, so may not exist.
+    return run_sql(database, """
+        DROP FUNCTION IF EXISTS midge_bug_search_vector(TEXT, INTEGER);
+        DROP FUNCTION IF EXISTS midge_bugs_search_trigger();
+        DROP FUNCTION IF EXISTS midge_comments_search_trigger();
+        """)
+
+def drop_status_counts(database):
+    # Created by a migration, so may not exist.
+    return run_sql(database, """
+        DROP TABLE IF EXISTS status_counts;
+        DROP FUNCTION IF EXISTS midge_status_counts_trigger();
+        """)
+
 def create_comments(database):
     # Each bug has zero or more comments (accumulated over time).
-    # Once a comment has been created, it cannot be changed.
+    # Once a comment has been created, it cannot be changed (except to
+    # render its html afresh, as of migration 7).
     return run_sql(database, """
         CREATE TABLE comments (bug_id INTEGER
                                       NOT NULL
@@ -227,6 +524,31 @@ def drop_progress(database):
         DROP TABLE progress;
         """)
 
+def create_schema_version(database):
+    # One row per migration applied to the database.
+    return run_sql(database, """
+        CREATE TABLE schema_version (version     INTEGER PRIMARY KEY,
+                                     description TEXT,
+                                     date        TIMESTAMP);
+                                     """)
+
+def drop_schema_version(database):
+    return run_sql(database, """
+        DROP TABLE schema_version;
+        """)
+
+def drop_sessions(database):
+    # Created by a migration, so may not exist.
+    return run_sql(database, """
+        DROP TABLE IF EXISTS sessions;
+        """)
+
+def drop_import_checkpoints(database):
+    # Created by a migration, so may not exist.
+    return run_sql(database, """
+        DROP TABLE IF EXISTS import_checkpoints;
+        """)
+
 def create_state_value(database, value_table):
     return run_sql(database, """
         CREATE SEQUENCE %(value_table)s_ids_seq;
@@ -260,7 +582,8 @@ def drop_state_value(database, value_table):
 
 
 def drop_state(database, bug_table):
+    # Dropped by a migration, so may not exist.
     return run_sql(database, """
-        DROP TABLE %(bug_table)s;
+        DROP TABLE IF EXISTS %(bug_table)s;
         """ % {"bug_table":bug_table})
 
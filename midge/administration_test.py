@@ -54,13 +54,9 @@ class AdministrationTests(unittest.TestCase):
         cursor.execute("SELECT * FROM versions;")
         self.assertEqual(len(cursor.fetchall()), 0)
        
-        cursor.execute("SELECT * FROM reported_ins;")
-        self.assertEqual(len(cursor.fetchall()), 0)
-       
-        cursor.execute("SELECT * FROM fixed_ins;")
-        self.assertEqual(len(cursor.fetchall()), 0)
-       
-        cursor.execute("SELECT * FROM tested_ok_ins;")
+        cursor.execute("SELECT priority_id, resolution_id, category_id, "
+                       "keyword_id, reported_in_id, fixed_in_id, "
+                       "tested_ok_in_id FROM bugs;")
         self.assertEqual(len(cursor.fetchall()), 0)
 
         cursor.execute("SELECT * FROM changes;")
@@ -70,3 +66,66 @@ class AdministrationTests(unittest.TestCase):
         self.assertEqual(len(cursor.fetchall()), 0)
        
         cursor.close()
+
+    def test_schema_version(self):
+        """Check new tables are fully migrated"""
+        self.assertEqual(
+            administration.get_schema_version(config.Database.test_name),
+            administration.get_latest_version())
+        self.assertEqual(
+            administration.migrate(config.Database.test_name), True)
+        self.assertEqual(
+            administration.get_schema_version(config.Database.test_name),
+            administration.get_latest_version())
+
+    def test_migrate_without_trigram_indexes(self):
+        """Check later migrations apply even if trigram indexes cannot"""
+        database = config.Database.test_name
+        self.connection.close()
+        administration.drop_tables(database)
+        administration.create_tables(database, 1)
+        # Make creating the trigram indexes fail, as it would without
+        # the pg_trgm extension.
+        administration.run_sql(database, """
+            CREATE INDEX bugs_title_trgm_idx ON bugs (title);
+            """)
+        self.assertEqual(administration.migrate(database), True)
+        self.assertEqual(administration.get_schema_version(database),
+                         administration.get_latest_version())
+        self.connection = psycopg2.connect(
+            "dbname=%s user=%s password=%s" % (database,
+                                               config.Database.user,
+                                               config.Database.password))
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT to_regclass('comments_comment_trgm_idx');")
+        self.assertEqual(cursor.fetchone(), (None,))
+        cursor.close()
+
+    def test_migrate_states_into_bugs(self):
+        """Check states of existing bugs are moved into the bugs table"""
+        database = config.Database.test_name
+        self.connection.close()
+        administration.drop_tables(database)
+        administration.create_tables(database, 3)
+        self.assertEqual(administration.have_table(database, "categories"),
+                         True)
+        administration.run_sql(database, """
+            INSERT INTO users (user_id, username) VALUES (1, 'username');
+            INSERT INTO bugs (bug_id, user_id, title, status_id)
+                   VALUES (1, 1, 'a title', 1);
+            INSERT INTO bugs (bug_id, user_id, title, status_id)
+                   VALUES (2, 1, 'another title', 1);
+            INSERT INTO category_values (id, name) VALUES (1, 'a category');
+            INSERT INTO categories (bug_id, id) VALUES (1, 1);
+            """)
+        self.assertEqual(administration.migrate(database), True)
+        self.assertEqual(administration.have_table(database, "categories"),
+                         False)
+        self.connection = psycopg2.connect(
+            "dbname=%s user=%s password=%s" % (database,
+                                               config.Database.user,
+                                               config.Database.password))
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT bug_id, category_id FROM bugs ORDER BY bug_id;")
+        self.assertEqual(cursor.fetchall(), [(1, 1), (2, None)])
+        cursor.close()
@@ -6,26 +6,16 @@
 import re
 import sets
 import textwrap
+import threading
 import time
 
 import midge.config as config
 import midge.connection as connection
 import midge.lib as lib
 import midge.logger as logger
-
-
-def quote(x):
-    # TODO make more efficient - use translate?, or re.escape ?
-    # and make sure coverage complete.
-    # NB the order of these replacements is very important...
-    x = x.replace("\\", r"\\")
-    x = x.replace("\b", r"\b")
-    x = x.replace("\f", r"\f")
-    x = x.replace("\r", r"\r")
-    x = x.replace("\n", r"\n")
-    x = x.replace("\t", r"\t")
-    x = x.replace("'", r"\047")
-    return x
+import midge.scheduler as scheduler
+import midge.sessions as sessions
+import midge.templates as templates
 
 
 class MidgeException(Exception):
@@ -59,25 +49,29 @@ class User(object):
 
     """Represent a user who may or may not be logged-in.
 
-    The user attributes are all obtained live from the database, so it
-    is ok to keep hold of a User instance for as long as is
-    convenient.
+    The user attributes are all read from the database in one go, and
+    the record is then held in a cache (typically shared by all User
+    instances) keyed by user_id. The cache entry is invalidated on
+    every change made through a User, so it is ok to keep hold of a
+    User instance for as long as is convenient.
 
     """
-    def __init__(self, connection, username=None):
+    def __init__(self, connection, username=None, cache=None, user_id=None):
         self.connection = connection
-        self.user_id = None
+        if cache is None:
+            cache = lib.ExpiringCache(config.Cache.timeout)
+        self.cache = cache
+        self.user_id = user_id
         if username:
             self.user_id = self._get_user_id(username)
         
     def _get_user_id(self, username):
         user_id = None
-        username = quote(username)
         cursor = self.connection.cursor()
-        cursor.execute("""
+        connection.execute_prepared(cursor, """
                 SELECT user_id FROM users
-                WHERE username='%s';
-                """ % username)
+                WHERE username=$1
+                """, (username,))
         ans = cursor.fetchone()
         if ans is not None:
             user_id = ans[0]
@@ -86,12 +80,11 @@ class User(object):
 
     def authenticate(self, password):
         assert self.user_id
-        password = quote(password)
         cursor = self.connection.cursor()
-        cursor.execute("""
-                SELECT * FROM users
-                WHERE user_id=%d AND password='%s';
-                """ % (self.user_id, password))
+        connection.execute_prepared(cursor, """
+                SELECT user_id FROM users
+                WHERE user_id=$1 AND password=$2
+                """, (self.user_id, password))
         ans = cursor.fetchone()
         authenticated = ans is not None
         cursor.close()
@@ -104,36 +97,52 @@ class User(object):
 
     def set_password(self, password):
         if self.user_id is not None:
-            password = quote(password)
             return self._set_attribute("password", password)
         return False
 
     password = property(get_password, set_password)
 
-    def _get_attribute(self, attribute):
-        assert self.user_id
-        value = None
+    def _get_record(self):
+        """Return a dictionary of all the user's attributes."""
+        record = self.cache.get(self.user_id)
+        if record is None:
+            record = self._read_record()
+            self.cache.set(self.user_id, record)
+        return record
+
+    def _read_record(self):
+        record = {}
         cursor = self.connection.cursor()
-        cursor.execute("""
-                SELECT %s FROM users
-                WHERE user_id=%d;
-                """ % (attribute, self.user_id))
+        connection.execute_prepared(cursor, """
+                SELECT username, name, email, password FROM users
+                WHERE user_id=$1
+                """, (self.user_id,))
         ans = cursor.fetchone()
         if ans is not None:
-            value = ans[0]
+            username, name, email, password = ans
+            record = {"username": username,
+                      "name": name,
+                      "email": email,
+                      "password": password}
         cursor.close()
-        return value
+        return record
+
+    def _get_attribute(self, attribute):
+        assert self.user_id
+        return self._get_record().get(attribute, None)
 
     def _set_attribute(self, attribute, value):
         assert self.user_id
-        value = quote(value)
         cursor = self.connection.cursor()
-        cursor.execute("""
-                UPDATE users SET %s='%s'
-                WHERE user_id=%d;
-                """ % (attribute, value, self.user_id))
-        self.connection.commit()
-        cursor.close()
+        try:
+            cursor.execute("""
+                UPDATE users SET %s=%%s
+                WHERE user_id=%%s;
+                """ % attribute, (value, self.user_id))
+            self.connection.commit()
+        finally:
+            cursor.close()
+            self.cache.invalidate(self.user_id)
         return True
 
     def get_username(self):
@@ -181,30 +190,42 @@ class User(object):
 
 class Users(object):
 
-    """Access to all operations relating to users."""
+    """Access to all operations relating to users.
 
-    def __init__(self, connection):
+    Which user is logged-in to each session is kept by the session
+    store, so may be shared with other processes.
+
+    """
+
+    def __init__(self, connection, session_store=None):
         self.connection = connection
-        self.logged_in_users = {}
+        if session_store is None:
+            session_store = sessions.MemoryStore()
+        self.session_store = session_store
+        self.user_cache = lib.ExpiringCache(config.Cache.timeout)
+        # The User of each session recently seen, to save making anew.
+        self._session_users = lib.ExpiringCache(config.Cache.timeout)
 
     def expired_session(self, session_id):
-        user = self.logged_in_users.get(session_id, None)
+        user = self.get_user(session_id)
         if user is not None:
             logger.info('"Timeout of user "%s"' % user.username)
             user.logout()
-            del self.logged_in_users[session_id]
+        # The session may already have gone from the store (e.g. when
+        # evicted), but not yet from here.
+        self._session_users.invalidate(session_id)
+        self.session_store.remove(session_id)
+
+    def do_maintenance(self):
+        self._session_users.purge()
 
     def create_new_user(self, username, name, email, password):
         cursor = self.connection.cursor()
-        username = quote(username)
-        name = quote(name)
-        email = quote(email)
-        password = quote(password)
         try:
             cursor.execute("""
                 INSERT INTO users (username, password, name, email)
-                       VALUES ('%s', '%s', '%s', '%s');
-                       """ % (username, password, name, email))
+                       VALUES (%s, %s, %s, %s);
+                       """, (username, password, name, email))
             self.connection.commit()
         except connection.IntegrityError:
             # Almost certainly caused by username in use.
@@ -214,9 +235,10 @@ class Users(object):
         cursor.close()
             
     def login(self, session_id, username, password):
-        user = User(self.connection)
+        user = User(self.connection, cache=self.user_cache)
         if user.login(username, password):
-            self.logged_in_users[session_id] = user
+            self.session_store.set_user_id(session_id, user.user_id)
+            self._session_users.set(session_id, user)
             logger.info('Logging in user "%s" under session: %s' % (
                 user.username, session_id))
             return True
@@ -225,18 +247,27 @@ class Users(object):
             return False
 
     def logout(self, session_id):
-        user = self.logged_in_users.get(session_id, None)
+        user = self.get_user(session_id)
         if user is not None:
             logger.info('Logged out user "%s" under session: %s' % (
                 user.username, session_id))
             user.logout()
-            del self.logged_in_users[session_id]
+            self._session_users.invalidate(session_id)
+            self.session_store.set_user_id(session_id, None)
             return True
         else:
             return False
 
     def get_user(self, session_id):
-        return self.logged_in_users.get(session_id, None)
+        user_id = self.session_store.get_user_id(session_id)
+        if user_id is None:
+            return None
+        user = self._session_users.get(session_id)
+        if user is None or user.user_id != user_id:
+            user = User(self.connection, cache=self.user_cache,
+                        user_id=user_id)
+            self._session_users.set(session_id, user)
+        return user
 
     def _get_usernames(self):
         cursor = self.connection.cursor()
@@ -248,8 +279,19 @@ class Users(object):
 
     usernames = property(_get_usernames)
 
+    def get_user_ids(self):
+        """Return a dictionary of the user_id of every user, by username."""
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("""
+                SELECT username, user_id FROM users;
+                """)
+            return dict(cursor.fetchall())
+        finally:
+            cursor.close()
+
     def email_password(self, username):
-        user = User(self.connection, username)
+        user = User(self.connection, username, self.user_cache)
         if user.username != username:
             raise NoSuchUsernameException, username
         return lib.sendmail(
@@ -266,60 +308,66 @@ class Users(object):
             return rows
         finally:
             cursor.close()
+
+    def write_users(self, cursor, wfile):
+        """Write the same as export_users() to wfile, as csv.
+
+        The rows are streamed by postgres straight to wfile, so are
+        never held in memory.
+
+        """
+        cursor.copy_expert("""
+            COPY (SELECT username AS "Username",
+                         name AS "Name",
+                         email AS "Email",
+                         password AS "Password"
+                  FROM users
+                  ORDER BY user_id)
+            TO STDOUT WITH (FORMAT csv, HEADER);
+            """, wfile)
     
 
 class Comment:
 
-    """A single comment for a particular bug, cached from the database."""
+    """A single comment for a particular bug, cached from the database.
+
+    The html is that rendered from the text by the current comment
+    mappings, or None if it was rendered by different mappings.
+
+    """
 
-    def __init__(self, bug_id, users_name, username, date, text):
+    def __init__(self, bug_id, users_name, username, date, text, html=None):
         self.bug_id = bug_id
         self.users_name = users_name
         self.username = username
         self.date = date
         self.text = text
+        self.html = html
 
 
 class Comments(list):
 
     """A list of comments for a particular bug, cached from the database."""
 
-    def __init__(self, connection, bug_id):
+    def __init__(self, bug_id, rows=()):
         list.__init__(self)
-        self.connection = connection
         self.bug_id = bug_id
-        self._read_comments_from_database()
-        
-    def _read_comments_from_database(self):
-        cursor = self.connection.cursor()
-        cursor.execute("""
-                SELECT users.name, users.username, date, comment
-                FROM comments, users
-                WHERE bug_id=%d
-                AND comments.user_id = users.user_id
-                ORDER BY date ASC;
-                """ % self.bug_id)
-        results = cursor.fetchall()
-        cursor.close()
-        if results is not None:
-            for result in results:
-                users_name, username, date, text = result
-                self.append(Comment(self.bug_id,
-                                    users_name,
-                                    username,
-                                    date,
-                                    text))
-        else:
-            raise UnableToReadCommentsException, self.bug_id
+        for users_name, username, date, text, html in rows:
+            self.append(Comment(bug_id, users_name, username, date, text,
+                                html))
 
     def add(self, cursor, user, text, timestamp=None):
+        """Add the comment, along with its html."""
         if timestamp is None:
             timestamp = time.ctime()
-        text = quote(text.strip())
+        text = text.strip()
         cursor.execute("""
-                INSERT INTO comments (bug_id, user_id, date, comment)
-                       VALUES (%d, %d, '%s', '%s');
-                """ % (self.bug_id, user.user_id, timestamp, text))
+                INSERT INTO comments (bug_id, user_id, date, comment,
+                                      html, html_mappings)
+                       VALUES (%s, %s, %s, %s, %s, %s);
+                """, (self.bug_id, user.user_id, timestamp, text,
+                      templates.format_comment(text, False),
+                      templates.get_comment_digest()))
 
     
 
@@ -328,9 +376,9 @@ class Statuses(object):
     """All operations relating to bug statuses.
 
     Note Statuses is not a StateTable, as every bug must have a
-    non-null status. Thus the underlying bugs table links to an entry
-    in the statuses table, in contrast to every type of StateTable
-    which link the other way (from state table to the bugs table).
+    non-null status, and the set of statuses is fixed. Thus the
+    status_id column of the bugs table is never NULL, in contrast to
+    the column of every type of StateTable.
     
     """
     def __init__(self, connection):
@@ -389,36 +437,70 @@ class Statuses(object):
 
     initial_id = property(_get_initial_id)
 
-    def set_for_bug(self, cursor, bug_id, status):
+    def get_ids(self):
+        """Return a dictionary of the status_id of every status, by name."""
+        cursor = self.connection.cursor()
         try:
             cursor.execute("""
-            UPDATE bugs
-            SET status_id = (
-                SELECT status_id
-                FROM statuses
-                WHERE name = '%s'
-                )
-            WHERE bug_id = %d;
-            """ % (status, bug_id))
+                    SELECT name, status_id FROM statuses;
+                    """)
+            return dict(cursor.fetchall())
+        finally:
+            cursor.close()
+
+    def set_for_bug(self, cursor, bug_id, status):
+        try:
+            connection.execute_prepared(cursor, """
+                UPDATE bugs
+                SET status_id = (
+                    SELECT status_id
+                    FROM statuses
+                    WHERE name = $1
+                    )
+                WHERE bug_id = $2
+                """, (status, bug_id))
         except connection.IntegrityError:
             raise InvalidValueException, (bug_id, status)
 
 
 class StateTable(object):
 
-    """Abstract behaviour of all optional bug states."""
+    """Abstract behaviour of all optional bug states.
+
+    The state of each bug is held in the bug_column of the bugs table,
+    which refers to (the id of) a value in the value_table, or is NULL
+    if the bug does not have the state.
+
+    """
 
     # These need to be provided by subclasses.
     valid_value = None
-    bug_table = None
+    bug_column = None
     value_table = None
     alphabetical = True
     
-    def __init__(self, connection):
+    def __init__(self, connection, cache=None):
+        """Construct a StateTable.
+
+        The cache holds the values of each value_table, and should be
+        shared by all StateTables so that those sharing a value_table
+        see each others new values immediately.
+
+        """
         self.connection = connection
+        if cache is None:
+            cache = lib.ExpiringCache(config.Cache.timeout)
+        self.cache = cache
 
     def _get_values(self):
         """Return a list of all existing values."""
+        values = self.cache.get(self.value_table)
+        if values is None:
+            values = self._read_values()
+            self.cache.set(self.value_table, values)
+        return values
+
+    def _read_values(self):
         cursor = self.connection.cursor()
         if self.alphabetical:
             sort_column = "name"
@@ -445,15 +527,39 @@ class StateTable(object):
         cursor = self.connection.cursor()
         try:
             cursor.execute("""
-                INSERT INTO %(value_table)s (name)
-                VALUES ('%(value)s');                 
-                """ % {"value_table":self.value_table, "value":value})
+                INSERT INTO %s (name)
+                VALUES (%%s);
+                """ % self.value_table, (value,))
             self.connection.commit()
         except connection.IntegrityError:
             self.connection.rollback()
             cursor.close()
+            self.cache.invalidate(self.value_table)
             raise ValueInUseException
         cursor.close()
+        self.cache.invalidate(self.value_table)
+
+    def get_ids(self, cursor, values):
+        """Return a dictionary of the ids of the values, by value.
+
+        Any of the values which are new are created, as part of the
+        transaction of the cursor, so the cache should be invalidated
+        once it has been committed. Raises if any value is invalid.
+
+        """
+        for value in values:
+            if not self.valid_value.match(value):
+                raise InvalidValueException, value
+        values = list(values)
+        cursor.execute("""
+                INSERT INTO %s (name)
+                SELECT unnest(%%s::TEXT[])
+                ON CONFLICT (name) DO NOTHING;
+                """ % self.value_table, (values,))
+        cursor.execute("""
+                SELECT name, id FROM %s WHERE name = ANY(%%s::TEXT[]);
+                """ % self.value_table, (values,))
+        return dict(cursor.fetchall())
 
     def get_for_bug(self, cursor, bug_id):
         """Return one of the values for a given bug (may be "").
@@ -464,12 +570,12 @@ class StateTable(object):
         """
         cursor.execute("""
                 SELECT name
-                FROM %(bug_table)s, %(value_table)s
-                WHERE bug_id = %(bug_id)d AND
-                      %(value_table)s.id = %(bug_table)s.id;
-                """ % {"bug_table":self.bug_table,
-                       "value_table":self.value_table,
-                       "bug_id":bug_id})
+                FROM bugs, %(value_table)s
+                WHERE bug_id = %%s AND
+                      %(value_table)s.id = bugs.%(bug_column)s;
+                """ % {"bug_column":self.bug_column,
+                       "value_table":self.value_table},
+                       (bug_id,))
         ans = cursor.fetchone()
         if ans:
             return ans[0]
@@ -479,69 +585,50 @@ class StateTable(object):
     def set_for_bug(self, cursor, bug_id, value):
         """Change one of the values for a given bug.
 
-        Will create a new value if necessary.
+        Will create a new value if necessary, in the same transaction
+        which sets the value for the bug. Returns whether the value may
+        be new, in which case the cache should be invalidated once the
+        transaction has been committed.
         
         """
         value = str(value).strip()
         if value:
             if not self.valid_value.match(value):
                 raise InvalidValueException, value
-            state_id = self._get_id(cursor, value)
-            if not state_id:
-                self.create_new_value(value)
-                state_id = self._get_id(cursor, value)
-            if self.get_for_bug(cursor, bug_id):
-                self._update_for_bug(cursor, bug_id, state_id)
-            else:
-                self._insert_for_bug(cursor, bug_id, state_id)
+            is_new = value not in self.values
+            # Separate statements, as the value may be inserted by
+            # another transaction which commits after this insert
+            # starts, which the snapshot of a single statement (as
+            # needed to find the id) would not see.
+            connection.execute_prepared(cursor, """
+                INSERT INTO %s (name) VALUES ($1)
+                ON CONFLICT (name) DO NOTHING
+                """ % self.value_table, (value,))
+            connection.execute_prepared(cursor, """
+                UPDATE bugs
+                SET %(bug_column)s = (SELECT id FROM %(value_table)s
+                                      WHERE name = $2)
+                WHERE bug_id = $1
+                """ % {"bug_column": self.bug_column,
+                       "value_table": self.value_table},
+                (bug_id, value))
+            return is_new
         else:
-            self._delete_for_bug(cursor, bug_id)
-
-    def _get_id(self, cursor, value):
-        cursor.execute("""
-                SELECT id
-                FROM %(value_table)s
-                WHERE name = '%(value)s';
-                """ % {"value_table":self.value_table, "value":value})
-        ans = cursor.fetchone()
-        if ans:
-            return ans[0]
-        else:
-            return None
-            
-    def _delete_for_bug(self, cursor, bug_id):
-        cursor.execute("""
-                DELETE FROM %(table)s
-                WHERE bug_id=%(bug_id)d;
-                """ % {"table":self.bug_table, "bug_id":bug_id})
-
-    def _update_for_bug(self, cursor, bug_id, state_id):
-        cursor.execute("""
-                UPDATE %(table)s
-                SET id = %(state_id)d
-                WHERE bug_id = %(bug_id)d;
-                """ % {"table":self.bug_table,
-                       "bug_id":bug_id,
-                       "state_id":state_id})
-
-    def _insert_for_bug(self, cursor, bug_id, state_id):
-        cursor.execute("""
-                INSERT INTO %(table)s (bug_id, id)
-                VALUES (%(bug_id)d, %(state_id)d);
-                """ % {"table":self.bug_table,
-                       "bug_id":bug_id,
-                       "state_id":state_id})
+            connection.execute_prepared(cursor, """
+                UPDATE bugs SET %s = NULL WHERE bug_id = $1
+                """ % self.bug_column, (bug_id,))
+            return False
 
 
 class Priorities(StateTable):
 
     valid_value = re.compile("^[a-zA-Z0-9.\(\) ]+$")
-    bug_table = "priorities"
+    bug_column = "priority_id"
     value_table = "priority_values"
     alphabetical = False
 
-    def __init__(self, connection):
-        StateTable.__init__(self, connection)
+    def __init__(self, connection, cache=None):
+        StateTable.__init__(self, connection, cache)
         existing_values = self.values
         for value in ("1", "2", "3", "4", "5"):
             if value not in existing_values:
@@ -553,21 +640,21 @@ class Priorities(StateTable):
 class Resolutions(StateTable):
 
     valid_value = re.compile(r"^[a-zA-Z0-9. _/-]+$")
-    bug_table = "resolutions"
+    bug_column = "resolution_id"
     value_table = "resolution_values"
 
 
 class Categories(StateTable):
 
     valid_value = re.compile(r"^[a-zA-Z0-9. _/-]+$")
-    bug_table = "categories"
+    bug_column = "category_id"
     value_table = "category_values"
 
 
 class Keywords(StateTable):
 
     valid_value = re.compile(r"^[a-zA-Z0-9. _/-]+$")
-    bug_table = "keywords"
+    bug_column = "keyword_id"
     value_table = "keyword_values"
 
 
@@ -579,23 +666,139 @@ class Versions(StateTable):
 
 class ReportedIns(Versions):
 
-    bug_table = "reported_ins"
+    bug_column = "reported_in_id"
 
 
 class FixedIns(Versions):
 
-    bug_table = "fixed_ins"
+    bug_column = "fixed_in_id"
 
 
 class TestedOkIns(Versions):
 
-    bug_table = "tested_ok_ins"
+    bug_column = "tested_ok_in_id"
+
+
+class ResultCache(object):
+
+    """The results of queries, each valid until the data next changes.
+
+    Every write to the bugs, their comments and changes, or progress
+    bumps the generation, which forgets all the results cached before
+    it. A result is only kept if no write happened while it was being
+    read, as given by the generation passed to set(). Writes by other
+    midged processes sharing the database do not bump the generation,
+    so results also expire after config.Cache.timeout, as for the
+    other caches.
+
+    The results are held by a lib.LRUCache, bounded by an estimate of
+    their size in bytes.
+
+    """
+    def __init__(self, max_size, timeout):
+        self.timeout = timeout
+        self.generation = 0
+        self.n_hits = 0
+        self.n_misses = 0
+        self._results = lib.LRUCache(max_size)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the result cached for the key, or None if there is none."""
+        self._lock.acquire()
+        try:
+            entry = self._results.get(key)
+            if entry is not None and entry[0] < time.time():
+                self._results.remove(key)
+                entry = None
+            if entry is None:
+                self.n_misses += 1
+                return None
+            self.n_hits += 1
+            return entry[1]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, size, generation):
+        """Cache the value, if read since the data last changed.
+
+        generation should be that read before the value was read from
+        the database.
+
+        """
+        self._lock.acquire()
+        try:
+            if generation == self.generation:
+                self._results.set(key, (time.time() + self.timeout, value),
+                                  size)
+        finally:
+            self._lock.release()
+
+    def can_hold(self, size):
+        """Return whether a result of the given size would be cached."""
+        return size <= self._results.max_size
+
+    def bump(self):
+        """Note that the data has changed, forgetting every result."""
+        self._lock.acquire()
+        try:
+            self.generation += 1
+            self._results.clear()
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        """Return a dictionary of the numbers of results, hits, etc."""
+        self._lock.acquire()
+        try:
+            return dict(results=len(self._results),
+                        size=self._results.size,
+                        max_size=self._results.max_size,
+                        hits=self.n_hits,
+                        misses=self.n_misses,
+                        evictions=self._results.n_evictions,
+                        generation=self.generation)
+        finally:
+            self._lock.release()
+
+
+def _make_result_cache():
+    return ResultCache(config.Cache.results_size * 1024, config.Cache.timeout)
+
+
+def _estimate_size(results):
+    """Return roughly how many bytes the results (tuples of values) take."""
+    size = 0
+    for result in results:
+        size += 64
+        for value in result:
+            size += 32
+            if isinstance(value, basestring):
+                size += len(value)
+    return size
+
+
+def _sort_results(results, index, order):
+    """Sort the list of results (tuples of values) by the value at index.
+
+    The value should be a rank given by the database (by rank() OVER
+    the column to be sorted), so that the results are sorted exactly
+    as by the database, i.e. by its collation, with NULL values after
+    all others when ascending and before them when descending. The sort
+    is stable, so results with equal values keep their order.
+
+    """
+    results.sort(key=lambda result: result[index],
+                 reverse=(order == "descending"))
 
 
 class Summary(object):
 
-    def __init__(self, connection):
+    def __init__(self, connection, results=None):
         self.connection = connection
+        if results is None:
+            results = _make_result_cache()
+        self.results = results
 
     def _get_status_counts(self):
         cursor = self.connection.cursor()
@@ -607,12 +810,11 @@ class Summary(object):
             fixed = 0
             closed = 0
 
-        cursor.execute("""
+        connection.execute_prepared(cursor, """
                 SELECT statuses.name,
-                       COUNT(*)
-                FROM statuses, bugs
-                WHERE bugs.status_id = statuses.status_id
-                GROUP BY statuses.name;
+                       status_counts.count
+                FROM statuses, status_counts
+                WHERE status_counts.status_id = statuses.status_id
         """)
         result = cursor.fetchall()
         count = Count()
@@ -624,6 +826,38 @@ class Summary(object):
 
     status_counts = property(_get_status_counts)
 
+    def reconcile_status_counts(self):
+        """Correct the maintained number of bugs in each status.
+
+        The numbers are kept by a trigger on the bugs table, so should
+        never need correcting. Returns how many were corrected.
+
+        """
+        cursor = self.connection.cursor()
+        try:
+            # Wait for (and then block) any transaction changing the
+            # counts, so that the bugs counted below are all committed.
+            cursor.execute("""
+                SELECT status_id FROM status_counts FOR UPDATE;
+                """)
+            cursor.execute("""
+                UPDATE status_counts SET count = actual.count
+                FROM (SELECT statuses.status_id, COUNT(bugs.bug_id) AS count
+                      FROM statuses LEFT OUTER JOIN bugs ON
+                           (bugs.status_id = statuses.status_id)
+                      GROUP BY statuses.status_id) AS actual
+                WHERE status_counts.status_id = actual.status_id
+                  AND status_counts.count != actual.count;
+                """)
+            n_corrected = cursor.rowcount
+            self.connection.commit()
+        finally:
+            cursor.close()
+        if n_corrected:
+            logger.warn("Corrected the number of bugs in %d statuses" % \
+                        n_corrected)
+        return n_corrected
+
     def do_maintenance(self):
         self._take_snapshot()
         self._keep_short()
@@ -634,34 +868,46 @@ class Summary(object):
             counts = self.status_counts
             cursor.execute("""
               INSERT INTO progress VALUES
-              ('%s', %d, %d, %d, %d, %d)
-              """ % (time.ctime(),
-                     counts.new,
-                     counts.reviewed,
-                     counts.scheduled,
-                     counts.fixed,
-                     counts.closed))
+              (%s, %s, %s, %s, %s, %s)
+              """, (time.ctime(),
+                    counts.new,
+                    counts.reviewed,
+                    counts.scheduled,
+                    counts.fixed,
+                    counts.closed))
             self.connection.commit()
         finally:
             cursor.close()
+        self.results.bump()
 
     def get_progress(self):
-        cursor = self.connection.cursor()
-        try:
-            class Progress:
 
-                variables = ("date", "new", "reviewed", "scheduled",
-                             "fixed", "closed")
-                titles = ("Date",
-                          "New",
-                          "Reviewed",
-                          "Scheduled",
-                          "Fixed",
-                          "Closed")
+        class Progress:
+
+            variables = ("date", "new", "reviewed", "scheduled",
+                         "fixed", "closed")
+            titles = ("Date",
+                      "New",
+                      "Reviewed",
+                      "Scheduled",
+                      "Fixed",
+                      "Closed")
+
+            def __init__(self, rows):
+                self.rows = rows
 
-                def __init__(self, rows):
-                    self.rows = rows
+        deltas = self.results.get(("progress",))
+        if deltas is None:
+            generation = self.results.generation
+            deltas = self._read_progress()
+            self.results.set(("progress",), deltas, _estimate_size(deltas),
+                             generation)
+        return Progress([Row(Progress.variables, *delta) for delta in deltas])
 
+    def _read_progress(self):
+        """Return the net change in each status, by day, latest first."""
+        cursor = self.connection.cursor()
+        try:
             cursor.execute("""
               SELECT * FROM progress
               ORDER BY date ASC
@@ -677,7 +923,7 @@ class Summary(object):
 #               ORDER BY temp_progress.date ASC;
 #             """)
 
-            rows = []
+            deltas = []
             counts = cursor.fetchall()
             if len(counts) > 0:
                 old_count = counts[0]
@@ -687,11 +933,11 @@ class Summary(object):
                         delta = [lib.format_date(old_count[0]), 0, 0, 0, 0, 0]
                         for i in (1,2,3,4,5):
                             delta[i] = count[i] - old_count[i]
-                        rows.append(Row(Progress.variables, *delta))
+                        deltas.append(delta)
                         old_count = count
                         old_day = lib.get_day(count[0])
-                rows.reverse()
-            return Progress(rows)
+                deltas.reverse()
+            return deltas
         
         finally:
             cursor.close()
@@ -702,10 +948,11 @@ class Summary(object):
             now = time.ctime(time.time() -
                              config.History.progress_max_age * 60*60*24)
             cursor.execute("""
-              DELETE FROM progress WHERE date<'%s'""" % now)
+              DELETE FROM progress WHERE date<%s""", (now,))
             self.connection.commit()
         finally:
             cursor.close()
+        self.results.bump()
 
 
 class Bug(object):
@@ -727,14 +974,23 @@ class Bug(object):
         self.reported_in = None
         self.fixed_in = None
         self.tested_ok_in = None
+        self._comments = None
         self._read_bug_from_database()
         
     def _read_bug_from_database(self):
+        """Read the state of the bug and all its comments in one query.
+
+        The comments are joined on, so there is one row for each
+        comment (or just one row if there are none), each repeating the
+        state of the bug. The html of each comment is only read if it
+        was rendered by the current comment mappings.
+
+        """
         cursor = self.bugs.connection.cursor()
-        cursor.execute("""
-                SELECT user_id,
-                       date,
-                       title,
+        connection.execute_prepared(cursor, """
+                SELECT bugs.user_id,
+                       bugs.date,
+                       bugs.title,
                        statuses.name,
                        priority_values.name,
                        resolution_values.name,
@@ -742,50 +998,40 @@ class Bug(object):
                        keyword_values.name,
                        reported_versions.name,
                        fixed_versions.name,
-                       tested_ok_versions.name                       
-                FROM (((((((((((((((
+                       tested_ok_versions.name,
+                       users.name,
+                       users.username,
+                       comments.date,
+                       comments.comment,
+                       CASE WHEN comments.html_mappings = $2
+                            THEN comments.html END,
+                       comments.comment_id
+                FROM (((((((((
                            statuses INNER JOIN bugs ON
                            (bugs.status_id = statuses.status_id)
-
-                         ) LEFT OUTER JOIN priorities ON
-                           (priorities.bug_id = %(bug_id)s)
                          ) LEFT OUTER JOIN priority_values ON
-                           (priority_values.id = priorities.id)
-
-                         ) LEFT OUTER JOIN resolutions ON
-                           (resolutions.bug_id = %(bug_id)s)
+                           (priority_values.id = bugs.priority_id)
                          ) LEFT OUTER JOIN resolution_values ON
-                           (resolution_values.id = resolutions.id)
-
-                         ) LEFT OUTER JOIN categories ON
-                           (categories.bug_id = %(bug_id)s)
+                           (resolution_values.id = bugs.resolution_id)
                          ) LEFT OUTER JOIN category_values ON
-                           (category_values.id = categories.id)
-
-                         ) LEFT OUTER JOIN keywords ON
-                           (keywords.bug_id = %(bug_id)s)
+                           (category_values.id = bugs.category_id)
                          ) LEFT OUTER JOIN keyword_values ON
-                           (keyword_values.id = keywords.id)
-
-                         ) LEFT OUTER JOIN reported_ins ON
-                           (reported_ins.bug_id = %(bug_id)s)
+                           (keyword_values.id = bugs.keyword_id)
                          ) LEFT OUTER JOIN versions AS reported_versions ON
-                           (reported_versions.id = reported_ins.id)
-
-                         ) LEFT OUTER JOIN fixed_ins ON
-                           (fixed_ins.bug_id = %(bug_id)s)
+                           (reported_versions.id = bugs.reported_in_id)
                          ) LEFT OUTER JOIN versions AS fixed_versions ON
-                           (fixed_versions.id = fixed_ins.id)
-
-                         ) LEFT OUTER JOIN tested_ok_ins ON
-                           (tested_ok_ins.bug_id = %(bug_id)s)
+                           (fixed_versions.id = bugs.fixed_in_id)
                          ) LEFT OUTER JOIN versions AS tested_ok_versions ON
-                           (tested_ok_versions.id = tested_ok_ins.id))
-                WHERE bugs.bug_id = %(bug_id)s;
-                """ % {"bug_id": self.bug_id})
-        result = cursor.fetchone()
+                           (tested_ok_versions.id = bugs.tested_ok_in_id)
+                         ) LEFT OUTER JOIN (comments INNER JOIN users ON
+                             (users.user_id = comments.user_id)) ON
+                           (comments.bug_id = $1))
+                WHERE bugs.bug_id = $1
+                ORDER BY comments.date ASC
+                """, (self.bug_id, templates.get_comment_digest()))
+        results = cursor.fetchall()
         cursor.close()
-        if result is not None:
+        if results:
             (self.user_id,
              self.date,
              title,
@@ -796,7 +1042,7 @@ class Bug(object):
              keyword,
              reported_in,
              fixed_in,
-             tested_ok_in) = result
+             tested_ok_in) = results[0][:11]
             # Convert None's into ""s
             self.priority = priority or ""
             self.resolution = resolution or ""
@@ -806,11 +1052,14 @@ class Bug(object):
             self.fixed_in = fixed_in or ""
             self.tested_ok_in = tested_ok_in or ""
             self.title = title
+            self._comments = Comments(self.bug_id,
+                                      [result[11:16] for result in results
+                                       if result[16] is not None])
         else:
             raise NoSuchBugException, self.bug_id
 
     def _get_comments(self):
-        return Comments(self.bugs.connection, self.bug_id)
+        return self._comments
 
     comments = property(_get_comments)
 
@@ -825,62 +1074,97 @@ class Bug(object):
             self._change(user, cursor, log_changes, **args)
         finally:
             cursor.close()
+        # Re-read the bug, so that it (and its comments) show the changes.
+        self._read_bug_from_database()
+
+    # The state tables of the optional states, by variable.
+    _state_tables = (("priority", "priorities"),
+                     ("resolution", "resolutions"),
+                     ("category", "categories"),
+                     ("keyword", "keywords"),
+                     ("reported_in", "reported_ins"),
+                     ("fixed_in", "fixed_ins"),
+                     ("tested_ok_in", "tested_ok_ins"))
 
     def _change(self, user, cursor, log_changes, **args):
+        """Make all the changes, and log them, in a single transaction."""
+        new_values = []
         try:
-            if "status" in args:
-                status = args["status"]
-                self.bugs.statuses.set_for_bug(
-                    cursor, self.bug_id, status)
-            if "priority" in args:
-                priority = args["priority"]
-                self.bugs.priorities.set_for_bug(
-                    cursor, self.bug_id, priority)
-            if "resolution" in args:
-                resolution = args["resolution"]
-                self.bugs.resolutions.set_for_bug(
-                    cursor, self.bug_id, resolution)
-            if "category" in args:
-                category = args["category"]
-                self.bugs.categories.set_for_bug(
-                    cursor, self.bug_id, category)
-            if "keyword" in args:
-                keyword = args["keyword"]
-                self.bugs.keywords.set_for_bug(
-                    cursor, self.bug_id, keyword)
-            if "reported_in" in args:
-                reported_in = args["reported_in"]
-                self.bugs.reported_ins.set_for_bug(
-                    cursor, self.bug_id, reported_in)
-            if "fixed_in" in args:
-                fixed_in = args["fixed_in"]
-                self.bugs.fixed_ins.set_for_bug(
-                    cursor, self.bug_id, fixed_in)
-            if "tested_ok_in" in args:
-                tested_ok_in = args["tested_ok_in"]
-                self.bugs.tested_ok_ins.set_for_bug(
-                    cursor, self.bug_id, tested_ok_in)
-            if "comment" in args:
-                comment = args["comment"]
-                if "timestamp" in args:
-                    timestamp = args["timestamp"]
-                    self.comments.add(cursor, user, comment, timestamp)
-                else:
-                    self.comments.add(cursor, user, comment)
-            self.bugs.connection.commit()
-            if log_changes:
-                for variable, value in args.iteritems():
-                    if variable == "comment":
-                        self.bugs.changes.add_change(
-                            self.bug_id, user, "Added comment")
+            try:
+                if "status" in args:
+                    self.bugs.statuses.set_for_bug(
+                        cursor, self.bug_id, args["status"])
+                for variable, table_name in self._state_tables:
+                    if variable in args:
+                        state_table = getattr(self.bugs, table_name)
+                        if state_table.set_for_bug(cursor, self.bug_id,
+                                                   args[variable]):
+                            new_values.append(state_table)
+                if "comment" in args:
+                    comment = args["comment"]
+                    if "timestamp" in args:
+                        timestamp = args["timestamp"]
+                        self.comments.add(cursor, user, comment, timestamp)
                     else:
-                        pretty_variable = variable.replace("_", " ").capitalize()
-                        self.bugs.changes.add_change(
-                            self.bug_id, user, "%s -> %s" % (pretty_variable,
-                                                             value))
-        except:
-            self.bugs.connection.rollback()
-            raise
+                        self.comments.add(cursor, user, comment)
+                if log_changes:
+                    descriptions = []
+                    for variable, value in args.iteritems():
+                        if variable == "comment":
+                            descriptions.append("Added comment")
+                        else:
+                            pretty_variable = variable.replace("_", " ").capitalize()
+                            descriptions.append("%s -> %s" % (pretty_variable,
+                                                              value))
+                    self.bugs.changes.add_changes(
+                        cursor, self.bug_id, user, descriptions)
+                self.bugs.connection.commit()
+            except:
+                self.bugs.connection.rollback()
+                raise
+            self.bugs.results.bump()
+        finally:
+            for state_table in new_values:
+                state_table.cache.invalidate(state_table.value_table)
+
+
+# Words (or phrases in quotes) of a text search, each perhaps excluded
+# by a leading "-".
+_text_search_term = re.compile(r'(-?)(?:"([^"]*)"?|(\S+))')
+
+# Characters with a special meaning to to_tsquery(), which separate words.
+_text_search_separators = re.compile(r"[\s\"&|!():*<>'\\-]+")
+
+
+def make_text_query(text):
+    """Convert the text of a search into the text of a postgres tsquery.
+
+    All the words must match. Words in "quotes" must match as a phrase,
+    a word ending in * matches any word with that prefix, and a word
+    (or phrase) with a leading - must not match.
+
+    """
+    operands = []
+    for exclude, phrase, word in _text_search_term.findall(text):
+        prefix = False
+        if word:
+            prefix = word.endswith("*")
+            phrase = word
+        words = filter(None, _text_search_separators.split(phrase))
+        if not words:
+            continue
+        lexemes = ["'%s'" % w for w in words]
+        if prefix:
+            lexemes[-1] += ":*"
+        operand = " <-> ".join(lexemes)
+        if len(lexemes) > 1:
+            operand = "(%s)" % operand
+        if exclude:
+            operand = "!" + operand
+        operands.append(operand)
+    if not operands:
+        raise InvalidSearchException
+    return " & ".join(operands)
 
 
 class Search:
@@ -914,66 +1198,56 @@ class Search:
 
     _from_map = dict(
         priority = """
-               ) LEFT OUTER JOIN priorities ON
-                (priorities.bug_id = bugs.bug_id)
                ) LEFT OUTER JOIN priority_values ON
-                (priority_values.id = priorities.id)""",
+                (priority_values.id = bugs.priority_id)""",
         resolution = """
-               ) LEFT OUTER JOIN resolutions ON
-                (resolutions.bug_id = bugs.bug_id)
                ) LEFT OUTER JOIN resolution_values ON
-                (resolution_values.id = resolutions.id)""",
+                (resolution_values.id = bugs.resolution_id)""",
         category = """
-               ) LEFT OUTER JOIN categories ON
-                (categories.bug_id = bugs.bug_id)
                ) LEFT OUTER JOIN category_values ON
-                (category_values.id = categories.id)""",
+                (category_values.id = bugs.category_id)""",
         keyword = """
-               ) LEFT OUTER JOIN keywords ON
-                (keywords.bug_id = bugs.bug_id)
                ) LEFT OUTER JOIN keyword_values ON
-                (keyword_values.id = keywords.id)""",
+                (keyword_values.id = bugs.keyword_id)""",
         reported_in = """
-               ) LEFT OUTER JOIN reported_ins ON
-                (reported_ins.bug_id = bugs.bug_id)
                ) LEFT OUTER JOIN versions AS reported_versions ON
-                (reported_versions.id = reported_ins.id)""",
+                (reported_versions.id = bugs.reported_in_id)""",
         fixed_in = """
-               ) LEFT OUTER JOIN fixed_ins ON
-                (fixed_ins.bug_id = bugs.bug_id)
                ) LEFT OUTER JOIN versions AS fixed_versions ON
-                (fixed_versions.id = fixed_ins.id)""",
+                (fixed_versions.id = bugs.fixed_in_id)""",
         tested_ok_in = """
-               ) LEFT OUTER JOIN tested_ok_ins ON
-                (tested_ok_ins.bug_id = bugs.bug_id)
                ) LEFT OUTER JOIN versions AS tested_ok_versions ON
-                (tested_ok_versions.id = tested_ok_ins.id)""",
-        comments = """
-               ) LEFT OUTER JOIN comments ON
-                (comments.bug_id = bugs.bug_id)
-               )""")
+                (tested_ok_versions.id = bugs.tested_ok_in_id)""",
+        text = """
+               ) CROSS JOIN to_tsquery('english', %s) AS text_query""")
 
     _where_map = {
-        "status": "statuses.name = '%s'",
-        "status_regex": "statuses.name ~* '%s'",
-        "priority": "priority_values.name = '%s'",
-        "priority_regex": "priority_values.name ~* '%s'",
-        "resolution": "resolution_values.name = '%s'",
-        "resolution_regex": "resolution_values.name ~* '%s'",
-        "category": "category_values.name = '%s'",
-        "category_regex": "category_values.name ~* '%s'",
-        "keyword": "keyword_values.name = '%s'",
-        "keyword_regex": "keyword_values.name ~* '%s'",
-        "reported_in": "reported_versions.name = '%s'",
-        "reported_in_regex": "reported_versions.name ~* '%s'",
-        "fixed_in": "fixed_versions.name = '%s'",
-        "fixed_in_regex": "fixed_versions.name ~* '%s'",
-        "tested_ok_in": "tested_ok_versions.name = '%s'",
-        "tested_ok_in_regex": "tested_ok_versions.name ~* '%s'",
-        "title": "title ~* '%s'",
-        "comments": "comments.comment ~* '%s'"
+        "status": "statuses.name = %s",
+        "status_regex": "statuses.name ~* %s",
+        "priority": "priority_values.name = %s",
+        "priority_regex": "priority_values.name ~* %s",
+        "resolution": "resolution_values.name = %s",
+        "resolution_regex": "resolution_values.name ~* %s",
+        "category": "category_values.name = %s",
+        "category_regex": "category_values.name ~* %s",
+        "keyword": "keyword_values.name = %s",
+        "keyword_regex": "keyword_values.name ~* %s",
+        "reported_in": "reported_versions.name = %s",
+        "reported_in_regex": "reported_versions.name ~* %s",
+        "fixed_in": "fixed_versions.name = %s",
+        "fixed_in_regex": "fixed_versions.name ~* %s",
+        "tested_ok_in": "tested_ok_versions.name = %s",
+        "tested_ok_in_regex": "tested_ok_versions.name ~* %s",
+        "title": "title ~* %s",
+        "comments": """EXISTS (SELECT 1 FROM comments
+                               WHERE comments.bug_id = bugs.bug_id
+                                 AND comments.comment ~* %s)""",
+        "text": "bugs.search_vector @@ text_query"
         }
 
+    # Number of rows fetched at a time when streaming.
+    stream_batch_size = 500
+
     def __init__(self, variables, sort_by, order, **criteria):
         """Construct an object defining a search.
 
@@ -981,12 +1255,14 @@ class Search:
         included is provided by the variables parameter.
 
         sort_by and order determine by which column the results are
-        sorted and in which order.
+        sorted and in which order. A search including the text
+        criterion may instead be sorted by "relevance".
 
         The subset of the data is provided by the **criteria
         argument. E.g.
            status="new"
            keyword_regex="comms|replication"
+           text='"broken pipe" socket*'
 
         For example, a search used to list all the new bugs could be
         defined:
@@ -994,14 +1270,29 @@ class Search:
            Search(("bug_id", "category", "reported_in", "title"),
                   "category", "ascending", status="new")
 
+        By default all the results are fetched. Use paginate() to
+        fetch just one page of them.
+
+        Unless sorted by relevance, all the results are fetched and
+        cached (see Bugs.search) whatever the page, as long as they fit
+        in the cache, and then sorted and paginated in memory. Thus
+        another page, or another sort of the same results, is found
+        without a query.
+
         """
         self.variables, self.titles = self._make_variables_and_titles(variables)
         self.sort_by = sort_by
         self.order = order
         self.criteria = criteria
         self.rows = []
-
-        assert self.sort_by in self.variables
+        self.total = 0
+        self.page = 1
+        self.page_size = None
+        # The bytes taken by the values of all the results, as counted.
+        self._size = 0
+
+        assert self.sort_by in self.variables or \
+               (self.sort_by == "relevance" and "text" in self.criteria)
         assert self.order in ("ascending", "descending")
         assert type(self.criteria) == type({})
 
@@ -1018,7 +1309,7 @@ class Search:
         return tuple(variables), tuple(titles)
 
     def _make_select_clause(self, variables):
-        return "SELECT DISTINCT " + \
+        return "SELECT " + \
                ", ".join([self._select_map[v] for v in variables])
 
     def _make_from_clause(self, variables, criteria):
@@ -1031,13 +1322,20 @@ class Search:
         return """FROM %(from_brackets)s
                   statuses INNER JOIN bugs ON
                   (bugs.status_id = statuses.status_id)
-                  %(from)s""" % {"from_brackets": len(clauses) * "((",
+                  %(from)s""" % {"from_brackets": len(clauses) * "(",
                                  "from": " ".join(clauses)}
 
     def _make_where_clause(self, criteria):
+        """Return the where clause and the list of its parameters."""
         clauses = []
+        parameters = []
         # TODO fix this hack to detect malformed regex expressions
         for c,v in criteria.iteritems():
+            if c == "text":
+                # The query is used by the from clause, so comes first.
+                parameters.insert(0, make_text_query(v))
+                clauses.append(self._where_map[c])
+                continue
             if "~" in self._where_map[c]:
                 if "{" in v or "}" in v:
                     # Unfortunately "asdf{1,2,3}" does not raise
@@ -1048,31 +1346,192 @@ class Search:
                     re.compile(v)
                 except re.error, e:
                     raise InvalidSearchException
-            clauses.append(self._where_map[c] % quote(v))
+            clauses.append(self._where_map[c])
+            parameters.append(v)
         if clauses:
-            return "WHERE " + " AND ".join(clauses)
+            return "WHERE " + " AND ".join(clauses), parameters
         else:
-            return ""
+            return "", parameters
 
     def _make_sort_clause(self, sort_by, order):
-        return "ORDER BY %s %s" % (self._select_map[sort_by],
-                                  self._order_map[order])
-    
-    def run(self, cursor):
-        search_sql = """
+        if sort_by == "relevance":
+            column = "ts_rank_cd(bugs.search_vector, text_query)"
+        else:
+            column = self._select_map[sort_by]
+        sort = "ORDER BY %s %s" % (column, self._order_map[order])
+        if sort_by != "bug_id" and "bug_id" in self.variables:
+            # Break ties, so that pages split the results consistently.
+            sort += ", %s" % self._select_map["bug_id"]
+        return sort
+
+    def _make_limit_clause(self):
+        if self.page_size:
+            return "LIMIT %d OFFSET %d" % (self.page_size,
+                                           (self.page - 1) * self.page_size)
+        else:
+            return ""
+
+    def _make_search_sql(self, where, paginated=True):
+        if paginated:
+            limit = self._make_limit_clause()
+        else:
+            limit = ""
+        return """
         %(select)s
         %(from)s
         %(where)s
-        %(sort)s;""" % {
+        %(sort)s
+        %(limit)s;""" % {
+            "select": self._make_select_clause(self.variables),
+            "from": self._make_from_clause(self.variables, self.criteria),
+            "where": where,
+            "sort": self._make_sort_clause(self.sort_by, self.order),
+            "limit": limit}
+
+    def _count(self, cursor, where, parameters):
+        """Set the total number of results, and keep page in range.
+
+        The size of the results is found along with their number, for
+        estimate_size().
+
+        """
+        cursor.execute("""
+        SELECT count(*), coalesce(sum(pg_column_size(matches.*)), 0) FROM (
+          %(select)s
+          %(from)s
+          %(where)s
+        ) AS matches;""" % {
             "select": self._make_select_clause(self.variables),
             "from": self._make_from_clause(self.variables, self.criteria),
-            "where": self._make_where_clause(self.criteria),
-            "sort": self._make_sort_clause(self.sort_by, self.order)}
-        cursor.execute(search_sql)
+            "where": where}, parameters)
+        self.total, self._size = cursor.fetchone()
+        self.page = max(1, min(self.page, self.get_n_pages()))
+
+    def count(self, cursor):
+        """Count the results, without fetching any."""
+        where, parameters = self._make_where_clause(self.criteria)
+        self._count(cursor, where, parameters)
+
+    def paginate(self, page, page_size):
+        """Restrict the rows fetched by run() to the given page (from 1)."""
+        assert page_size > 0
+        self.page = max(1, page)
+        self.page_size = page_size
+
+    def get_n_pages(self):
+        if self.page_size and self.total:
+            return (self.total + self.page_size - 1) // self.page_size
+        else:
+            return 1
+
+    n_pages = property(get_n_pages)
+
+    def get_cache_key(self):
+        """Return a key identifying the results, however sorted or paged."""
+        criteria = self.criteria.items()
+        criteria.sort()
+        return ("search", self.variables, tuple(criteria))
+
+    def estimate_size(self):
+        """Return roughly how many bytes fetch_all() would return.
+
+        This is estimated (as by _estimate_size) from the results as
+        counted by count(), each of which has a value and a rank for
+        each variable.
+
+        """
+        return self._size + self.total * (64 + 64 * len(self.variables))
+
+    def _make_rank_clause(self, variables):
+        return "".join([", rank() OVER (ORDER BY %s)" % self._select_map[v]
+                        for v in variables])
+
+    def fetch_all(self, cursor):
+        """Return all the results, as a list of tuples of values.
+
+        Each tuple is followed by the rank of the result by each
+        variable, as sorted by the database, for use_results() to sort
+        by.
+
+        """
+        where, parameters = self._make_where_clause(self.criteria)
+        cursor.execute("""
+        %(select)s%(ranks)s
+        %(from)s
+        %(where)s;""" % {
+            "select": self._make_select_clause(self.variables),
+            "ranks": self._make_rank_clause(self.variables),
+            "from": self._make_from_clause(self.variables, self.criteria),
+            "where": where}, parameters)
+        return cursor.fetchall()
+
+    def use_results(self, results):
+        """Leave rows holding the results sorted, and paged if paginated.
+
+        The results are as returned by fetch_all(), and are not changed.
+
+        """
+        n_variables = len(self.variables)
+        results = list(results)
+        if self.sort_by != "bug_id" and "bug_id" in self.variables:
+            # Break ties, so that pages split the results consistently.
+            _sort_results(results, 0, "ascending")
+        _sort_results(results,
+                      n_variables + list(self.variables).index(self.sort_by),
+                      self.order)
+        self.total = len(results)
+        if self.page_size:
+            self.page = max(1, min(self.page, self.get_n_pages()))
+            start = (self.page - 1) * self.page_size
+            results = results[start:start + self.page_size]
+        self.rows = []
+        for result in results:
+            self.add(*result[:n_variables])
+
+    def run(self, cursor, counted=False):
+        """Run the search, leaving a list of the results in rows.
+
+        If paginated, rows holds just the results of the current page,
+        and total the number of results in all pages (which are
+        counted first, unless already counted by count()).
+
+        """
+        where, parameters = self._make_where_clause(self.criteria)
+        if self.page_size and not counted:
+            self._count(cursor, where, parameters)
+        cursor.execute(self._make_search_sql(where), parameters)
         self.rows = []
         result = cursor.fetchall()
         for row in result:
             self.add(*row)
+        if not self.page_size:
+            self.total = len(self.rows)
+
+    def stream(self, cursor, row_cursor):
+        """Run the search, leaving an iterator over all results in rows.
+
+        The total is counted using cursor, then the results are fetched
+        from row_cursor (which should be a server-side cursor) in
+        batches as rows is iterated over. Thus the results are never all
+        held in memory at once, and may be rendered as they arrive.
+
+        Any pagination is ignored.
+
+        """
+        where, parameters = self._make_where_clause(self.criteria)
+        self.page_size = None
+        self._count(cursor, where, parameters)
+        row_cursor.execute(self._make_search_sql(where, False), parameters)
+        self.rows = self._iterate_rows(row_cursor)
+
+    def _iterate_rows(self, cursor):
+        while True:
+            result = cursor.fetchmany(self.stream_batch_size)
+            if not result:
+                cursor.close()
+                break
+            for row in result:
+                yield Row(self.variables, *row)
 
     def add(self, *args):
         assert len(args) == len(self.variables)
@@ -1112,21 +1571,34 @@ class Changes(object):
         ascending = "ASC",
         descending = "DESC")
 
-    def __init__(self, connection):
+    def __init__(self, connection, results=None):
         self.connection = connection
+        if results is None:
+            results = _make_result_cache()
+        self.results = results
         
     def add_change(self, bug_id, user, description):
         cursor = self.connection.cursor()
         try:
-            description = quote(description)
-            timestamp = time.ctime()
-            cursor.execute("""
-            INSERT INTO changes (bug_id, user_id, date, description)
-            VALUES ('%s', '%s', '%s', '%s');
-            """ % (bug_id, user.user_id, timestamp, description))
+            self.add_changes(cursor, bug_id, user, [description])
             self.connection.commit()
         finally:
             cursor.close()
+        self.results.bump()
+
+    def add_changes(self, cursor, bug_id, user, descriptions):
+        """Record several changes to a bug, without committing them."""
+        if not descriptions:
+            return
+        timestamp = time.ctime()
+        parameters = []
+        for description in descriptions:
+            parameters.extend((bug_id, user.user_id, timestamp, description))
+        cursor.execute("""
+            INSERT INTO changes (bug_id, user_id, date, description)
+            VALUES %s;
+            """ % ", ".join(["(%s, %s, %s, %s)"] * len(descriptions)),
+            parameters)
         
     def do_maintenance(self):
         cursor = self.connection.cursor()
@@ -1134,10 +1606,11 @@ class Changes(object):
             now = time.ctime(time.time() -
                              config.History.changes_max_age * 60*60*24)
             cursor.execute("""
-              DELETE FROM changes WHERE date<'%s'""" % now)
+              DELETE FROM changes WHERE date<%s""", (now,))
             self.connection.commit()
         finally:
             cursor.close()
+        self.results.bump()
 
     def get_recent_changes(self, sort_by, order):
         
@@ -1154,6 +1627,24 @@ class Changes(object):
         assert sort_by in RecentChanges.variables
         assert order in self._order_map
 
+        # All the changes are cached, and sorted in memory as requested.
+        changes = self.results.get(("changes",))
+        if changes is None:
+            generation = self.results.generation
+            changes = self._read_changes()
+            self.results.set(("changes",), changes, _estimate_size(changes),
+                             generation)
+        n_variables = len(RecentChanges.variables)
+        changes = list(changes)
+        _sort_results(changes,
+                      n_variables + list(RecentChanges.variables).index(sort_by),
+                      order)
+        return RecentChanges(sort_by, order,
+                             [Row(RecentChanges.variables,
+                                  *change[:n_variables])
+                              for change in changes])
+
+    def _read_changes(self):
         cursor = self.connection.cursor()
         try:
             cursor.execute("""
@@ -1161,14 +1652,17 @@ class Changes(object):
                    users.username,
                    changes.date,
                    changes.description,
-                   bugs.title
+                   bugs.title,
+                   rank() OVER (ORDER BY changes.bug_id),
+                   rank() OVER (ORDER BY users.username),
+                   rank() OVER (ORDER BY changes.date),
+                   rank() OVER (ORDER BY changes.description),
+                   rank() OVER (ORDER BY bugs.title)
             FROM changes, users, bugs
             WHERE changes.user_id=users.user_id
               AND changes.bug_id=bugs.bug_id
-            ORDER BY %s %s;""" % (sort_by, self._order_map[order]))
-            return RecentChanges(sort_by, order,
-                                 [Row(RecentChanges.variables, *change)
-                                  for change in cursor.fetchall()])
+            ORDER BY changes.date ASC;""")
+            return cursor.fetchall()
         finally:
             cursor.close()
     
@@ -1178,15 +1672,23 @@ class Bugs(object):
     def __init__(self, connection):
         self.connection = connection
         self.statuses = Statuses(connection)
-        self.priorities = Priorities(connection)
-        self.resolutions = Resolutions(connection)
-        self.categories = Categories(connection)
-        self.keywords = Keywords(connection)
-        self.reported_ins = ReportedIns(connection)
-        self.fixed_ins = FixedIns(connection)
-        self.tested_ok_ins = TestedOkIns(connection)
-        self.summary = Summary(connection)
-        self.changes = Changes(connection)
+        values_cache = lib.ExpiringCache(config.Cache.timeout)
+        self.priorities = Priorities(connection, values_cache)
+        self.resolutions = Resolutions(connection, values_cache)
+        self.categories = Categories(connection, values_cache)
+        self.keywords = Keywords(connection, values_cache)
+        self.reported_ins = ReportedIns(connection, values_cache)
+        self.fixed_ins = FixedIns(connection, values_cache)
+        self.tested_ok_ins = TestedOkIns(connection, values_cache)
+        # The results of searches, changes and progress, forgotten on
+        # every change.
+        self.results = _make_result_cache()
+        self.summary = Summary(connection, self.results)
+        self.changes = Changes(connection, self.results)
+        # The digest of the comment formatting (see
+        # templates.get_comment_digest) by which every comment is known
+        # to have been rendered.
+        self._rendered_digest = None
 
     def do_maintenance(self):
         """Remove unused keywords, versions, etc"""
@@ -1195,22 +1697,20 @@ class Bugs(object):
         # TODO implement purge
         
     def _add_to_bugs_table(self, cursor, user, title):
-        title = quote(title)
         cursor.execute("""
                 INSERT INTO bugs (user_id, date, title, status_id)
-                       VALUES (%d, 'now', '%s', %d);
-                """ % (user.user_id, title, self.statuses.initial_id))
-        cursor.execute("SELECT currval('bug_ids_seq')")
+                       VALUES (%s, 'now', %s, %s)
+                RETURNING bug_id;
+                """, (user.user_id, title, self.statuses.initial_id))
         bug_id = cursor.fetchone()[0]
         return bug_id
 
     def _import_into_bugs_table(self, cursor, user, timestamp, bug_id, title):
-        title = quote(title)
         cursor.execute("""
                 INSERT INTO bugs (bug_id, user_id, date, title, status_id)
-                       VALUES (%d, %d, '%s', '%s', %d);
-                """ % (int(bug_id), user.user_id, timestamp, title,
-                       self.statuses.initial_id))
+                       VALUES (%s, %s, %s, %s, %s);
+                """, (int(bug_id), user.user_id, timestamp, title,
+                      self.statuses.initial_id))
         cursor.execute("""
                 SELECT setval('bug_ids_seq', (SELECT MAX(bug_id) FROM bugs));
         """)
@@ -1230,10 +1730,11 @@ class Bugs(object):
             changes["comment"] = description
         if changes:
             bug = self.get(bug_id)
-            self.changes.add_change(bug_id, user, "New bug")
+            self.changes.add_changes(cursor, bug_id, user, ["New bug"])
             bug._change(user, cursor, False, **changes)
         self.connection.commit()
         cursor.close()
+        self.results.bump()
         return bug_id
 
     def import_bug(self, bug_id, user, timestamp, title,
@@ -1254,6 +1755,7 @@ class Bugs(object):
         bug._change(user, cursor, False, **changes)
         self.connection.commit()
         cursor.close()
+        self.results.bump()
 
     def export_bugs(self):
         cursor = self.connection.cursor()
@@ -1271,39 +1773,25 @@ class Bugs(object):
                         reported_versions.name,
                         fixed_versions.name,
                         tested_ok_versions.name
-        FROM (((((((((((((((
+        FROM ((((((((
                statuses INNER JOIN bugs ON
                 (bugs.status_id = statuses.status_id)
                ) LEFT OUTER JOIN users ON
                 (users.user_id = bugs.user_id)
-               ) LEFT OUTER JOIN categories ON
-                (categories.bug_id = bugs.bug_id)
                ) LEFT OUTER JOIN category_values ON
-                (category_values.id = categories.id) 
-               ) LEFT OUTER JOIN keywords ON
-                (keywords.bug_id = bugs.bug_id)
+                (category_values.id = bugs.category_id)
                ) LEFT OUTER JOIN keyword_values ON
-                (keyword_values.id = keywords.id) 
-               ) LEFT OUTER JOIN fixed_ins ON
-                (fixed_ins.bug_id = bugs.bug_id)
+                (keyword_values.id = bugs.keyword_id)
                ) LEFT OUTER JOIN versions AS fixed_versions ON
-                (fixed_versions.id = fixed_ins.id) 
-               ) LEFT OUTER JOIN tested_ok_ins ON
-                (tested_ok_ins.bug_id = bugs.bug_id)
+                (fixed_versions.id = bugs.fixed_in_id)
                ) LEFT OUTER JOIN versions AS tested_ok_versions ON
-                (tested_ok_versions.id = tested_ok_ins.id) 
-               ) LEFT OUTER JOIN reported_ins ON
-                (reported_ins.bug_id = bugs.bug_id)
+                (tested_ok_versions.id = bugs.tested_ok_in_id)
                ) LEFT OUTER JOIN versions AS reported_versions ON
-                (reported_versions.id = reported_ins.id) 
-               ) LEFT OUTER JOIN priorities ON
-                (priorities.bug_id = bugs.bug_id)
+                (reported_versions.id = bugs.reported_in_id)
                ) LEFT OUTER JOIN priority_values ON
-                (priority_values.id = priorities.id)
-               ) LEFT OUTER JOIN resolutions ON
-                (resolutions.bug_id = bugs.bug_id)
+                (priority_values.id = bugs.priority_id)
                ) LEFT OUTER JOIN resolution_values ON
-                (resolution_values.id = resolutions.id)
+                (resolution_values.id = bugs.resolution_id)
         ORDER BY bugs.bug_id ASC;
                 """)
             rows = cursor.fetchall()
@@ -1327,7 +1815,124 @@ class Bugs(object):
             return rows
         finally:
             cursor.close()
+
+    def write_bugs(self, cursor, wfile):
+        """Write the same as export_bugs() to wfile, as csv.
+
+        As each bug has at most one of each state, and one user, the
+        joins give one row per bug without needing DISTINCT. The rows
+        are streamed by postgres straight to wfile, in the order of
+        the index of bug ids.
+
+        """
+        cursor.copy_expert("""
+            COPY (SELECT bugs.bug_id AS "Bug",
+                         users.username AS "Username",
+                         bugs.date AS "Date",
+                         bugs.title AS "Title",
+                         statuses.name AS "Status",
+                         priority_values.name AS "Priority",
+                         resolution_values.name AS "Resolution",
+                         category_values.name AS "Category",
+                         keyword_values.name AS "Keyword",
+                         reported_versions.name AS "Reported in",
+                         fixed_versions.name AS "Fixed in",
+                         tested_ok_versions.name AS "Tested ok in"
+                  FROM bugs
+                  INNER JOIN statuses ON
+                      (statuses.status_id = bugs.status_id)
+                  LEFT OUTER JOIN users ON
+                      (users.user_id = bugs.user_id)
+                  LEFT OUTER JOIN priority_values ON
+                      (priority_values.id = bugs.priority_id)
+                  LEFT OUTER JOIN resolution_values ON
+                      (resolution_values.id = bugs.resolution_id)
+                  LEFT OUTER JOIN category_values ON
+                      (category_values.id = bugs.category_id)
+                  LEFT OUTER JOIN keyword_values ON
+                      (keyword_values.id = bugs.keyword_id)
+                  LEFT OUTER JOIN versions AS reported_versions ON
+                      (reported_versions.id = bugs.reported_in_id)
+                  LEFT OUTER JOIN versions AS fixed_versions ON
+                      (fixed_versions.id = bugs.fixed_in_id)
+                  LEFT OUTER JOIN versions AS tested_ok_versions ON
+                      (tested_ok_versions.id = bugs.tested_ok_in_id)
+                  ORDER BY bugs.bug_id)
+            TO STDOUT WITH (FORMAT csv, HEADER);
+            """, wfile)
+
+    def write_comments(self, cursor, wfile):
+        """Write the same as export_comments() to wfile, as csv.
+
+        The rows are streamed by postgres straight to wfile, so are
+        never held in memory.
+
+        """
+        cursor.copy_expert("""
+            COPY (SELECT comments.bug_id AS "Bug",
+                         users.username AS "Username",
+                         comments.date AS "Date",
+                         comments.comment AS "Comment"
+                  FROM comments
+                  INNER JOIN users ON (users.user_id = comments.user_id)
+                  ORDER BY comments.bug_id, comments.date)
+            TO STDOUT WITH (FORMAT csv, HEADER);
+            """, wfile)
     
+    # The number of comments rendered in each transaction by
+    # render_comments().
+    render_batch_size = 500
+
+    def render_comments(self):
+        """Render the html of the comments, if the mappings have changed.
+
+        Comments are rendered when added, so this only renders those
+        rendered by different comment mappings or an earlier version of
+        templates.format_comment (or added before their html was kept),
+        a batch at a time. Returns how many were rendered. Once all are
+        rendered by the current mappings, there is nothing to do (not
+        even a query) until they change.
+
+        """
+        digest = templates.get_comment_digest()
+        if digest == self._rendered_digest:
+            return 0
+        n_rendered = 0
+        last_comment_id = 0
+        cursor = self.connection.cursor()
+        try:
+            while True:
+                connection.execute_prepared(cursor, """
+                    SELECT comment_id, comment FROM comments
+                    WHERE comment_id > $1
+                      AND html_mappings IS DISTINCT FROM $2
+                    ORDER BY comment_id ASC
+                    LIMIT $3
+                    """, (last_comment_id, digest, self.render_batch_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                parameters = [digest]
+                for comment_id, text in rows:
+                    parameters.extend(
+                        (comment_id, templates.format_comment(text or "",
+                                                              False)))
+                cursor.execute("""
+                    UPDATE comments
+                    SET html = rendered.html, html_mappings = %%s
+                    FROM (VALUES %s) AS rendered (comment_id, html)
+                    WHERE comments.comment_id = rendered.comment_id;
+                    """ % ", ".join(["(%s, %s)"] * len(rows)), parameters)
+                self.connection.commit()
+                n_rendered += len(rows)
+                last_comment_id = rows[-1][0]
+        finally:
+            cursor.close()
+        self._rendered_digest = digest
+        if n_rendered:
+            logger.info("Rendered the html of %d comments" % n_rendered)
+        return n_rendered
+
     def get(self, bug_id):
         try:
             bug_id = int(bug_id)
@@ -1335,20 +1940,85 @@ class Bugs(object):
             raise NoSuchBugException, bug_id
         return Bug(self, bug_id)
 
-    def search(self, search):
+    def search(self, search, stream=False):
+        """Run the search, reusing its cached results if there are any.
+
+        Streamed searches are never cached, as their results are not to
+        be held in memory, nor are those sorted by relevance, which only
+        the database can sort. Nor are those too big for the cache (as
+        counted first), of which just the page is fetched, by run(),
+        every time.
+
+        """
+        if not stream and search.sort_by != "relevance":
+            key = search.get_cache_key()
+            results = self.results.get(key)
+            if results is None:
+                generation = self.results.generation
+                cursor = self.connection.cursor()
+                try:
+                    search.count(cursor)
+                    if not self.results.can_hold(search.estimate_size()):
+                        search.run(cursor, True)
+                        return
+                    results = search.fetch_all(cursor)
+                finally:
+                    cursor.close()
+                self.results.set(key, results, _estimate_size(results),
+                                 generation)
+            search.use_results(results)
+            return
         cursor = self.connection.cursor()
         try:
-            search.run(cursor)
+            if stream:
+                row_cursor = self.connection.cursor("search_%d" % id(search))
+                search.stream(cursor, row_cursor)
+            else:
+                search.run(cursor)
         finally:
             cursor.close()
 
 
 class Application(object):
 
-    def __init__(self, connection):
-        self.users = Users(connection)
+    def __init__(self, connection, session_store=None):
+        self.connection = connection
+        if session_store is None:
+            session_store = sessions.make_store(connection)
+        self.session_store = session_store
+        self.users = Users(connection, session_store)
         self.bugs = Bugs(connection)
-        
+        self.scheduler = scheduler.Scheduler(self.release)
+        self._add_jobs()
+        self.release()
+
+    def _add_jobs(self):
+        """Add the jobs which maintain the database and caches."""
+        self.scheduler.add("purge-caches", self.users.do_maintenance,
+                           600, jitter=60)
+        self.scheduler.add("prune-changes", self.bugs.changes.do_maintenance,
+                           60*60, aligned=True)
+        self.scheduler.add("snapshot-progress",
+                           self.bugs.summary.do_maintenance,
+                           60*60, aligned=True)
+        self.scheduler.add("reconcile-status-counts",
+                           self.bugs.summary.reconcile_status_counts,
+                           24*60*60, jitter=60*60)
+        # Does nothing once the comments are rendered by the current
+        # comment mappings, so checks often.
+        self.scheduler.add("render-comments", self.bugs.render_comments,
+                           60, jitter=10)
+
+    def release(self):
+        """Release the database connection used by the current thread.
+
+        Must be called once the current thread has finished with the
+        application (e.g. at the end of every request) so that the
+        connection can be reused.
+
+        """
+        self.connection.release()
+
     def new_session(self, session_id):
         pass
 
@@ -1393,9 +2063,9 @@ class Application(object):
         else:
             return None
 
-    def search(self, session_id, search):
+    def search(self, session_id, search, stream=False):
         if self.users.get_user(session_id):
-            return self.bugs.search(search)
+            return self.bugs.search(search, stream)
         else:
             return None
     
@@ -1435,6 +2105,57 @@ class Application(object):
 
     keywords = property(_get_keywords)
 
+    def get_scheduled_jobs(self, session_id):
+        """Return the status of each of the scheduler's jobs."""
+
+        class ScheduledJobs:
+
+            variables = ("name", "interval", "last_run", "last_duration",
+                         "mean_duration", "max_duration", "n_runs",
+                         "n_failures", "last_error", "next_run")
+            titles = ("Job", "Interval", "Last run", "Duration",
+                      "Mean duration", "Max duration", "Runs",
+                      "Failures", "Last error", "Next run")
+
+            def __init__(self, rows):
+                self.rows = rows
+
+        def format_time(t):
+            if t is None:
+                return "-"
+            return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+
+        def format_duration(duration):
+            if duration is None:
+                return "-"
+            return "%.3fs" % duration
+
+        if not self.users.get_user(session_id):
+            return None
+        rows = []
+        for job in self.scheduler.get_jobs():
+            if job.running:
+                next_run = "running"
+            else:
+                next_run = format_time(job.next_run)
+            rows.append(Row(ScheduledJobs.variables,
+                            job.name,
+                            "%ds" % job.interval,
+                            format_time(job.last_run),
+                            format_duration(job.last_duration),
+                            format_duration(job.mean_duration),
+                            format_duration(job.max_duration),
+                            str(job.n_runs),
+                            str(job.n_failures),
+                            lib.html_entity_escape(job.last_error or "-"),
+                            next_run))
+        return ScheduledJobs(rows)
+
+    def get_result_cache_stats(self, session_id):
+        """Return a dictionary of the use of the cache of results."""
+        return self._if_have_user(session_id, self.bugs.results.get_stats)
+
     def do_maintenance(self):
+        self.users.do_maintenance()
         self.bugs.do_maintenance()
 
@@ -9,11 +9,15 @@ not as fast as one might hope.
 
 """
 import mx.DateTime
+import threading
+import time
 import unittest
 
 import midge.application as application
+import midge.config as config
 import midge.connection as connection
 import midge.lib as lib
+import midge.templates as templates
 
 
 class BaseTest(unittest.TestCase):
@@ -85,6 +89,20 @@ class UserTests(BaseTest):
         user = self.app.get_user(self.session_id)
         self.assertEqual(user, None)
 
+    def test_user_changes_seen_by_all_sessions(self):
+        """Check a change to a user is seen by all its sessions"""
+        other_session_id = "another-session-id"
+        for session_id in (self.session_id, other_session_id):
+            self.assertEqual(self.app.login(session_id,
+                                            "test-username",
+                                            "test-password"), True)
+        user = self.app.get_user(self.session_id)
+        other_user = self.app.get_user(other_session_id)
+        self.assertEqual(other_user.name, "test-name")
+        user.name = "new name"
+        self.assertEqual(other_user.name, "new name")
+        self.assertEqual(other_user.email, "test-email")
+
     def test_get_usernames(self):
         """Check get all usernames"""
         self.assertEqual(self.app.usernames, ["test-username"])
@@ -142,6 +160,51 @@ class CategoryTests(BaseTest):
                 application.InvalidValueException,
                 self._add_category, invalid_value)
 
+    def _add_bug(self):
+        self.app.login(self.session_id, "test-username", "test-password")
+        bug_id = self.app.add_bug(self.session_id, title="a title")
+        return self.app.get_bug(self.session_id, bug_id)
+
+    def test_set_existing_category(self):
+        """Check bugs may be given an existing category"""
+        self._add_category("foobar")
+        bug = self._add_bug()
+        user = self.app.get_user(self.session_id)
+        bug.change(user, category="foobar")
+        self.assertEqual(self.app.get_bug(self.session_id,
+                                          bug.bug_id).category, "foobar")
+        self.assertEqual(list(self.app.categories), ["", "foobar"])
+
+    def test_set_category_added_meanwhile(self):
+        """Check bugs may be given a category added by another transaction"""
+        bug = self._add_bug()
+        user = self.app.get_user(self.session_id)
+        other = connection.connect(config.Database.test_name)
+        errors = []
+
+        def change():
+            try:
+                bug.change(user, category="foobar")
+            except:
+                errors.append(True)
+
+        try:
+            cursor = other.cursor()
+            cursor.execute("""
+                INSERT INTO category_values (name) VALUES ('foobar');
+                """)
+            cursor.close()
+            thread = threading.Thread(target=change)
+            thread.start()
+            time.sleep(0.5)
+            other.commit()
+            thread.join()
+        finally:
+            other.close()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.app.get_bug(self.session_id,
+                                          bug.bug_id).category, "foobar")
+
 
 class VersionTests(BaseTest):
 
@@ -150,6 +213,15 @@ class VersionTests(BaseTest):
         self.assertEqual(len(self.app.versions), 1)
         self.assertEqual(self.app.versions[0], "")
 
+    def test_versions_are_cached(self):
+        """Check new versions are seen by all version fields at once"""
+        bugs = self.app.bugs
+        self.assert_(bugs.fixed_ins.values is bugs.fixed_ins.values)
+        self.assertEqual(bugs.fixed_ins.values, ("",))
+        bugs.reported_ins.create_new_value("1.0")
+        self.assertEqual(bugs.fixed_ins.values, ("", "1.0"))
+        self.assertEqual(bugs.tested_ok_ins.values, ("", "1.0"))
+
 
 class KeywordTests(BaseTest):
 
@@ -270,6 +342,76 @@ class BugTests(BaseTest):
                                     type(mx.DateTime.DateTime(0))),
                          True)
 
+    def test_lookups_are_prepared_once(self):
+        """Check repeated bug lookups reuse their prepared statements"""
+        self._login()
+        bug = self._add_bug()
+        self.assertEqual(len(bug.comments), 1)
+        prepared = self.connection._connection.prepared.copy()
+        self.assertNotEqual(len(prepared), 0)
+        bug = self.app.get_bug(self.session_id, bug.bug_id)
+        self.assertEqual(len(bug.comments), 1)
+        self.assertEqual(self.connection._connection.prepared, prepared)
+
+    def test_comments_are_read_with_bug(self):
+        """Check a bug's comments are read once, along with the bug"""
+        user = self._login()
+        bug = self._add_bug()
+        comments = bug.comments
+        self.assert_(bug.comments is comments)
+        for i in range(3):
+            bug.change(user, comment="comment %d" % i)
+        self.assertEqual(len(bug.comments), 4)
+        bug = self.app.get_bug(self.session_id, bug.bug_id)
+        self.assertEqual(len(bug.comments), 4)
+        self.assert_(self.DESCRIPTION in [c.text for c in bug.comments])
+        self.assertEqual(bug.title, self.TITLE)
+
+    def test_comments_without_date(self):
+        """Check comments without a date are still read with the bug"""
+        self._login()
+        bug = self._add_bug()
+        cursor = self.connection.cursor()
+        cursor.execute("UPDATE comments SET date = NULL;")
+        self.connection.commit()
+        cursor.close()
+        bug = self.app.get_bug(self.session_id, bug.bug_id)
+        self.assertEqual([c.text for c in bug.comments], [self.DESCRIPTION])
+        self.assertEqual(bug.comments[0].date, None)
+
+    def test_comments_are_rendered(self):
+        """Check the html of comments is kept, and rendered afresh"""
+        user = self._login()
+        bug = self._add_bug()
+        bug.change(user, comment="a <b>comment</b>\n  indented")
+        html = templates.format_comment("a <b>comment</b>\n  indented")
+        self.assert_(html in [c.html for c in bug.comments])
+
+        cursor = self.connection.cursor()
+        cursor.execute("UPDATE comments SET html_mappings = NULL;")
+        self.connection.commit()
+        cursor.close()
+        bug = self.app.get_bug(self.session_id, bug.bug_id)
+        self.assertEqual([c.html for c in bug.comments], [None, None])
+        self.assertEqual(self.app.bugs.render_comments(), 2)
+        self.assertEqual(self.app.bugs.render_comments(), 0)
+        bug = self.app.get_bug(self.session_id, bug.bug_id)
+        self.assert_(html in [c.html for c in bug.comments])
+
+    def test_comments_are_rendered_by_new_format(self):
+        """Check comments are rendered afresh by a new comment format"""
+        self._login()
+        bug = self._add_bug()
+        self.assertEqual(self.app.bugs.render_comments(), 0)
+        version = templates.COMMENT_FORMAT_VERSION
+        templates.COMMENT_FORMAT_VERSION += 1
+        try:
+            bug = self.app.get_bug(self.session_id, bug.bug_id)
+            self.assertEqual([c.html for c in bug.comments], [None])
+            self.assertEqual(self.app.bugs.render_comments(), 1)
+        finally:
+            templates.COMMENT_FORMAT_VERSION = version
+
     def test_add_comments(self):
         """Check add comments to a bug"""
         user = self._login()
@@ -310,6 +452,23 @@ class BugTests(BaseTest):
         self.assertEqual(bug.category, "a new category")
         bug.change(user, category="a new category")
         
+    def test_change_is_atomic(self):
+        """Check a failed change leaves the bug and its values unchanged"""
+        user = self._login()
+        bug = self._add_bug()
+        self.failUnlessRaises(
+            application.InvalidValueException,
+            bug.change, user, category="another category",
+            tested_ok_in="not a valid version!", comment="a comment")
+        bug = self.app.get_bug(self.session_id, bug.bug_id)
+        self.assertEqual(bug.category, self.CATEGORY)
+        self.assertEqual(len(bug.comments), 1)
+        self.assert_("another category" not in self.app.categories)
+        bug.change(user, category="another category", comment="a comment")
+        self.assertEqual(bug.category, "another category")
+        self.assertEqual(len(bug.comments), 2)
+        self.assert_("another category" in self.app.categories)
+
     def test_list_new_bugs(self):
         """Check list of new bugs"""
         user = self._login()
@@ -512,6 +671,67 @@ class BugTests(BaseTest):
         for status, count in n_bugs_in_status.iteritems():
             self.assertEqual(getattr(counts, status), count)
         
+    def test_reconcile_status_counts(self):
+        """Check the maintained status counts are corrected if wrong"""
+        user = self._login()
+        bug = self._add_bug()
+        bug.change(user, status="reviewed")
+        self._add_bug()
+        summary = self.app.bugs.summary
+        self.assertEqual(summary.reconcile_status_counts(), 0)
+        cursor = self.connection.cursor()
+        cursor.execute("UPDATE status_counts SET count = 10;")
+        self.connection.commit()
+        cursor.close()
+        self.assertEqual(summary.status_counts.new, 10)
+        self.assertEqual(summary.reconcile_status_counts(), 5)
+        counts = summary.status_counts
+        self.assertEqual((counts.new, counts.reviewed, counts.closed),
+                         (1, 1, 0))
+
+    def test_opposite_status_changes(self):
+        """Check bugs moved between two statuses both ways at once"""
+        user = self._login()
+        bug = self._add_bug()
+        other_bug = self._add_bug()
+        other_bug.change(user, status="reviewed")
+
+        def set_status(database_connection, bug_id, status):
+            cursor = database_connection.cursor()
+            cursor.execute("""
+                UPDATE bugs SET status_id = (
+                    SELECT status_id FROM statuses WHERE name = %s)
+                WHERE bug_id = %s;
+                """, (status, bug_id))
+            cursor.close()
+
+        first = connection.connect(config.Database.test_name)
+        second = connection.connect(config.Database.test_name)
+        errors = []
+
+        def move_other_bug():
+            try:
+                set_status(second, other_bug.bug_id, "new")
+                second.commit()
+            except:
+                errors.append(True)
+
+        try:
+            set_status(first, bug.bug_id, "reviewed")
+            thread = threading.Thread(target=move_other_bug)
+            thread.start()
+            time.sleep(0.5)
+            first.commit()
+            thread.join()
+        finally:
+            first.close()
+            second.close()
+        self.assertEqual(errors, [])
+        summary = self.app.bugs.summary
+        self.assertEqual(summary.reconcile_status_counts(), 0)
+        counts = summary.status_counts
+        self.assertEqual((counts.new, counts.reviewed), (1, 1))
+
     def test_search(self):
         """Check search for bugs"""
         user = self._login()
@@ -620,3 +840,191 @@ class BugTests(BaseTest):
             application.InvalidSearchException,
             self.app.search,
             self.session_id, search)
+
+    def test_text_search(self):
+        """Check search for words in the titles and comments of bugs"""
+        user = self._login()
+
+        bug_ids = []
+        for title, description in (
+            ("Server crashes on startup", "A broken pipe in the socket"),
+            ("Typo in help page", "The pipe character is broken"),
+            ("Slow searches", "Searching for sockets is slow")):
+            bug_ids.append(self.app.add_bug(self.session_id,
+                                            title=title,
+                                            version="a version",
+                                            description=description))
+        bug = self.app.get_bug(self.session_id, bug_ids[1])
+        bug.change(user, comment="Seen on the server too")
+
+        def search_for(text):
+            search = application.Search(("bug_id",), "relevance",
+                                        "descending", text=text)
+            self.app.search(self.session_id, search)
+            return [row.bug_id for row in search.rows]
+
+        self.assertEqual(search_for("crashes"), [bug_ids[0]])
+        self.assertEqual(search_for("broken pipe"), bug_ids[:2])
+        self.assertEqual(search_for('"broken pipe"'), [bug_ids[0]])
+        self.assertEqual(search_for("sock*"), [bug_ids[0], bug_ids[2]])
+        self.assertEqual(search_for("pipe -socket"), [bug_ids[1]])
+        # Words in the title rank above words only in the comments.
+        self.assertEqual(search_for("server"), bug_ids[:2])
+        self.assertEqual(search_for("nothing"), [])
+
+        search = application.Search(("bug_id",), "relevance",
+                                    "descending", text='""')
+        self.failUnlessRaises(
+            application.InvalidSearchException,
+            self.app.search,
+            self.session_id, search)
+
+    def test_search_pages(self):
+        """Check search for one page of bugs, and for all bugs streamed"""
+        self._login()
+        bug_ids = [self._add_bug().bug_id for i in range(5)]
+
+        search = application.Search(("bug_id", "title"), "bug_id", "ascending")
+        search.paginate(2, 2)
+        self.app.search(self.session_id, search)
+        self.assertEqual(search.total, 5)
+        self.assertEqual(search.n_pages, 3)
+        self.assertEqual([row.bug_id for row in search.rows], bug_ids[2:4])
+
+        search.paginate(10, 2)
+        self.app.search(self.session_id, search)
+        self.assertEqual(search.page, 3)
+        self.assertEqual([row.bug_id for row in search.rows], bug_ids[4:])
+
+        search = application.Search(("bug_id", "title"), "bug_id", "ascending")
+        self.app.search(self.session_id, search, stream=True)
+        self.assertEqual(search.total, 5)
+        self.assertEqual([row.bug_id for row in search.rows], bug_ids)
+
+    def test_search_results_cached(self):
+        """Check searches reuse cached results until a bug changes"""
+        user = self._login()
+        bug_ids = [self._add_bug().bug_id for i in range(3)]
+        results = self.app.bugs.results
+
+        search = application.Search(("bug_id", "title"), "bug_id", "ascending")
+        self.app.search(self.session_id, search)
+        self.assertEqual([row.bug_id for row in search.rows], bug_ids)
+        n_misses = results.n_misses
+
+        search = application.Search(("bug_id", "title"), "bug_id",
+                                    "descending")
+        search.paginate(1, 2)
+        self.app.search(self.session_id, search)
+        self.assertEqual(results.n_misses, n_misses)
+        self.assertEqual(search.total, 3)
+        self.assertEqual([row.bug_id for row in search.rows],
+                         [bug_ids[2], bug_ids[1]])
+
+        bug = self.app.get_bug(self.session_id, bug_ids[0])
+        bug.change(user, status="reviewed")
+        search = application.Search(("bug_id", "title"), "bug_id",
+                                    "ascending", status="new")
+        self.app.search(self.session_id, search)
+        self.assertEqual([row.bug_id for row in search.rows], bug_ids[1:])
+
+    def test_search_sorted_as_database(self):
+        """Check cached results are sorted as the database sorts them"""
+        user = self._login()
+        bug_ids = [self._add_bug().bug_id for i in range(3)]
+        bug = self.app.get_bug(self.session_id, bug_ids[0])
+        bug.change(user, priority="2")
+
+        def search_for(order):
+            search = application.Search(("bug_id", "priority"), "priority",
+                                        order)
+            self.app.search(self.session_id, search)
+            return [row.bug_id for row in search.rows]
+
+        # NULL priorities are last when ascending and first otherwise.
+        self.assertEqual(search_for("ascending"), bug_ids)
+        self.assertEqual(search_for("descending"), bug_ids[1:] + bug_ids[:1])
+        results = self.app.bugs.results
+        self.assertEqual(results.get_stats()["results"], 1)
+
+        # As when the results are too big to cache, and sorted by the
+        # database.
+        self.app.bugs.results = application.ResultCache(1, 60)
+        self.assertEqual(search_for("ascending"), bug_ids)
+        self.assertEqual(search_for("descending"), bug_ids[1:] + bug_ids[:1])
+
+    def test_big_search_results_not_cached(self):
+        """Check results too big to cache are fetched a page at a time"""
+        self._login()
+        bug_ids = [self._add_bug().bug_id for i in range(5)]
+        results = application.ResultCache(1, 60)
+        self.app.bugs.results = results
+
+        for page in (1, 2):
+            search = application.Search(("bug_id", "title"), "bug_id",
+                                        "descending")
+            search.paginate(page, 2)
+            self.app.search(self.session_id, search)
+            self.assertEqual(search.total, 5)
+            self.assertEqual([row.bug_id for row in search.rows],
+                             [bug_ids[4 - 2 * (page - 1)],
+                              bug_ids[3 - 2 * (page - 1)]])
+        stats = results.get_stats()
+        self.assertEqual(stats["results"], 0)
+        self.assertEqual(stats["misses"], 2)
+
+    def test_estimate_size(self):
+        """Check the size of results is estimated before fetching them"""
+        self._login()
+        for i in range(5):
+            self._add_bug()
+        search = application.Search(("bug_id", "title", "status"),
+                                    "bug_id", "ascending")
+        cursor = self.connection.cursor()
+        search.count(cursor)
+        self.assertEqual(search.total, 5)
+        size = application._estimate_size(search.fetch_all(cursor))
+        cursor.close()
+        self.assert_(size / 2 < search.estimate_size() < size * 2)
+
+
+class ResultCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = application.ResultCache(100, 60)
+
+    def test_get_and_set(self):
+        """Check results are cached until the generation is bumped"""
+        self.assertEqual(self.cache.get("a"), None)
+        self.cache.set("a", [(1,)], 10, self.cache.generation)
+        self.assertEqual(self.cache.get("a"), [(1,)])
+        self.cache.bump()
+        self.assertEqual(self.cache.get("a"), None)
+        stats = self.cache.get_stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["size"], 0)
+
+    def test_can_hold(self):
+        """Check only results no bigger than the cache are held"""
+        self.assert_(self.cache.can_hold(100))
+        self.failIf(self.cache.can_hold(101))
+
+    def test_stale_result_not_cached(self):
+        """Check results read before the data changed are not cached"""
+        generation = self.cache.generation
+        self.cache.bump()
+        self.cache.set("a", [(1,)], 10, generation)
+        self.assertEqual(self.cache.get("a"), None)
+
+    def test_results_bounded(self):
+        """Check results are evicted when the cache is full"""
+        generation = self.cache.generation
+        self.cache.set("a", "a", 60, generation)
+        self.cache.set("b", "b", 60, generation)
+        self.assertEqual(self.cache.get("a"), None)
+        self.assertEqual(self.cache.get("b"), "b")
+        stats = self.cache.get_stats()
+        self.assertEqual(stats["results"], 1)
+        self.assertEqual(stats["size"], 60)
+        self.assertEqual(stats["evictions"], 1)
@@ -3,6 +3,7 @@
 
 
 import ConfigParser
+import md5
 import re
 
 import midge.logger as logger
@@ -19,6 +20,7 @@ class Database:
     password = None
     name = None
     test_name = None
+    pool_size = None
 
 
 class Project:
@@ -32,6 +34,14 @@ class Server:
     interface = None
     port = None
     session_timeout = None
+    max_sessions = None
+    session_store = None
+    session_secret = None
+    threads = None
+    keep_alive_timeout = None
+    keep_alive_requests = None
+    compression_level = None
+    compression_threshold = None
    
 
 class Email:
@@ -50,6 +60,7 @@ class Logging:
 class Presentation:
 
     directory = None
+    page_size = None
 
 
 class History:
@@ -58,9 +69,20 @@ class History:
     progress_max_age = None
 
 
+class Cache:
+
+    timeout = None
+    results_size = None
+
+
 class CommentMappings:
 
     mappings = None
+    # Incremented whenever the mappings are read.
+    generation = 0
+    # The md5 digest of the mappings, identifying the html rendered
+    # by them.
+    digest = None
 
     
 def read():
@@ -71,7 +93,9 @@ def read():
     """
     config = ConfigParser.SafeConfigParser()
 
-    def get(section, option):
+    def get(section, option, default=None):
+        if default is not None and not config.has_option(section, option):
+            return default
         try:
             return config.get(section, option)
         except Exception:
@@ -85,7 +109,9 @@ def read():
             logger.exception()
             raise
 
-    def get_int(section, option):
+    def get_int(section, option, default=None):
+        if default is not None and not config.has_option(section, option):
+            return default
         try:
             return config.getint(section, option)
         except Exception:
@@ -105,11 +131,21 @@ def read():
     Database.password = get("Database", "password")
     Database.name = get("Database", "name")
     Database.test_name = get("Database", "test_name")
+    Database.pool_size = get_int("Database", "pool_size", 10)
     Project.name = get("Project", "name")
     Project.help = get("Project", "help")
     Server.interface = get("Server", "interface")
     Server.port = get_int("Server", "port")
     Server.session_timeout = get_int("Server", "session_timeout")
+    Server.max_sessions = get_int("Server", "max_sessions", 10000)
+    Server.session_store = get("Server", "session_store", "memory")
+    Server.session_secret = get("Server", "session_secret", "")
+    Server.threads = get_int("Server", "threads", 0)
+    Server.keep_alive_timeout = get_int("Server", "keep_alive_timeout", 1)
+    Server.keep_alive_requests = get_int("Server", "keep_alive_requests", 100)
+    Server.compression_level = get_int("Server", "compression_level", 6)
+    Server.compression_threshold = get_int("Server", "compression_threshold",
+                                           1024)
     Email.from_address = get("Email", "from_address")
     Email.smtp_host = get("Email", "smtp_host")
     Logging.host = get("Logging", "host")
@@ -118,6 +154,9 @@ def read():
     History.changes_max_age = get_int("History", "changes_max_age")
     History.progress_max_age = get_int("History", "progress_max_age")
     Presentation.directory = get("Presentation", "directory")
+    Presentation.page_size = get_int("Presentation", "page_size", 100)
+    Cache.timeout = get_int("Cache", "timeout", 60)
+    Cache.results_size = get_int("Cache", "results_size", 8192)
 
     def read_comment_mappings():
         SEPARATOR_KEY = "SEPARATOR"
@@ -130,6 +169,10 @@ def read():
                     (k, re.compile( pattern.strip()), substitute.strip()) )
         mappings.sort()
         CommentMappings.mappings = mappings
+        CommentMappings.generation += 1
+        CommentMappings.digest = md5.new(repr(
+            [(k, pattern.pattern, substitute)
+             for k, pattern, substitute in mappings])).hexdigest()
 
     read_comment_mappings()
     
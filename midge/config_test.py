@@ -18,17 +18,29 @@ class ConfigTests(unittest.TestCase):
         self.assertNotEqual(midge.config.Database.password, None)
         self.assertNotEqual(midge.config.Database.name, None)
         self.assertNotEqual(midge.config.Database.test_name, None)
+        self.assertNotEqual(midge.config.Database.pool_size, None)
         self.assertNotEqual(midge.config.Project.name, None)
         self.assertNotEqual(midge.config.Project.help, None)
         self.assertNotEqual(midge.config.Server.interface, None)
         self.assertNotEqual(midge.config.Server.port, None)
         self.assertNotEqual(midge.config.Server.session_timeout, None)
+        self.assertNotEqual(midge.config.Server.max_sessions, None)
+        self.assertNotEqual(midge.config.Server.session_store, None)
+        self.assertNotEqual(midge.config.Server.session_secret, None)
+        self.assertNotEqual(midge.config.Server.threads, None)
+        self.assertNotEqual(midge.config.Server.keep_alive_timeout, None)
+        self.assertNotEqual(midge.config.Server.keep_alive_requests, None)
+        self.assertNotEqual(midge.config.Server.compression_level, None)
+        self.assertNotEqual(midge.config.Server.compression_threshold, None)
         self.assertNotEqual(midge.config.Email.smtp_host, None)
         self.assertNotEqual(midge.config.Email.from_address, None)
         self.assertNotEqual(midge.config.Logging.host, None)
         self.assertNotEqual(midge.config.Logging.facility, None)
         self.assertNotEqual(midge.config.Logging.debugging, None)
         self.assertNotEqual(midge.config.Presentation.directory, None)
+        self.assertNotEqual(midge.config.Presentation.page_size, None)
+        self.assertNotEqual(midge.config.Cache.timeout, None)
+        self.assertNotEqual(midge.config.Cache.results_size, None)
         self.assertNotEqual(midge.config.History.changes_max_age, None)
         self.assertNotEqual(midge.config.History.progress_max_age, None)
 
@@ -45,5 +57,5 @@ class ConfigTests(unittest.TestCase):
                 
         sys.stdout = MyStdout() 
         midge.config.print_env_variables()
-        self.assertEqual(len(sys.stdout.lines), 17)
+        self.assertEqual(len(sys.stdout.lines), 26)
         sys.stdout = sys.__stdout__
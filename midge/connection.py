@@ -4,6 +4,9 @@
 """Provide abstract connections and test connections to the database."""
 
 import psycopg2
+import psycopg2.extensions
+import threading
+import time
 
 import midge.administration as administration
 import midge.config as config
@@ -11,27 +14,79 @@ import midge.lib as lib
 import midge.logger as logger
 
 
+class _PreparingConnection(psycopg2.extensions.connection):
+
+    """A psycopg2 connection which remembers its prepared statements."""
+
+    def __init__(self, *args, **kwargs):
+        psycopg2.extensions.connection.__init__(self, *args, **kwargs)
+        self.prepared = {}
+
+
+def connect(database):
+    """Return a new (raw) connection to the given database."""
+    return psycopg2.connect(
+        "dbname=%s user=%s password=%s" % (database,
+                                           config.Database.user,
+                                           config.Database.password),
+        connection_factory=_PreparingConnection)
+
+
+def execute_prepared(cursor, sql, parameters=()):
+    """Execute sql as a prepared statement.
+
+    The sql must use postgres' own placeholders ($1, $2, etc) for the
+    parameters. Each distinct statement is prepared (i.e. parsed and
+    planned) only on its first use with each underlying connection,
+    and thereafter just executed.
+
+    """
+    prepared = cursor.connection.prepared
+    name = prepared.get(sql, None)
+    if name is None:
+        name = "midge_%d" % (len(prepared) + 1)
+        cursor.execute("PREPARE %s AS %s" % (name, sql))
+        prepared[sql] = name
+    if parameters:
+        placeholders = ", ".join(["%s"] * len(parameters))
+        cursor.execute("EXECUTE %s (%s);" % (name, placeholders), parameters)
+    else:
+        cursor.execute("EXECUTE %s;" % name)
+
+
+class MigrationFailedException(Exception):
+    pass
+
+
 class Connection(object):
 
     """Provide an abstracted connection to the database.
 
-    Also automatically sets-up the tables if they are not present.
+    Also automatically sets-up the tables if they are not present, or
+    upgrades them if they are out of date. Raises if that fails, rather
+    than carry on with tables which are not what midge expects.
     
     """
     def __init__(self):
-        self._connection = psycopg2.connect(
-            "dbname=%s user=%s password=%s" % (config.Database.name,
-                                               config.Database.user,
-                                               config.Database.password))
+        self.database = config.Database.name
+        self._connection = connect(self.database)
         self._setup_tables()
 
     def _setup_tables(self):
-        if not administration.have_tables(config.Database.name):
+        if not administration.have_tables(self.database):
             logger.info("No tables defined - creating new ones")
-            administration.create_tables(config.Database.name)
+            success = administration.create_tables(self.database)
+        else:
+            success = administration.migrate(self.database)
+        if not success:
+            raise MigrationFailedException, \
+                  "Failed to upgrade database %s to version %d (see the " \
+                  "logs, and try \"midge-admin upgrade\")" % (
+                self.database, administration.get_latest_version())
 
-    def cursor(self):
-        return self._connection.cursor()
+    def cursor(self, name=None):
+        """Return a new cursor, which is server-side if given a name."""
+        return self._connection.cursor(name)
 
     def commit(self):
         return self._connection.commit()
@@ -39,10 +94,169 @@ class Connection(object):
     def rollback(self):
         return self._connection.rollback()
 
+    def release(self):
+        """Release any resources held on behalf of the current thread."""
+        pass
+
     def close(self):
         return self._connection.close()
 
-    
+
+class PoolExhaustedException(Exception):
+    pass
+
+
+class Pool(Connection):
+
+    """A bounded pool of connections to the database.
+
+    The first database access made by a thread checks out a connection
+    from the pool, which then remains bound to that thread until
+    release() is called (typically at the end of every request). Thus
+    each thread works within its own transaction, and the pool bounds
+    the total number of connections made to postgres.
+
+    Connections which have been idle for a while are checked before
+    being handed out, and any which have been broken (e.g. by a restart
+    of postgres) are transparently replaced by a new connection.
+
+    """
+
+    # Connections idle for longer than this (seconds) are checked.
+    check_after = 10
+
+    # Time (seconds) to wait for a connection when the pool is exhausted.
+    timeout = 30
+
+    def __init__(self, size=None):
+        if size is None:
+            size = config.Database.pool_size
+        assert size > 0
+        self.size = size
+        self.database = config.Database.name
+        self._local = threading.local()
+        self._idle = []
+        self._n_open = 0
+        self._condition = threading.Condition(threading.Lock())
+        self.n_checkouts = 0
+        self.n_waits = 0
+        self.n_reconnects = 0
+        self._setup_tables()
+
+    def _is_healthy(self, connection):
+        if connection.closed:
+            return False
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.close()
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _take_connection(self):
+        """Return an idle connection (or None), counting it as in use."""
+        self._condition.acquire()
+        try:
+            t0 = time.time()
+            while not self._idle and self._n_open >= self.size:
+                self.n_waits += 1
+                remaining = self.timeout - (time.time() - t0)
+                if remaining <= 0:
+                    raise PoolExhaustedException
+                self._condition.wait(remaining)
+            self._n_open += 1
+            self.n_checkouts += 1
+            if self._idle:
+                return self._idle.pop()
+            return None
+        finally:
+            self._condition.release()
+
+    def _discard_connection(self):
+        self._condition.acquire()
+        try:
+            self._n_open -= 1
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def _checkout(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            return connection
+        idle = self._take_connection()
+        try:
+            if idle is not None:
+                connection, last_used = idle
+                if time.time() - last_used > self.check_after and \
+                       not self._is_healthy(connection):
+                    logger.warn("Replacing broken database connection")
+                    self.n_reconnects += 1
+                    try:
+                        connection.close()
+                    except psycopg2.Error:
+                        pass
+                    connection = connect(self.database)
+            else:
+                connection = connect(self.database)
+        except:
+            self._discard_connection()
+            raise
+        self._local.connection = connection
+        return connection
+
+    _connection = property(_checkout)
+
+    def release(self):
+        """Return the connection bound to this thread (if any) to the pool.
+
+        Any uncommitted changes are rolled back.
+
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            return
+        self._local.connection = None
+        if not connection.closed:
+            try:
+                connection.rollback()
+            except psycopg2.Error:
+                pass
+        self._condition.acquire()
+        try:
+            self._n_open -= 1
+            if not connection.closed:
+                self._idle.append((connection, time.time()))
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def get_metrics(self):
+        """Return a dictionary describing the current use of the pool."""
+        self._condition.acquire()
+        try:
+            return {"size": self.size,
+                    "in_use": self._n_open,
+                    "idle": len(self._idle),
+                    "checkouts": self.n_checkouts,
+                    "waits": self.n_waits,
+                    "reconnects": self.n_reconnects}
+        finally:
+            self._condition.release()
+
+    def close(self):
+        self.release()
+        self._condition.acquire()
+        try:
+            for connection, last_used in self._idle:
+                connection.close()
+            self._idle = []
+        finally:
+            self._condition.release()
+
+
 class TestConnection(object):
 
     """A connection for testing which is independent of a normal Connection.
@@ -55,14 +269,16 @@ class TestConnection(object):
         self._drop_tables()
         self._create_tables()
         self._create_test_user()
-        self._connection = psycopg2.connect(
-            "dbname=%s user=%s password=%s" % (config.Database.test_name,
-                                               config.Database.user,
-                                               config.Database.password))
+        self.database = config.Database.test_name
+        self._connection = connect(self.database)
 
     def _create_tables(self):
-        if not administration.have_tables(config.Database.test_name):
-            administration.create_tables(config.Database.test_name)
+        database = config.Database.test_name
+        if not administration.have_tables(database):
+            if not administration.create_tables(database):
+                raise MigrationFailedException, \
+                      "Failed to create the tables of database %s (see " \
+                      "the logs)" % database
 
     def _drop_tables(self):
         if administration.have_tables(config.Database.test_name):
@@ -75,8 +291,8 @@ class TestConnection(object):
             "VALUES ('test-username', 'test-password', "
             "'test-name', 'test-email')")
 
-    def cursor(self):
-        return self._connection.cursor()
+    def cursor(self, name=None):
+        return self._connection.cursor(name)
 
     def commit(self):
         return self._connection.commit()
@@ -84,6 +300,9 @@ class TestConnection(object):
     def rollback(self):
         return self._connection.rollback()
 
+    def release(self):
+        pass
+
     def close(self):
         self._connection.close()
         self._drop_tables()
@@ -5,6 +5,7 @@
 
 import unittest
 
+import midge.administration as administration
 import midge.config as config
 import midge.connection as connection
 
@@ -17,8 +18,35 @@ class ConnectionTests(unittest.TestCase):
         conn = connection.Connection()
         conn.close()
 
+    def test_failed_migration(self):
+        """Check a connection is refused if the tables cannot be upgraded."""
+        config.read()
+        migrate = administration.migrate
+        administration.migrate = lambda database: False
+        try:
+            self.assertRaises(connection.MigrationFailedException,
+                              connection.Connection)
+        finally:
+            administration.migrate = migrate
+
     def test_test_connection(self):
         """Check open/close connection to the test database."""
         config.read()
         conn = connection.TestConnection()
         conn.close()
+
+    def test_pool(self):
+        """Check connections are returned to and reused from the pool."""
+        config.read()
+        pool = connection.Pool(1)
+        cursor = pool.cursor()
+        cursor.execute("SELECT 1;")
+        cursor.close()
+        self.assertEqual(pool.get_metrics()["in_use"], 1)
+        pool.release()
+        self.assertEqual(pool.get_metrics()["in_use"], 0)
+        self.assertEqual(pool.get_metrics()["idle"], 1)
+        cursor = pool.cursor()
+        cursor.close()
+        self.assertEqual(pool.get_metrics()["checkouts"], 2)
+        pool.close()
@@ -3,9 +3,24 @@
 
 """Functionality to import and export bugs from Midge."""
 
+import cStringIO
 import csv
+import os
+import sys
+import threading
 
 import midge.application as application
+import midge.connection as connection
+import midge.logger as logger
+
+
+# The title row of each file.
+_user_titles = ["Username", "Name", "Email", "Password"]
+_bug_titles = ["Bug", "Username", "Date", "Title", "Status",
+               "Priority", "Resolution",
+               "Category", "Keyword",
+               "Reported in", "Fixed in", "Tested ok in"]
+_comment_titles = ["Bug", "Username", "Date", "Comment"]
 
 
 class Importer:
@@ -42,33 +57,39 @@ class Importer:
 
     def _import_users_from_file(self, filename):
         f = file(filename)
-        reader = csv.reader(f)
-        iterator = iter(reader)
-        titles = iterator.next()
-        assert titles == ["Username", "Name", "Email", "Password"]
-        for row in iterator:
-            self._import_user(*row)
+        try:
+            reader = csv.reader(f)
+            iterator = iter(reader)
+            titles = iterator.next()
+            assert titles == _user_titles
+            for row in iterator:
+                self._import_user(*row)
+        finally:
+            f.close()
 
     def _import_bugs_from_file(self, filename):
         f = file(filename)
-        reader = csv.reader(f)
-        iterator = iter(reader)
-        titles = iterator.next()
-        assert titles == ["Bug", "Username", "Date", "Title", "Status",
-                          "Priority", "Resolution",
-                          "Category", "Keyword",
-                          "Reported in", "Fixed in", "Tested ok in"]
-        for row in iterator:
-            self._import_bug(*row)
+        try:
+            reader = csv.reader(f)
+            iterator = iter(reader)
+            titles = iterator.next()
+            assert titles == _bug_titles
+            for row in iterator:
+                self._import_bug(*row)
+        finally:
+            f.close()
 
     def _import_comments_from_file(self, filename):
         f = file(filename)
-        reader = csv.reader(f)
-        iterator = iter(reader)
-        titles = iterator.next()
-        assert titles == ["Bug", "Username", "Date", "Comment"]
-        for row in iterator:
-            self._import_comment(*row)
+        try:
+            reader = csv.reader(f)
+            iterator = iter(reader)
+            titles = iterator.next()
+            assert titles == _comment_titles
+            for row in iterator:
+                self._import_comment(*row)
+        finally:
+            f.close()
 
     def import_all(self, users_filename, bugs_filename, comments_filename):
         """Import a set of data into the database."""
@@ -77,6 +98,275 @@ class Importer:
         self._import_comments_from_file(comments_filename)
 
 
+def _copy_escape(value):
+    """Return the value as text for COPY, with None as NULL."""
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace(
+        "\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+class BulkImporter:
+
+    """Import a set of data in bulk, much faster than the Importer.
+
+    The user_id of every user, and the id of every value of each state,
+    are read just once into dictionaries, so the rows of bugs and
+    comments need no queries of their own. The rows are then streamed
+    into their tables by COPY, batch_size at a time. Each batch is
+    committed along with a checkpoint of how many rows of its file have
+    been imported, so if an import fails, running it again with the
+    same files resumes after the last batch committed. The sequence of
+    bug ids is set once all the bugs have been imported.
+
+    Rather than the trigger on comments appending each comment to the
+    search_vector of its bug (rewriting the bug for every comment), the
+    bugs with comments in the file are indexed once all the comments
+    have been imported, in a single pass. Until then, searches by the
+    words of a running midged do not find the comments imported.
+
+    As with the Importer, no changes are logged. The html of the
+    comments is rendered afterwards, by Bugs.render_comments().
+
+    """
+
+    # The number of rows copied in each transaction.
+    batch_size = 5000
+
+    # The state tables of the columns of the bugs file after the status.
+    _state_tables = ("priorities", "resolutions", "categories", "keywords",
+                     "reported_ins", "fixed_ins", "tested_ok_ins")
+
+    def __init__(self, connection, report=logger.info):
+        """Construct a BulkImporter, which reports progress by report()."""
+        self.connection = connection
+        self.report = report
+        self.users = application.Users(connection)
+        self.bugs = application.Bugs(connection)
+        self.user_ids = {}
+        self.status_ids = {}
+        # The ids of the values of each value_table, by value.
+        self.value_ids = {}
+
+    def _read_rows(self, f, titles):
+        iterator = iter(csv.reader(f))
+        assert iterator.next() == titles
+        for row in iterator:
+            yield row
+
+    def _get_user_id(self, username):
+        try:
+            return self.user_ids[username]
+        except KeyError:
+            raise application.MidgeException, "No such user: %s" % username
+
+    def _get_checkpoint_name(self, filename):
+        filename = os.path.abspath(filename)
+        return "%s %d" % (filename, os.path.getsize(filename))
+
+    def _read_checkpoint(self, name):
+        """Return the number of rows already imported from the file."""
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("""
+                SELECT n_rows FROM import_checkpoints WHERE name = %s;
+                """, (name,))
+            ans = cursor.fetchone()
+        finally:
+            cursor.close()
+        self.connection.commit()
+        if ans is None:
+            return 0
+        return ans[0]
+
+    def _remove_checkpoints(self, names):
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("""
+                DELETE FROM import_checkpoints WHERE name = ANY(%s);
+                """, (names,))
+            self.connection.commit()
+        finally:
+            cursor.close()
+
+    def _import_users(self, filename):
+        """Create those users who do not already exist."""
+        self.user_ids = self.users.get_user_ids()
+        n_users = 0
+        f = file(filename)
+        try:
+            for username, name, email, password in self._read_rows(
+                f, _user_titles):
+                if username not in self.user_ids:
+                    self.users.create_new_user(username, name, email,
+                                               password)
+                    n_users += 1
+        finally:
+            f.close()
+        self.user_ids = self.users.get_user_ids()
+        self.report("Imported %d users" % n_users)
+
+    def _resolve_values(self, cursor, rows):
+        """Find (or create) the ids of the values new to the rows of bugs."""
+        for index, table_name in enumerate(self._state_tables):
+            state_table = getattr(self.bugs, table_name)
+            ids = self.value_ids.setdefault(state_table.value_table, {})
+            new_values = {}
+            for row in rows:
+                value = row[5 + index].strip()
+                if value and value not in ids:
+                    new_values[value] = True
+            if new_values:
+                ids.update(state_table.get_ids(cursor, new_values.keys()))
+
+    def _convert_bugs(self, cursor, rows):
+        self._resolve_values(cursor, rows)
+        for row in rows:
+            bug_id, username, date, title, status = row[:5]
+            status_id = self.status_ids.get(status, None)
+            if status_id is None:
+                raise application.InvalidValueException, (bug_id, status)
+            converted = [int(bug_id), self._get_user_id(username), date,
+                         title, status_id]
+            for index, table_name in enumerate(self._state_tables):
+                ids = self.value_ids[getattr(self.bugs,
+                                             table_name).value_table]
+                converted.append(ids.get(row[5 + index].strip(), None))
+            yield converted
+
+    def _convert_comments(self, rows):
+        for bug_id, username, date, text in rows:
+            yield int(bug_id), self._get_user_id(username), date, text
+
+    def _copy_rows(self, cursor, table, columns, rows):
+        """Copy the rows (sequences of values) into the table."""
+        data = cStringIO.StringIO()
+        for row in rows:
+            data.write("\t".join([_copy_escape(value) for value in row]))
+            data.write("\n")
+        data.seek(0)
+        cursor.copy_expert("COPY %s (%s) FROM STDIN;" % (
+            table, ", ".join(columns)), data)
+
+    def _copy_bugs(self, cursor, rows):
+        self._copy_rows(cursor, "bugs",
+                        ("bug_id", "user_id", "date", "title", "status_id") +
+                        tuple([getattr(self.bugs, table_name).bug_column
+                               for table_name in self._state_tables]),
+                        self._convert_bugs(cursor, rows))
+
+    def _copy_comments(self, cursor, rows):
+        """Copy the comments, without indexing their bugs for search.
+
+        Only the trigger run within this transaction is told not to
+        index them, so comments added meanwhile by midged still are.
+
+        """
+        cursor.execute("SET LOCAL midge.bulk_import = 'on';")
+        self._copy_rows(cursor, "comments",
+                        ("bug_id", "user_id", "date", "comment"),
+                        self._convert_comments(rows))
+
+    def _index_bugs(self, filename):
+        """Index for search the bugs with comments in the file."""
+        bug_ids = {}
+        f = file(filename)
+        try:
+            for row in self._read_rows(f, _comment_titles):
+                bug_ids[int(row[0])] = True
+        finally:
+            f.close()
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("""
+                UPDATE bugs
+                SET search_vector = midge_bug_search_vector(title, bug_id)
+                WHERE bug_id = ANY(%s);
+                """, (bug_ids.keys(),))
+            self.connection.commit()
+        finally:
+            cursor.close()
+        self.report("Indexed %d bugs for search" % len(bug_ids))
+
+    def _copy_batch(self, name, n_rows, copy, rows):
+        """Copy the rows by copy(), recording that n_rows are done."""
+        cursor = self.connection.cursor()
+        try:
+            try:
+                copy(cursor, rows)
+                cursor.execute("""
+                    INSERT INTO import_checkpoints (name, n_rows)
+                    VALUES (%s, %s)
+                    ON CONFLICT (name) DO UPDATE SET n_rows=EXCLUDED.n_rows;
+                    """, (name, n_rows))
+                self.connection.commit()
+            except:
+                self.connection.rollback()
+                raise
+        finally:
+            cursor.close()
+
+    def _copy_from_file(self, filename, titles, copy):
+        """Copy the rows of the file into the database, a batch at a time.
+
+        Each batch is copied by copy(cursor, rows). Rows imported by an
+        earlier attempt are skipped. Returns the name of the file's
+        checkpoint.
+
+        """
+        name = self._get_checkpoint_name(filename)
+        n_done = self._read_checkpoint(name)
+        if n_done:
+            self.report("Resuming %s after %d rows" % (filename, n_done))
+        n_rows = 0
+        rows = []
+        f = file(filename)
+        try:
+            for row in self._read_rows(f, titles):
+                n_rows += 1
+                if n_rows <= n_done:
+                    continue
+                rows.append(row)
+                if len(rows) == self.batch_size:
+                    self._copy_batch(name, n_rows, copy, rows)
+                    self.report("Imported %d rows of %s" % (n_rows,
+                                                            filename))
+                    rows = []
+        finally:
+            f.close()
+        if rows:
+            self._copy_batch(name, n_rows, copy, rows)
+        self.report("Imported all %d rows of %s" % (n_rows, filename))
+        return name
+
+    def _set_bug_ids(self):
+        """Set the sequence of bug ids to follow the bugs imported."""
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("""
+                SELECT setval('bug_ids_seq', (SELECT MAX(bug_id) FROM bugs));
+                """)
+            self.connection.commit()
+        finally:
+            cursor.close()
+
+    def import_all(self, users_filename, bugs_filename, comments_filename):
+        """Import a set of data into the database."""
+        self._import_users(users_filename)
+        self.status_ids = self.bugs.statuses.get_ids()
+        bugs_checkpoint = self._copy_from_file(
+            bugs_filename, _bug_titles, self._copy_bugs)
+        self._set_bug_ids()
+        comments_checkpoint = self._copy_from_file(
+            comments_filename, _comment_titles, self._copy_comments)
+        self._index_bugs(comments_filename)
+        self._remove_checkpoints([bugs_checkpoint, comments_checkpoint])
+        for table_name in self._state_tables:
+            state_table = getattr(self.bugs, table_name)
+            state_table.cache.invalidate(state_table.value_table)
+        self.bugs.results.bump()
+
+
 class Exporter:
 
     def __init__(self, connection):
@@ -105,4 +395,77 @@ class Exporter:
         """Export all bugs to three files (users, bugs, comments)."""
         self._write_users_to_file(users_filename)
         self._write_bugs_to_file(bugs_filename)
-        self._write_comments_to_file(comments_filename)           
+        self._write_comments_to_file(comments_filename)
+
+
+class StreamingExporter(Exporter):
+
+    """Export all bugs in constant memory, writing the files in parallel.
+
+    Each file is written by its own thread, over its own connection,
+    with postgres streaming the rows as csv straight to the file (by
+    COPY ... TO STDOUT). The connections all share one snapshot of the
+    database, exported by the transaction of the exporter's own
+    connection, so the three files are consistent with each other even
+    while bugs are being changed.
+
+    """
+
+    def __init__(self, connection):
+        Exporter.__init__(self, connection)
+        self.connection = connection
+
+    def _write_to_file(self, snapshot, write, filename, errors):
+        """Call write(cursor, wfile) within the snapshot, in this thread."""
+        try:
+            snapshot_connection = connection.connect(self.connection.database)
+            try:
+                cursor = snapshot_connection.cursor()
+                cursor.execute("""
+                    SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;
+                    """)
+                cursor.execute("""
+                    SET TRANSACTION SNAPSHOT %s;
+                    """, (snapshot,))
+                f = file(filename, "w")
+                try:
+                    write(cursor, f)
+                finally:
+                    f.close()
+                cursor.close()
+            finally:
+                snapshot_connection.close()
+        except:
+            errors.append(sys.exc_info())
+
+    def export_all(self, users_filename, bugs_filename, comments_filename):
+        """Export all bugs to three files (users, bugs, comments)."""
+        errors = []
+        self.connection.rollback()
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("""
+                SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;
+                """)
+            cursor.execute("""
+                SELECT pg_export_snapshot();
+                """)
+            snapshot = cursor.fetchone()[0]
+            threads = []
+            for write, filename in ((self.users.write_users, users_filename),
+                                    (self.bugs.write_bugs, bugs_filename),
+                                    (self.bugs.write_comments,
+                                     comments_filename)):
+                thread = threading.Thread(
+                    target=self._write_to_file,
+                    args=(snapshot, write, filename, errors))
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+        finally:
+            cursor.close()
+            self.connection.rollback()
+        if errors:
+            exc_type, exc_value, exc_traceback = errors[0]
+            raise exc_type, exc_value, exc_traceback
@@ -3,7 +3,11 @@
 
 """Unittests for the io module."""
 
+import csv
 import mx.DateTime
+import os
+import shutil
+import tempfile
 import unittest
 
 import midge.application as application
@@ -62,6 +66,7 @@ class ImporterTests(BaseTest):
                      "a second comment")]
         for bug_id, username, timestamp, text in comments:
             self.importer._import_comment(bug_id, username, timestamp, text)
+        bug = self.importer.bugs.get(bug.bug_id)
         self.assertEqual(len(bug.comments), 3)
 
         comment1 = bug.comments[1]
@@ -105,3 +110,170 @@ class ImporterTests(BaseTest):
         user.login("username", "password")
         bug = self._add_bug(user)
         self.assertEqual(bug.bug_id, 24)
+
+
+class BulkImporterTests(BaseTest):
+
+    def setUp(self, *args):
+        BaseTest.setUp(self)
+        self.reports = []
+        self.importer = io.BulkImporter(self.connection, self.reports.append)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        BaseTest.tearDown(self)
+
+    def _write(self, name, rows):
+        filename = os.path.join(self.directory, name)
+        f = file(filename, "w")
+        csv.writer(f).writerows(rows)
+        f.close()
+        return filename
+
+    def _write_files(self, usernames, comments):
+        users = [("Username", "Name", "Email", "Password")]
+        users += [(username, "name", "email", "password")
+                  for username in usernames]
+        bugs = [("Bug", "Username", "Date", "Title", "Status",
+                 "Priority", "Resolution", "Category", "Keyword",
+                 "Reported in", "Fixed in", "Tested ok in"),
+                ("23", "username", "Mon Apr 13 12:23:00 GMT 2000",
+                 "a title", "reviewed", "2", "a resolution", "a category",
+                 "a keyword", "a version", "", "a version"),
+                ("7", "username", "Mon Apr 13 12:24:00 GMT 2000",
+                 "a\ttab\\n", "new", "", "", "", "", "", "", "")]
+        comments.insert(0, ("Bug", "Username", "Date", "Comment"))
+        return (self._write("users.csv", users),
+                self._write("bugs.csv", bugs),
+                self._write("comments.csv", comments))
+
+    def _count_checkpoints(self):
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM import_checkpoints;")
+        n_checkpoints = cursor.fetchone()[0]
+        cursor.close()
+        return n_checkpoints
+
+    def test_import(self):
+        """Check bulk import of users, bugs and comments"""
+        filenames = self._write_files(
+            ["username"],
+            [("23", "username", "Sun Apr 12 09:31:06 BST 2004",
+              "a comment"),
+             ("23", "username", "Mon Apr 13 12:23:00 GMT 2000",
+              "another\ncomment")])
+        self.importer.import_all(*filenames)
+
+        bugs = application.Bugs(self.connection)
+        bug = bugs.get(23)
+        self.assertEqual(bug.title, "a title")
+        self.assertEqual(bug.status, "reviewed")
+        self.assertEqual(bug.priority, "2")
+        self.assertEqual(bug.resolution, "a resolution")
+        self.assertEqual(bug.category, "a category")
+        self.assertEqual(bug.keyword, "a keyword")
+        self.assertEqual(bug.reported_in, "a version")
+        self.assertEqual(bug.fixed_in, "")
+        self.assertEqual(bug.tested_ok_in, "a version")
+        self.assertEqual([comment.text for comment in bug.comments],
+                         ["another\ncomment", "a comment"])
+        bug = bugs.get(7)
+        self.assertEqual(bug.title, "a\ttab\\n")
+        self.assertEqual(bug.status, "new")
+        self.assertEqual(bug.priority, "")
+        self.assertEqual(self._count_checkpoints(), 0)
+
+        user = application.User(self.connection)
+        user.login("username", "password")
+        bug_id = bugs.add(user, title="a title")
+        self.assertEqual(bug_id, 24)
+
+        # The comments are indexed for search, and the trigger still
+        # indexes new comments.
+        bugs.get(7).change(user, comment="a third")
+
+        def search_for(text):
+            search = application.Search(("bug_id",), "relevance",
+                                        "descending", text=text)
+            bugs.search(search)
+            return [row.bug_id for row in search.rows]
+
+        self.assertEqual(search_for("another"), [23])
+        self.assertEqual(search_for("third"), [7])
+
+    def test_resume(self):
+        """Check a failed bulk import resumes after the last batch"""
+        self.importer.batch_size = 1
+        comments = [("23", "username", "Sun Apr 12 09:31:06 BST 2004",
+                     "a first comment"),
+                    ("23", "other", "Mon Apr 13 12:23:00 GMT 2000",
+                     "another comment")]
+        filenames = self._write_files(["username"], comments[:])
+        self.assertRaises(application.MidgeException,
+                          self.importer.import_all, *filenames)
+        bugs = application.Bugs(self.connection)
+        self.assertEqual(len(bugs.get(23).comments), 1)
+        self.assertEqual(self._count_checkpoints(), 2)
+
+        filenames = self._write_files(["username", "other"], comments)
+        self.importer.import_all(*filenames)
+        self.assertEqual([comment.username
+                          for comment in bugs.get(23).comments],
+                         ["other", "username"])
+        self.assertEqual(self._count_checkpoints(), 0)
+
+        # Including the comment imported by the failed attempt.
+        for text in ("first", "another"):
+            search = application.Search(("bug_id",), "relevance",
+                                        "descending", text=text)
+            bugs.search(search)
+            self.assertEqual([row.bug_id for row in search.rows], [23])
+
+
+class StreamingExporterTests(BaseTest):
+
+    def setUp(self, *args):
+        BaseTest.setUp(self)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        BaseTest.tearDown(self)
+
+    def _export(self, exporter, prefix):
+        filenames = [os.path.join(self.directory, prefix + name)
+                     for name in ("users.csv", "bugs.csv", "comments.csv")]
+        exporter.export_all(*filenames)
+        return [list(csv.reader(file(filename))) for filename in filenames]
+
+    def test_export(self):
+        """Check streaming export writes the same as the exporter"""
+        user = application.User(self.connection)
+        user.login("test-username", "test-password")
+        bugs = application.Bugs(self.connection)
+        bug_id = bugs.add(user, title="a title", version="a version",
+                          description="a comment,\nover two lines")
+        bugs.get(bug_id).change(user, priority="2", comment="another")
+
+        files = self._export(io.StreamingExporter(self.connection), "s-")
+        users, bugs_rows, comments = files
+        self.assertEqual(users[0], ["Username", "Name", "Email", "Password"])
+        self.assertEqual(users[1][0], "test-username")
+        self.assertEqual(len(bugs_rows), 2)
+        self.assertEqual(bugs_rows[1][3:6], ["a title", "new", "2"])
+        self.assertEqual(bugs_rows[1][9], "a version")
+        self.assertEqual([row[3] for row in comments[1:]],
+                         ["a comment,\nover two lines", "another"])
+        self.assertEqual(files, self._export(io.Exporter(self.connection),
+                                             "e-"))
+
+
+class CopyEscapeTests(unittest.TestCase):
+
+    def test_copy_escape(self):
+        """Check values are escaped for COPY"""
+        self.assertEqual(io._copy_escape(None), "\\N")
+        self.assertEqual(io._copy_escape(23), "23")
+        self.assertEqual(io._copy_escape("a\\b\tc\nd\re"),
+                         "a\\\\b\\tc\\nd\\re")
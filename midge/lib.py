@@ -3,11 +3,15 @@
 
 """Common library routines."""
 
+import heapq
 import mx.DateTime
 import smtplib
 import socket
+import threading
+import time
 import urllib
 import xml.sax.saxutils
+import zlib
 
 import midge.config as config
 import midge.logger as logger
@@ -58,6 +62,16 @@ def sendmail(to, message):
     return False
 
 
+def make_gzip_compressor(level):
+    """Return a zlib compressor which produces the gzip format."""
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def gzip_compress(data, level):
+    compressor = make_gzip_compressor(level)
+    return compressor.compress(data) + compressor.flush()
+
+
 def pretty_format_date(date):
     return date.strftime("%a %d of %B, %Y")
 
@@ -87,3 +101,145 @@ def get_utc_time_of_next_hour():
 
 def get_utc_time():
     return mx.DateTime.utc()
+
+
+class ExpiringCache(object):
+
+    """A thread-safe dictionary whose entries expire after a timeout.
+
+    Used to cache data read from the database, where the timeout puts
+    a bound on how long changes made by other processes go unseen.
+
+    """
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                return default
+            expire_time, value = entry
+            if time.time() > expire_time:
+                del self._entries[key]
+                return default
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            self._entries[key] = (time.time() + self.timeout, value)
+        finally:
+            self._lock.release()
+
+    def purge(self):
+        """Forget all the expired entries."""
+        self._lock.acquire()
+        try:
+            t0 = time.time()
+            for key, (expire_time, value) in self._entries.items():
+                if t0 > expire_time:
+                    del self._entries[key]
+        finally:
+            self._lock.release()
+
+    def invalidate(self, key=None):
+        """Forget the given entry, or all entries if no key is given."""
+        self._lock.acquire()
+        try:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+        finally:
+            self._lock.release()
+
+
+class LRUCache(object):
+
+    """A thread-safe dictionary bounded by the total size of its values.
+
+    Each value is set with its size (in whatever units max_size is
+    given). Once over max_size, the least recently used entries are
+    forgotten. Recency is tracked by a heap of (last_used, key), where
+    each use pushes a new entry rather than moving the old one, which
+    is ignored once popped, as for the heap of sessions.MemoryStore.
+
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.n_evictions = 0
+        self._entries = {}
+        self._heap = []
+        self._n_uses = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _use(self, key, entry):
+        self._n_uses += 1
+        entry[0] = self._n_uses
+        heapq.heappush(self._heap, (self._n_uses, key))
+        if len(self._heap) > 2 * len(self._entries) + 100:
+            self._heap = [(entry[0], key)
+                          for key, entry in self._entries.iteritems()]
+            heapq.heapify(self._heap)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                return default
+            self._use(key, entry)
+            return entry[2]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, size=1):
+        """Set the value, unless it is larger than max_size on its own."""
+        self._lock.acquire()
+        try:
+            self._remove(key)
+            if size > self.max_size:
+                return
+            entry = [None, size, value]
+            self._entries[key] = entry
+            self.size += size
+            self._use(key, entry)
+            while self.size > self.max_size:
+                n_uses, oldest = heapq.heappop(self._heap)
+                entry = self._entries.get(oldest, None)
+                if entry is not None and entry[0] == n_uses:
+                    self._remove(oldest)
+                    self.n_evictions += 1
+        finally:
+            self._lock.release()
+
+    def remove(self, key):
+        self._lock.acquire()
+        try:
+            self._remove(key)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._heap = []
+            self.size = 0
+        finally:
+            self._lock.release()
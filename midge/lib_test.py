@@ -27,3 +27,28 @@ class LibTests(unittest.TestCase):
         for base, params, url in url_splits:
             self.assertEqual(midge.lib.join_url(base, params), url)
             self.assertEqual(midge.lib.split_url(url), (base, params))
+
+
+class LRUCacheTests(unittest.TestCase):
+
+    def test_least_recently_used_evicted(self):
+        """Check the least recently used entries are evicted when full"""
+        cache = midge.lib.LRUCache(100)
+        cache.set("a", "a", 40)
+        cache.set("b", "b", 40)
+        cache.get("a")
+        cache.set("c", "c", 40)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), "a")
+        self.assertEqual(cache.get("c"), "c")
+        self.assertEqual(cache.size, 80)
+        self.assertEqual(cache.n_evictions, 1)
+
+    def test_too_large_not_set(self):
+        """Check an entry larger than the whole cache is not set"""
+        cache = midge.lib.LRUCache(100)
+        cache.set("a", "a", 40)
+        cache.set("a", "b", 101)
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
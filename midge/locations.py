@@ -3,12 +3,11 @@
 
 """Set of classes to manage URL locations, such as /list and /login."""
 
-import os.path
-
 import midge.application as application
 import midge.config as config
 import midge.lib as lib
 import midge.server as server
+import midge.static as static
 import midge.templates as templates
 
 
@@ -22,6 +21,15 @@ class Location:
 
     mime_type = "text/html"
 
+    # Whether output is sent to the client as it is written, rather
+    # than when complete. A streaming Location must only redirect
+    # before writing any output.
+    streaming = False
+
+    # Whether the Location serves static files, in which case it
+    # provides get_asset() instead of handle_get().
+    static = False
+
     def __init__(self, application):
         self.application = application
 
@@ -41,6 +49,23 @@ class Location:
             url = location
         raise server.RedirectException, url
 
+    def search(self, session_id, search, page):
+        """Run the search for the given page of results.
+
+        The page is a number, or "all" for all the results, which are
+        then streamed from the database as they are rendered.
+
+        """
+        if page == "all":
+            self.application.search(session_id, search, stream=True)
+        else:
+            try:
+                page = int(page)
+            except ValueError:
+                page = 1
+            search.paginate(page, config.Presentation.page_size)
+            self.application.search(session_id, search)
+
 
 class Home(Location):
 
@@ -352,6 +377,7 @@ class ModifyUser(Location):
 class List(Location):
 
     path = "/list"
+    streaming = True
 
     def handle_get(self, session_id, values, wfile):
         user = self.application.get_user(session_id)
@@ -359,11 +385,12 @@ class List(Location):
             status = values.pop("status", None)
             sort_by = values.pop("sort_by", None)
             order = values.pop("order", None)
+            page = values.pop("page", "1")
             show_method_name = "_show_%s" % status
             if hasattr(self, show_method_name):
                 show_method = getattr(self, show_method_name)
                 templates.header(wfile)
-                show_method(session_id, wfile, sort_by, order)
+                show_method(session_id, wfile, sort_by, order, page)
                 templates.footer(wfile)
             else:
                 templates.header(wfile)
@@ -381,7 +408,7 @@ class List(Location):
             path = lib.join_url(Login.path, values)
             self.redirect(path)
 
-    def _show_new(self, session_id, wfile, sort_by, order):
+    def _show_new(self, session_id, wfile, sort_by, order, page):
         if not sort_by:
             sort_by = "category"
         if not order:
@@ -389,9 +416,9 @@ class List(Location):
         search = application.Search(
             ("bug_id", "category", "reported_in", "title"),
             sort_by, order, status="new")
-        self.application.search(session_id, search)
-        templates.title(wfile, "All new bugs (%d)" % len(search.rows))
-        if search.rows:
+        self.search(session_id, search, page)
+        templates.title(wfile, "All new bugs (%d)" % search.total)
+        if search.total:
             templates.bullets(
                 wfile,
                 "Bugs that are new and need to be reviewed.")
@@ -400,7 +427,7 @@ class List(Location):
         else:
             templates.paragraph(wfile, "There are no new bugs.")
 
-    def _show_reviewed(self, session_id, wfile, sort_by, order):
+    def _show_reviewed(self, session_id, wfile, sort_by, order, page):
         if not sort_by:
             sort_by = "priority"
         if not order:
@@ -408,9 +435,9 @@ class List(Location):
         search = application.Search(
             ("bug_id", "priority", "category", "reported_in", "title"),
             sort_by, order, status="reviewed")
-        self.application.search(session_id, search)
-        templates.title(wfile, "All reviewed bugs (%d)" % len(search.rows))
-        if search.rows:
+        self.search(session_id, search, page)
+        templates.title(wfile, "All reviewed bugs (%d)" % search.total)
+        if search.total:
             templates.bullets(
                 wfile,
                 "Bugs that are ready to be scheduled.")
@@ -420,7 +447,7 @@ class List(Location):
             templates.paragraph(wfile,
                                 "There are no bugs in the reviewed state.")
 
-    def _show_scheduled(self, session_id, wfile, sort_by, order):
+    def _show_scheduled(self, session_id, wfile, sort_by, order, page):
         if not sort_by:
             sort_by = "priority"
         if not order:
@@ -428,9 +455,9 @@ class List(Location):
         search = application.Search(
             ("bug_id", "priority", "category", "reported_in", "title"),
             sort_by, order, status="scheduled")
-        self.application.search(session_id, search)
-        templates.title(wfile, "All scheduled bugs (%d)" % len(search.rows))
-        if search.rows:
+        self.search(session_id, search, page)
+        templates.title(wfile, "All scheduled bugs (%d)" % search.total)
+        if search.total:
             templates.bullets(
                 wfile,
                 "Bugs that are ready to be fixed.")
@@ -441,7 +468,7 @@ class List(Location):
                 wfile,
                 "There are no bugs scheduled to be fixed.")
 
-    def _show_fixed(self, session_id, wfile, sort_by, order):
+    def _show_fixed(self, session_id, wfile, sort_by, order, page):
         if not sort_by:
             sort_by = "fixed_in"
         if not order:
@@ -449,9 +476,9 @@ class List(Location):
         search = application.Search(
             ("bug_id", "priority", "resolution", "category", "fixed_in", "title"),
             sort_by, order, status="fixed")
-        self.application.search(session_id, search)
-        templates.title(wfile, "All fixed bugs (%d)" % len(search.rows))
-        if search.rows:
+        self.search(session_id, search, page)
+        templates.title(wfile, "All fixed bugs (%d)" % search.total)
+        if search.total:
             templates.bullets(
                 wfile,
                 "Bugs that are ready to be tested.")
@@ -462,7 +489,7 @@ class List(Location):
                 wfile,
                 "There are no bugs waiting to be tested.")
 
-    def _show_closed(self, session_id, wfile, sort_by, order):
+    def _show_closed(self, session_id, wfile, sort_by, order, page):
         if not sort_by:
             sort_by = "tested_ok_in"
         if not order:
@@ -470,9 +497,9 @@ class List(Location):
         search = application.Search(
             ("bug_id", "priority", "resolution", "category", "tested_ok_in", "title"),
             sort_by, order, status="closed")
-        self.application.search(session_id, search)
-        templates.title(wfile, "All closed bugs (%d)" % len(search.rows))
-        if search.rows:
+        self.search(session_id, search, page)
+        templates.title(wfile, "All closed bugs (%d)" % search.total)
+        if search.total:
             templates.bullets(
                 wfile,
                 "Bugs which require no further action.")
@@ -593,19 +620,23 @@ class View(Location):
         if comment:
             changes["comment"] = comment
             
+        # The bug is re-read by change(), so remember its old values.
+        old_values = {}
+        for variable in changes:
+            if variable != "comment":
+                old_values[variable] = getattr(old_bug, variable)
         if changes:
             old_bug.change(user, **changes)
-        self._report_on_changes(session_id, old_bug, changes, wfile)
+        self._report_on_changes(old_bug, old_values, changes, wfile)
         
-    def _report_on_changes(self, session_id, old_bug, changes, wfile):
-        new_bug = self.application.get_bug(session_id, old_bug.bug_id)
+    def _report_on_changes(self, bug, old_values, changes, wfile):
         if changes:
             templates.title(wfile, "Bug update successful")
             bullet_items = []
             if changes.pop("comment", None):
                 bullet_items.append("Added new comment.")
             for variable, new_value in changes.iteritems():
-                old_value = getattr(old_bug, variable)
+                old_value = old_values[variable]
                 variable = variable.capitalize().replace("_", " ")
                 if old_value and new_value:
                     bullet_items.append('Changed "%s" from %s to %s.' % \
@@ -620,8 +651,8 @@ class View(Location):
         else:
             templates.title(wfile, "No update needed")
         templates.hrule(wfile)
-        templates.title(wfile, new_bug.title)
-        self._show_status_and_comments_and_form(wfile, new_bug)
+        templates.title(wfile, bug.title)
+        self._show_status_and_comments_and_form(wfile, bug)
 
     def handle_post(self, session_id, values, post_data, wfile):
         user = self.application.get_user(session_id)
@@ -717,6 +748,7 @@ class New(Location):
 class Search(Location):
 
     path = "/search"    
+    streaming = True
 
     def handle_get(self, session_id, values, wfile):
         self._reload_if_url_can_be_simplified(values)
@@ -749,6 +781,10 @@ class Search(Location):
             'All criteria are combined with "And".',
             'Blank fields are ignored.',
             'Searches are case insensitive.',
+            '"Words" finds bugs with all the words in their title or '
+            'comments, most relevant first. Use "quotes" for a phrase, '
+            'a trailing * for words starting with a prefix, and a '
+            'leading - to exclude a word.',
             'The "regex" fields are for advanced searches '
             '(and may be ignored).')
         templates.search_form(wfile, self.path, values,
@@ -760,8 +796,13 @@ class Search(Location):
                               self.application.versions)
             
     def _search(self, session_id, wfile, values):
-        sort_by = values.pop("sort_by", "bug_id")
-        order = values.pop("order", "ascending")
+        if "text" in values:
+            sort_by = values.pop("sort_by", "relevance")
+            order = values.pop("order", "descending")
+        else:
+            sort_by = values.pop("sort_by", "bug_id")
+            order = values.pop("order", "ascending")
+        page = values.pop("page", "1")
 
         criteria = {}
         columns = ["bug_id", "title"]
@@ -774,10 +815,10 @@ class Search(Location):
         
         search = application.Search(columns, sort_by, order, **criteria)
         try:
-            self.application.search(session_id, search)
-            templates.title(wfile, "Search result (%d)" % len(search.rows))
+            self.search(session_id, search, page)
+            templates.title(wfile, "Search result (%d)" % search.total)
             self._pretty_print_search(wfile, criteria, values)
-            if search.rows:
+            if search.total:
                 url = lib.join_url(self.path, values)
                 templates.table_of_bugs(wfile, url, search)
             else:
@@ -793,11 +834,14 @@ class Search(Location):
             templates.paragraph(
                 wfile,
                 "Malformed regex expressions are a probable cause. "
-                "For example, mismatched parentheses.")
+                "For example, mismatched parentheses. Otherwise, the "
+                '"Words" field may have no words at all.')
 
     def _pretty_print_search(self, wfile, criteria, values):
 
         def clean_name(s):
+            if s == "text":
+                return "Words"
             s = s.replace("regex", "(regex)")
             s = s.replace("_", " ")
             return s.capitalize()
@@ -828,7 +872,9 @@ class History(Location):
                 '<a href="/changes">Recent changes</a> made to bugs</a>,'
                 ' including addition of new bugs.',
                 '<a href="/progress">Daily  progress</a>, as indicated'
-                ' by changes in the number of bugs in each status</a>.')
+                ' by changes in the number of bugs in each status</a>.',
+                '<a href="/status">Status</a> of the jobs which'
+                ' maintain this history.')
             templates.footer(wfile)
         else:
             values["next"] = self.path
@@ -838,6 +884,7 @@ class History(Location):
 class Changes(Location):
 
     path = "/changes"
+    streaming = True
 
     def handle_get(self, session_id, values, wfile):
         user = self.application.get_user(session_id)
@@ -900,29 +947,61 @@ class Progress(Location):
             path = lib.join_url(Login.path, values)
             self.redirect(path)
 
+
+
+class Status(Location):
+
+    path = "/status"
+
+    def handle_get(self, session_id, values, wfile):
+        jobs = self.application.get_scheduled_jobs(session_id)
+        if jobs is not None:
+            templates.header(wfile)
+            templates.title(wfile, "Status")
+            templates.bullets(
+                wfile,
+                "The following table shows the jobs run in the background"
+                " to maintain the database, as of when this page was"
+                " generated.",
+                "All times are those of the server.")
+            if len(jobs.rows) > 0:
+                templates.table_of_jobs(wfile, jobs)
+            else:
+                templates.paragraph(wfile, "There are no jobs.")
+            stats = self.application.get_result_cache_stats(session_id)
+            templates.paragraph(
+                wfile,
+                "The cache of results holds %(results)d results in"
+                " %(size)d of %(max_size)d bytes, after %(hits)d hits,"
+                " %(misses)d misses and %(evictions)d evictions."
+                " The data has changed %(generation)d times since"
+                " the server started." % stats)
+            templates.footer(wfile)
+        else:
+            values["next"] = self.path
+            path = lib.join_url(Login.path, values)
+            self.redirect(path)
+
         
 class Images(Location):
 
     path = "/images"    
+    static = True
 
-    def handle_get(self, session_id, values, wfile):
+    def get_asset(self, values):
         name = values.get("name", None)
         if name:
-            f = file(os.path.join(config.Presentation.directory, "%s" % name))
-            wfile.write(f.read())
-            f.close()
+            return static.get(name)
+        return None
 
 
 class DefaultCSS(Location):
 
     path = "/default.css"
-    mime_type = "text/css"
+    static = True
 
-    def handle_get(self, session_id, values, wfile):
-        filename = os.path.join(config.Presentation.directory, "default.css")
-        f = file(filename)
-        wfile.write(f.read())
-        f.close()
+    def get_asset(self, values):
+        return static.get("default.css")
 
 
 class Help(Location):
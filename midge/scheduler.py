@@ -0,0 +1,198 @@
+# $Id$
+# (C) Timothy Corbett-Clark, 2004
+
+"""Run named jobs periodically, independently of serving requests.
+
+Jobs are run one at a time by the scheduler's own thread, so that
+slow maintenance (e.g. taking a snapshot of progress) never holds up
+a request. With a connection.Pool, the thread therefore also uses its
+own database connection, which the release function given to the
+Scheduler returns to the pool after every job.
+
+Each job has an interval between runs, plus an optional random jitter
+which is added to every interval so that several midged processes
+sharing a database do not all run the same job at once. An aligned
+job runs at whole multiples of its interval (e.g. every hour on the
+hour) rather than an interval after its previous run.
+
+"""
+
+import random
+import threading
+import time
+
+import midge.logger as logger
+
+
+class Job(object):
+
+    """A named function to be run periodically, with metrics of its runs."""
+
+    def __init__(self, name, function, interval, jitter=0, aligned=False):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.jitter = jitter
+        self.aligned = aligned
+        self.next_run = None
+        self.last_run = None
+        self.last_duration = None
+        self.max_duration = None
+        self.total_duration = 0.0
+        self.last_error = None
+        self.n_runs = 0
+        self.n_failures = 0
+        self.running = False
+
+    def schedule(self, now):
+        """Set the time of the next run, being the first after now."""
+        if self.aligned:
+            next_run = now - now % self.interval + self.interval
+        else:
+            next_run = now + self.interval
+        if self.jitter:
+            next_run += random.uniform(0, self.jitter)
+        self.next_run = next_run
+
+    def _get_mean_duration(self):
+        if self.n_runs == 0:
+            return None
+        return self.total_duration / self.n_runs
+
+    mean_duration = property(_get_mean_duration)
+
+    def record(self, start, duration, error):
+        self.last_run = start
+        self.last_duration = duration
+        self.total_duration += duration
+        if self.max_duration is None or duration > self.max_duration:
+            self.max_duration = duration
+        self.n_runs += 1
+        self.last_error = error
+        if error is not None:
+            self.n_failures += 1
+
+
+class Scheduler(object):
+
+    """Run jobs in a background thread, each when it falls due."""
+
+    def __init__(self, release=None):
+        self.release = release
+        self._jobs = {}
+        self._condition = threading.Condition(threading.Lock())
+        self._stopping = False
+        self._thread = None
+
+    def add(self, name, function, interval, jitter=0, aligned=False):
+        """Add a job, replacing any previous job of the same name."""
+        job = Job(name, function, interval, jitter, aligned)
+        self._condition.acquire()
+        try:
+            job.schedule(time.time())
+            self._jobs[name] = job
+            self._condition.notify()
+        finally:
+            self._condition.release()
+        return job
+
+    def get_jobs(self):
+        """Return all the jobs, in order of name."""
+        self._condition.acquire()
+        try:
+            names = self._jobs.keys()
+            names.sort()
+            return [self._jobs[name] for name in names]
+        finally:
+            self._condition.release()
+
+    def _take_due_jobs(self, now):
+        """Return the jobs due by now, marking them as running."""
+        due = [job for job in self._jobs.itervalues()
+               if job.next_run <= now and not job.running]
+        due.sort(lambda a, b: cmp(a.next_run, b.next_run))
+        for job in due:
+            job.running = True
+        return due
+
+    def run_job(self, job):
+        logger.debug("Running scheduled job %s" % job.name)
+        error = None
+        start = time.time()
+        try:
+            try:
+                job.function()
+            except:
+                lines = logger.get_exception_as_lines()
+                for line in lines:
+                    logger.error(line)
+                error = lines[-1].strip()
+        finally:
+            if self.release is not None:
+                self.release()
+        duration = time.time() - start
+        self._condition.acquire()
+        try:
+            job.record(start, duration, error)
+            job.schedule(time.time())
+            job.running = False
+        finally:
+            self._condition.release()
+
+    def run_pending(self, now=None):
+        """Run every job which is due, in the current thread."""
+        if now is None:
+            now = time.time()
+        self._condition.acquire()
+        try:
+            due = self._take_due_jobs(now)
+        finally:
+            self._condition.release()
+        for job in due:
+            self.run_job(job)
+
+    def _run(self):
+        while True:
+            self._condition.acquire()
+            try:
+                while not self._stopping:
+                    now = time.time()
+                    due = self._take_due_jobs(now)
+                    if due:
+                        break
+                    next_runs = [job.next_run for job in
+                                 self._jobs.itervalues() if not job.running]
+                    if next_runs:
+                        self._condition.wait(min(next_runs) - now)
+                    else:
+                        self._condition.wait()
+                if self._stopping:
+                    return
+            finally:
+                self._condition.release()
+            for job in due:
+                self.run_job(job)
+
+    def start(self):
+        """Start running the jobs in the background."""
+        self._condition.acquire()
+        try:
+            self._stopping = False
+        finally:
+            self._condition.release()
+        self._thread = threading.Thread(target=self._run, name="scheduler")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop running jobs, waiting for any which is in progress."""
+        if self._thread is None:
+            return
+        self._condition.acquire()
+        try:
+            self._stopping = True
+            self._condition.notify()
+        finally:
+            self._condition.release()
+        self._thread.join()
+        self._thread = None
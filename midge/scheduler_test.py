@@ -0,0 +1,68 @@
+# $Id$
+# (C) Timothy Corbett-Clark, 2004
+
+import threading
+import unittest
+
+import midge.scheduler as scheduler
+
+
+class SchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.n_releases = 0
+        self.scheduler = scheduler.Scheduler(self.release)
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def release(self):
+        self.n_releases += 1
+
+    def test_schedule(self):
+        """Check jobs are scheduled after their interval"""
+        job = scheduler.Job("job", None, 60)
+        job.schedule(1000)
+        self.assertEqual(job.next_run, 1060)
+        job = scheduler.Job("job", None, 60, jitter=10)
+        job.schedule(1000)
+        self.assert_(1060 <= job.next_run <= 1070)
+        job = scheduler.Job("job", None, 3600, aligned=True)
+        job.schedule(3600 * 5 + 1)
+        self.assertEqual(job.next_run, 3600 * 6)
+
+    def test_run_pending(self):
+        """Check only due jobs are run, and their runs recorded"""
+        runs = []
+        job = self.scheduler.add("job", lambda: runs.append(1), 60)
+        self.scheduler.run_pending(job.next_run - 1)
+        self.assertEqual(runs, [])
+        self.scheduler.run_pending(job.next_run)
+        self.assertEqual(runs, [1])
+        self.assertEqual(job.n_runs, 1)
+        self.assertEqual(job.n_failures, 0)
+        self.assertEqual(self.n_releases, 1)
+        self.assert_(job.last_duration >= 0)
+        self.assert_(job.next_run > job.last_run)
+
+    def test_failure(self):
+        """Check a failing job is recorded and rescheduled"""
+        def fail():
+            raise ValueError, "failed"
+        job = self.scheduler.add("job", fail, 60)
+        self.scheduler.run_pending(job.next_run)
+        self.assertEqual(job.n_runs, 1)
+        self.assertEqual(job.n_failures, 1)
+        self.assert_("failed" in job.last_error)
+        self.assertEqual(self.n_releases, 1)
+        self.assertNotEqual(job.next_run, None)
+
+    def test_background(self):
+        """Check jobs are run by the scheduler's thread"""
+        ran = threading.Event()
+        self.scheduler.add("job", ran.set, 0.01)
+        self.scheduler.start()
+        ran.wait(5)
+        self.assert_(ran.isSet())
+        self.scheduler.stop()
+        self.assertEqual(self.scheduler.get_jobs()[0].running, False)
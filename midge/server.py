@@ -4,25 +4,44 @@
 """An HTTP server with session management."""
 
 import BaseHTTPServer
+import Queue
 import cStringIO
-import random
-import select
-import sys
+import socket
 import threading
-import time
 import traceback
 import urllib
+import zlib
 
 import midge.config as config
 import midge.lib as lib
 import midge.logger as logger
+import midge.static as static
 
 
 class Sessions(object):
 
+    """Validate the sessions of requests and serialise access to each.
+
+    The sessions themselves are kept by the application's session
+    store. Each session additionally has a lock, held for the whole of
+    a request, so that requests of different sessions may be handled
+    concurrently whilst requests of the same session (e.g. a login
+    followed by a redirect) are not. The global lock only protects the
+    table of these locks, each of which is discarded when no longer
+    in use.
+
+    Expired sessions are retired by a job of the application's
+    scheduler.
+
+    """
+
+    # Seconds between checks for expired sessions.
+    expiry_interval = 60
+
     def __init__(self, application):
         self.application = application
-        self.session_ids = {}
+        self.store = application.session_store
+        self._session_locks = {}
         self._lock = threading.Lock()
 
     def acquire_lock(self):
@@ -31,52 +50,49 @@ class Sessions(object):
     def release_lock(self):
         self._lock.release()
 
-    def _generate_session_id(self):
-        session_id = str(random.randint(0, sys.maxint))
-        while session_id in self.session_ids:
-            session_id = str(random.randint(0, sys.maxint))
-        logger.debug("Generating new session: %s" % session_id)
-        self._refresh_session(session_id)
-        self.application.new_session(session_id)
-        return session_id
-
-    def _retire_session(self, session_id):
+    def acquire_session_lock(self, session_id):
+        self.acquire_lock()
         try:
-            del self.session_ids[session_id]
-            logger.debug("Retiring session: %s" % session_id)
-            self.application.expired_session(session_id)
-        except KeyError:
-            pass
-
-    def _retire_expired_sessions(self):
-        t0 = time.time()
-        for session_id, expire_time in self.session_ids.items():
-            if t0 > expire_time:
-                self._retire_session(session_id)
-
-    def _refresh_session(self, session_id):
-        self.session_ids[session_id] = time.time() + \
-                                       60 * config.Server.session_timeout
-    
-    def get_valid_session_id(self, proposed_session_id):
-        self._retire_expired_sessions()
-        if proposed_session_id is None:
-            valid_session_id = self._generate_session_id()
-        elif proposed_session_id in self.session_ids:
-            self._refresh_session(proposed_session_id)
-            valid_session_id = proposed_session_id
-        else:
-            valid_session_id = self._generate_session_id()
-        return valid_session_id
+            lock_and_count = self._session_locks.get(session_id, None)
+            if lock_and_count is None:
+                lock_and_count = [threading.Lock(), 0]
+                self._session_locks[session_id] = lock_and_count
+            lock_and_count[1] += 1
+        finally:
+            self.release_lock()
+        lock_and_count[0].acquire()
 
-    def do_maintenance(self):
+    def release_session_lock(self, session_id):
         self.acquire_lock()
         try:
-            logger.info("Scheduled maintenance")
-            self.application.do_maintenance()
+            lock_and_count = self._session_locks[session_id]
+            lock_and_count[1] -= 1
+            if lock_and_count[1] == 0:
+                del self._session_locks[session_id]
+            lock_and_count[0].release()
         finally:
             self.release_lock()
 
+    def get_valid_session_id(self, cookie):
+        """Return the session_id of the cookie, or of a new session."""
+        session_id = None
+        if cookie is not None:
+            session_id = self.store.load(cookie)
+        if session_id is None:
+            session_id = self.store.create()
+            logger.debug("Generating new session: %s" % session_id)
+            self.application.new_session(session_id)
+        return session_id
+
+    def get_cookie(self, session_id):
+        return self.store.get_cookie(session_id)
+
+    def retire_expired_sessions(self):
+        self.store.flush()
+        for session_id in self.store.get_expired():
+            logger.debug("Retiring session: %s" % session_id)
+            self.application.expired_session(session_id)
+
 
 class RedirectException(Exception):
 
@@ -85,13 +101,99 @@ class RedirectException(Exception):
         Exception.__init__(self)
         
 
+class StreamingResponse(object):
+
+    """A file-like object which streams a response to the client.
+
+    The headers are not sent until there is output to follow them, so
+    a Location may still raise a RedirectException provided it has
+    not yet written anything. Output is gathered into chunks of about
+    chunk_size bytes, each sent as it fills, and using the chunked
+    transfer encoding if the client speaks HTTP/1.1. Otherwise the
+    end of the response is marked by closing the connection.
+
+    If compressed, each chunk is flushed through the compressor as it
+    is sent, so the client can still render the page as it arrives.
+
+    """
+
+    chunk_size = 8192
+
+    def __init__(self, handler, session_id, mime_type):
+        self.handler = handler
+        self.session_id = session_id
+        self.mime_type = mime_type
+        self.started = False
+        self.chunked = False
+        self._compressor = None
+        self._pieces = []
+        self._size = 0
+
+    def write(self, data):
+        self._pieces.append(data)
+        self._size += len(data)
+        if self._size >= self.chunk_size:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _start(self):
+        self.started = True
+        self.handler.send_standard_headers(self.session_id, self.mime_type)
+        if self.handler.negotiate_compression(self._size):
+            self._compressor = lib.make_gzip_compressor(
+                config.Server.compression_level)
+        self.chunked = self.handler.can_send_chunked()
+        if self.chunked:
+            self.handler.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.handler.close_connection = 1
+        self.handler.end_headers()
+
+    def _send(self, data):
+        if not data:
+            # Not least because an empty chunk marks the end.
+            return
+        if self.chunked:
+            self.handler.wfile.write("%x\r\n%s\r\n" % (len(data), data))
+        else:
+            self.handler.wfile.write(data)
+
+    def flush(self):
+        if not self._pieces:
+            return
+        if not self.started:
+            self._start()
+        data = "".join(self._pieces)
+        self._pieces = []
+        self._size = 0
+        if self._compressor is not None:
+            data = self._compressor.compress(data) + \
+                   self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self._send(data)
+
+    def close(self):
+        """Send any remaining output and mark the end of the response."""
+        if not self.started:
+            self._start()
+        self.flush()
+        if self._compressor is not None:
+            self._send(self._compressor.flush())
+        if self.chunked:
+            self.handler.wfile.write("0\r\n\r\n")
+
+
 class HttpCodes:
 
     # HTTP 1.1 Protocol: http://www.w3.org/Protocols/rfc2616/rfc2616.html
 
     OK = 200
     SeeOther = 303
+    NotModified = 304
     NotFound = 404
+    LengthRequired = 411
     
 
 class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
@@ -99,36 +201,237 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     SERVER_NAME = "midge server"
     SESSION_COOKIE_NAME = "midge_session"
 
+    # Seconds for which browsers may cache a versioned static file.
+    MAX_CACHE_AGE = 365 * 24 * 60 * 60
+
+    # Use persistent connections, where every response is delimited by
+    # its Content-Length or chunked encoding.
+    protocol_version = "HTTP/1.1"
+
     # The class variables are set by the Server class.
-    # Note that the RequestHandler is reinstantiated every GET/POST etc.
+    # Note that the RequestHandler is reinstantiated every connection,
+    # which may carry several GET/POST etc.
     _locations = None
     _sessions = None
 
-    def _send_standard_header(self, session_id, mime_type):
+    # Seconds an idle connection is kept open, waiting for its next
+    # request, or None to wait indefinitely.
+    keep_alive_timeout = None
+
+    # Seconds a request may stall, whilst it is read or its response
+    # written, before its connection is dropped. Generous, for clients
+    # on slow links.
+    request_timeout = 600
+
+    # Maximum number of requests served over one connection.
+    max_requests = 1
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.n_requests = 0
+
+    def handle(self):
+        """Handle the requests of the connection, until it is closed.
+
+        Whilst waiting for its next request, a connection occupies a
+        thread. So it is closed, rather than kept open, whenever other
+        connections are waiting for a thread.
+
+        """
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection and \
+                  not self.server.has_waiting_requests():
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        """Read and handle a single request.
+
+        As BaseHTTPRequestHandler.handle_one_request, except that only
+        the wait for the request line is limited to keep_alive_timeout.
+        The rest of the request (e.g. a POST body arriving in pieces)
+        and its response are only limited to request_timeout.
+
+        """
+        self.connection.settimeout(self.keep_alive_timeout)
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout:
+            # Idle for too long.
+            self.close_connection = 1
+            return
+        self.connection.settimeout(self.request_timeout)
+        try:
+            if len(self.raw_requestline) > 65536:
+                self.requestline = ""
+                self.request_version = ""
+                self.command = ""
+                self.send_error(414)
+                return
+            if not self.raw_requestline:
+                self.close_connection = 1
+                return
+            if not self.parse_request():
+                # An error has been sent.
+                return
+            method = getattr(self, "do_" + self.command, None)
+            if method is None:
+                self.send_error(501, "Unsupported method (%r)" %
+                                self.command)
+                return
+            method()
+            self.wfile.flush()
+        except socket.timeout:
+            logger.info("Request timed out, so dropping connection: %s" %
+                        self.requestline)
+            self.close_connection = 1
+
+    def end_headers(self):
+        self.n_requests += 1
+        if self.n_requests >= self.max_requests or \
+               self.server.has_waiting_requests():
+            self.close_connection = 1
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        elif self.request_version < "HTTP/1.1":
+            self.send_header("Connection", "keep-alive")
+        BaseHTTPServer.BaseHTTPRequestHandler.end_headers(self)
+
+    def _send_body(self, body):
+        """Send the Content-Length header, end the headers, then the body."""
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_standard_headers(self, session_id, mime_type):
         self.send_response(HttpCodes.OK)
         self.send_header("Content-type", "%s; charset=utf-8" % mime_type)
         self.send_header("Server", self.SERVER_NAME)
-        self.send_header("Set-Cookie", "%s=%s" % (self.SESSION_COOKIE_NAME,
-                                                  session_id))
-        self.end_headers()
-
-    def _send_redirect(self, path):
+        self._send_session_cookie(session_id)
+
+    def _send_session_cookie(self, session_id):
+        self.send_header("Set-Cookie", "%s=%s; Path=/; HttpOnly" % (
+            self.SESSION_COOKIE_NAME, self._sessions.get_cookie(session_id)))
+
+    def _accepts_gzip(self):
+        for coding in self.headers.get("Accept-Encoding", "").split(","):
+            parameters = coding.split(";")
+            if parameters[0].strip().lower() in ("gzip", "x-gzip"):
+                for parameter in parameters[1:]:
+                    parameter = parameter.strip()
+                    if parameter.startswith("q="):
+                        try:
+                            return float(parameter[2:]) > 0
+                        except ValueError:
+                            return False
+                return True
+        return False
+
+    def _compresses(self, size):
+        """Return whether to compress a response of about the given size.
+
+        It is compressed if the client accepts gzip encoding, and it is
+        big enough to be worth the bother.
+
+        """
+        return config.Server.compression_level > 0 and \
+               size >= config.Server.compression_threshold and \
+               self._accepts_gzip()
+
+    def negotiate_compression(self, size):
+        """Send the headers for, and return whether to use, compression."""
+        if config.Server.compression_level <= 0:
+            return False
+        self.send_header("Vary", "Accept-Encoding")
+        if self._compresses(size):
+            self.send_header("Content-Encoding", "gzip")
+            return True
+        return False
+
+    def can_send_chunked(self):
+        """Return whether the response may use chunked transfer encoding."""
+        return self.protocol_version >= "HTTP/1.1" and \
+               self.request_version >= "HTTP/1.1"
+
+    def _send_page(self, session_id, mime_type, page):
+        self.send_standard_headers(session_id, mime_type)
+        if self.negotiate_compression(len(page)):
+            page = lib.gzip_compress(page, config.Server.compression_level)
+        self._send_body(page)
+
+    def _send_redirect(self, path, session_id):
         logger.debug("Redirect to: %s" % path)
         self.send_response(HttpCodes.SeeOther)
         self.send_header("Content-type", "text/html")
         self.send_header("Server", self.SERVER_NAME)
+        # E.g. a login followed by a redirect changes the cookie.
+        self._send_session_cookie(session_id)
         self.send_header("Location", path)
-        self.end_headers()
+        self._send_body("")
 
     def _send_no_such_location(self, path):
         logger.info("No such location: %s" % path)
         self.send_response(HttpCodes.NotFound)
         self.send_header("Content-type", "text/html")
         self.send_header("Server", self.SERVER_NAME)
-        self.end_headers()
-        self.wfile.write("<html><body><h1>No such location!</h1>"
-                         "<p>The location <b>%s</b> does not exist." % path)
-        self.wfile.write("</body></html>")
+        self._send_body("<html><body><h1>No such location!</h1>"
+                        "<p>The location <b>%s</b> does not exist."
+                        "</body></html>" % lib.html_entity_escape(path))
+
+    def _send_asset(self, location, values):
+        """Send a static file, or just confirm the client's copy is current.
+
+        A url including the file's current version may be cached for
+        ever, otherwise the client must check for a new version.
+
+        """
+        asset = location.get_asset(values)
+        if asset is None:
+            self._send_no_such_location(self.path)
+            return
+        if values.get("v", None) == asset.version:
+            cache_control = "public, max-age=%d" % self.MAX_CACHE_AGE
+        else:
+            cache_control = "no-cache"
+        varies = asset.gzip_data is not None and \
+                 config.Server.compression_level > 0
+        compressed = varies and self._compresses(len(asset.data))
+        if compressed:
+            etag, data = asset.gzip_etag, asset.gzip_data
+        else:
+            etag, data = asset.etag, asset.data
+        not_modified = asset.matches(
+            self.headers.get("If-None-Match", None),
+            self.headers.get("If-Modified-Since", None))
+        if not_modified:
+            # Only the headers describing the client's copy, as there is
+            # no body (let alone an encoded one).
+            self.send_response(HttpCodes.NotModified)
+        else:
+            self.send_response(HttpCodes.OK)
+            self.send_header("Server", self.SERVER_NAME)
+            self.send_header("Content-type", asset.mime_type)
+            if compressed:
+                self.send_header("Content-Encoding", "gzip")
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", cache_control)
+        self.send_header("Last-Modified", asset.last_modified)
+        if varies:
+            self.send_header("Vary", "Accept-Encoding")
+        if not_modified:
+            self.end_headers()
+        else:
+            self._send_body(data)
+
+    def _send_length_required(self):
+        logger.info("Post without content length: %s" % self.path)
+        self.send_response(HttpCodes.LengthRequired)
+        self.send_header("Content-type", "text/html")
+        self.send_header("Server", self.SERVER_NAME)
+        # Any body sent cannot be found, let alone skipped.
+        self.close_connection = 1
+        self._send_body("<html><body><h1>Length required!</h1>"
+                        "</body></html>")
 
     def _send_exception(self):
         lines = logger.get_exception_as_lines()
@@ -137,21 +440,65 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         self.send_response(HttpCodes.OK)
         self.send_header("Content-type", "text/html")
         self.send_header("Server", self.SERVER_NAME)
-        self.end_headers()
-        self.wfile.write("<html><body><h1>Midge Error!</h1>")
-        self.wfile.write("It would appear that Midge is not completely "
-                         "free of bugs...")
-        self.wfile.write("<blockquote><pre>")
+        page = cStringIO.StringIO()
+        page.write("<html><body><h1>Midge Error!</h1>")
+        page.write("It would appear that Midge is not completely "
+                   "free of bugs...")
+        page.write("<blockquote><pre>")
         for line in lines:
-            self.wfile.write(line)
-            self.wfile.write("\n")
-        self.wfile.write("</pre></blockquote></body></html>")
+            page.write(line)
+            page.write("\n")
+        page.write("</pre></blockquote></body></html>")
+        self._send_body(page.getvalue())
 
-    def _extract_session_id(self):
+    def _abandon_response(self):
+        """Log an exception raised after a response was partly sent.
+
+        It is too late to send anything else, so the connection is
+        closed leaving the client with a (detectably) incomplete page.
+
+        """
+        for line in logger.get_exception_as_lines():
+            logger.error(line)
+        self.close_connection = 1
+
+    def _handle(self, session_id, location, handle, values):
+        """Call the location's handle method and send its response.
+
+        Locations are buffered, so that they may raise a
+        RedirectException at any point, unless they are streaming.
+
+        """
+        if location.streaming:
+            wfile = StreamingResponse(self, session_id, location.mime_type)
+        else:
+            wfile = cStringIO.StringIO()
+        try:
+            handle(session_id, values, wfile)
+            if location.streaming:
+                wfile.close()
+            else:
+                self._send_page(session_id, location.mime_type,
+                                wfile.getvalue())
+        except RedirectException, e:
+            if location.streaming and wfile.started:
+                logger.error("Redirect to %s after response started" % e.path)
+                self.close_connection = 1
+            else:
+                self._send_redirect(e.path, session_id)
+        except Exception:
+            if location.streaming and wfile.started:
+                self._abandon_response()
+            else:
+                self._send_exception()
+
+    def _extract_session_cookie(self):
         cookie = self.headers.get("Cookie", None)
         if cookie is not None:
             for key_value_pairs in cookie.split(";"):
-                key, value = key_value_pairs.split("=")
+                if "=" not in key_value_pairs:
+                    continue
+                key, value = key_value_pairs.split("=", 1)
                 if key.strip() == self.SESSION_COOKIE_NAME:
                     return value.strip()
         return None
@@ -164,64 +511,62 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         return post_data
 
     def do_GET(self):
-        self._sessions.acquire_lock()
+        path, values = lib.split_url(self.path)
+        location = self._locations.get(path)
+        if location and location.static:
+            # Static files need neither a session nor the application.
+            self._send_asset(location, values)
+            return
         try:
-            proposed_session_id = self._extract_session_id()
-            session_id = self._sessions.get_valid_session_id(
-                proposed_session_id)
-            path, values = lib.split_url(self.path)
-            host = self.client_address[0]
-            logger.debug("http get %s from host %s (session %s)" % (path,
-                                                                    host,
-                                                                    session_id))
-            location = self._locations.get(path)
-            if location:
-                try:
-                    wfile = cStringIO.StringIO()
-                    location.handle_get(session_id, values, wfile)
-                    self._send_standard_header(session_id, location.mime_type)
-                    self.wfile.write(wfile.getvalue())
-                except RedirectException, e:
-                    self._send_redirect(e.path)
-                except Exception:
-                    self._send_exception()
-            else:
-                self._send_no_such_location(self.path)
+            cookie = self._extract_session_cookie()
+            session_id = self._sessions.get_valid_session_id(cookie)
+            self._sessions.acquire_session_lock(session_id)
+            try:
+                host = self.client_address[0]
+                logger.debug("http get %s from host %s (session %s)" % (
+                    path, host, session_id))
+                if location:
+                    self._handle(session_id, location, location.handle_get,
+                                 values)
+                else:
+                    self._send_no_such_location(self.path)
+            finally:
+                self._sessions.release_session_lock(session_id)
         finally:
-            self._sessions.release_lock()
+            self._sessions.application.release()
         
     def do_POST(self):
-        self._sessions.acquire_lock()
         try:
-            proposed_session_id = self._extract_session_id()
-            session_id = self._sessions.get_valid_session_id(
-                proposed_session_id)
-            content_length = self.headers.dict.get("content-length", None)
-            if content_length is not None:
-                raw_post_data = self.rfile.read(int(content_length))
-                path, values = lib.split_url(self.path)
-                logger.debug(
-                    "http post %s for session: %s" % (path, session_id))
-                location = self._locations.get(path)
-                if location:
-                    try:
-                        wfile = cStringIO.StringIO()
-                        post_data = self._decode_raw_post_data(raw_post_data)
-                        location.handle_post(session_id, values,
-                                             post_data, wfile)
-                        self._send_standard_header(session_id, location.mime_type)
-                        self.wfile.write(wfile.getvalue())
-                    except RedirectException, e:
-                        self._send_redirect(e.path)
-                    except Exception:
-                        self._send_exception()
-                else:
-                    self._send_no_such_location(self.path)
-            else:
-                # TODO send an HTTP error code.
-                pass
+            cookie = self._extract_session_cookie()
+            session_id = self._sessions.get_valid_session_id(cookie)
+            self._sessions.acquire_session_lock(session_id)
+            try:
+                self._post(session_id)
+            finally:
+                self._sessions.release_session_lock(session_id)
         finally:
-            self._sessions.release_lock()
+            self._sessions.application.release()
+
+    def _post(self, session_id):
+        content_length = self.headers.dict.get("content-length", None)
+        if content_length is not None:
+            raw_post_data = self.rfile.read(int(content_length))
+            path, values = lib.split_url(self.path)
+            logger.debug(
+                "http post %s for session: %s" % (path, session_id))
+            location = self._locations.get(path)
+            if location:
+
+                def handle_post(session_id, values, wfile):
+                    post_data = self._decode_raw_post_data(raw_post_data)
+                    location.handle_post(session_id, values,
+                                         post_data, wfile)
+
+                self._handle(session_id, location, handle_post, values)
+            else:
+                self._send_no_such_location(self.path)
+        else:
+            self._send_length_required()
 
     def log_message(self, *args):
         pass
@@ -229,6 +574,10 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
 class MyHTTPServer(BaseHTTPServer.HTTPServer):
 
+    def has_waiting_requests(self):
+        """Return whether connections are waiting to be handled."""
+        return False
+
     def handle_error(self, request, client_address):
         logger.error("Request = %s" % str(request))
         logger.error("Client address = %s" % str(client_address))
@@ -237,20 +586,82 @@ class MyHTTPServer(BaseHTTPServer.HTTPServer):
             logger.error(line)
 
 
+class ThreadPoolHTTPServer(MyHTTPServer):
+
+    """An HTTP server which handles requests using a pool of threads.
+
+    The main thread only accepts connections; each request is then
+    queued and handled by the first free worker. The number of workers
+    bounds both the concurrency and the number of database connections
+    in use.
+
+    """
+    def __init__(self, server_address, RequestHandlerClass, n_threads):
+        MyHTTPServer.__init__(self, server_address, RequestHandlerClass)
+        self._requests = Queue.Queue()
+        self._workers = []
+        for i in range(n_threads):
+            worker = threading.Thread(target=self._work,
+                                      name="worker-%d" % i)
+            worker.setDaemon(True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def has_waiting_requests(self):
+        return not self._requests.empty()
+
+    def server_close(self):
+        for worker in self._workers:
+            self._requests.put(None)
+        MyHTTPServer.server_close(self)
+
+
 class Server(object):
 
     def __init__(self, application, locations):
         self.sessions = Sessions(application)
+        self.scheduler = application.scheduler
+        self.scheduler.add("expire-sessions",
+                           self.sessions.retire_expired_sessions,
+                           Sessions.expiry_interval,
+                           jitter=Sessions.expiry_interval / 10)
         RequestHandler._locations = self._get_locations(locations,
                                                         application)
         RequestHandler._sessions = self.sessions
+        static.load(config.Presentation.directory)
+        if config.Server.threads > 0:
+            RequestHandler.keep_alive_timeout = \
+                config.Server.keep_alive_timeout
+            RequestHandler.max_requests = config.Server.keep_alive_requests
         interface = config.Server.interface
         port = config.Server.port
         if interface:
             logger.info("Creating server on %s:%s" % (interface, port))
         else:
             logger.info("Creating server on all interfaces:%s" % port)
-        self.httpd = MyHTTPServer( (interface, port), RequestHandler)
+        if config.Server.threads > 0:
+            logger.info("Serving requests with %d threads" % \
+                        config.Server.threads)
+            self.httpd = ThreadPoolHTTPServer( (interface, port),
+                                               RequestHandler,
+                                               config.Server.threads)
+        else:
+            self.httpd = MyHTTPServer( (interface, port), RequestHandler)
 
     def _get_locations(self, locations, application):
         """Build a dictionary of Location's from the locations module."""
@@ -267,14 +678,9 @@ class Server(object):
 
     def start(self):
         logger.info("Starting server")
-        next_hour = lib.get_utc_time_of_next_hour()
-        while True:
-            rs, ws, es = select.select([self.httpd], [self.httpd], [], 1)
-            if rs or ws:
-                self.httpd.handle_request()
-            if lib.get_utc_time() > next_hour:
-                self.sessions.do_maintenance()
-                next_hour = lib.get_utc_time_of_next_hour()
+        self.scheduler.start()
+        self.httpd.serve_forever()
 
     def stop(self):
+        self.scheduler.stop()
         self.httpd.server_close()
@@ -0,0 +1,441 @@
+# $Id$
+# (C) Timothy Corbett-Clark, 2004
+
+import socket
+import threading
+import time
+import unittest
+import zlib
+
+import midge.config as config
+import midge.server as server
+import midge.sessions as sessions
+import midge.static as static
+
+
+class MockApplication(object):
+
+    def __init__(self):
+        self.session_store = sessions.MemoryStore()
+        self.n_releases = 0
+
+    def new_session(self, session_id):
+        pass
+
+    def expired_session(self, session_id):
+        self.session_store.remove(session_id)
+
+    def release(self):
+        self.n_releases += 1
+
+
+class MockLocation(object):
+
+    streaming = False
+    static = False
+    mime_type = "text/html"
+
+    def __init__(self, body):
+        self.body = body
+
+    def handle_get(self, session_id, values, wfile):
+        wfile.write(self.body)
+
+    def handle_post(self, session_id, values, post_data, wfile):
+        wfile.write("%s %s" % (self.body, post_data.get("text", "")))
+
+
+class MockStreamingLocation(MockLocation):
+
+    streaming = True
+
+
+class MockBrokenLocation(MockStreamingLocation):
+
+    """A streaming location which fails after its response has started."""
+
+    def handle_get(self, session_id, values, wfile):
+        wfile.write(self.body)
+        wfile.flush()
+        raise ValueError, "broken"
+
+
+class MockSlowLocation(MockLocation):
+
+    """A location which waits until told to go, before responding."""
+
+    def __init__(self, body):
+        MockLocation.__init__(self, body)
+        self.go = threading.Event()
+
+    def handle_get(self, session_id, values, wfile):
+        self.go.wait(10)
+        wfile.write(self.body)
+
+
+class MockAssetLocation(object):
+
+    static = True
+
+    def __init__(self, asset):
+        self.asset = asset
+
+    def get_asset(self, values):
+        return self.asset
+
+
+class Response(object):
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+class SessionsTests(unittest.TestCase):
+
+    def setUp(self):
+        config.read()
+        self.sessions = server.Sessions(MockApplication())
+
+    def get_count(self, session_id):
+        self.sessions.acquire_lock()
+        try:
+            lock_and_count = self.sessions._session_locks.get(session_id,
+                                                              None)
+        finally:
+            self.sessions.release_lock()
+        if lock_and_count is None:
+            return 0
+        return lock_and_count[1]
+
+    def test_lock_discarded(self):
+        """Check a session's lock is discarded once released"""
+        self.sessions.acquire_session_lock("a")
+        self.sessions.acquire_session_lock("b")
+        self.assertEqual(self.get_count("a"), 1)
+        self.sessions.release_session_lock("a")
+        self.assertEqual(self.sessions._session_locks.keys(), ["b"])
+        self.sessions.release_session_lock("b")
+        self.assertEqual(self.sessions._session_locks, {})
+
+    def test_lock_shared(self):
+        """Check a session's lock is kept while another request waits"""
+        order = []
+
+        def request():
+            self.sessions.acquire_session_lock("a")
+            order.append("second")
+            self.sessions.release_session_lock("a")
+
+        self.sessions.acquire_session_lock("a")
+        thread = threading.Thread(target=request)
+        thread.start()
+        while self.get_count("a") < 2:
+            time.sleep(0.01)
+        order.append("first")
+        self.sessions.release_session_lock("a")
+        thread.join(5)
+        self.assertEqual(order, ["first", "second"])
+        self.assertEqual(self.sessions._session_locks, {})
+
+
+class BaseTest(unittest.TestCase):
+
+    # Configuration of the server, for each test.
+    n_threads = 2
+    keep_alive_timeout = 5
+    max_requests = 100
+
+    def setUp(self):
+        config.read()
+
+        class Handler(server.RequestHandler):
+            pass
+
+        self.application = MockApplication()
+        self.asset = static.Asset("style.css", "a { color: red; }\n" * 100, 0)
+        self.slow = MockSlowLocation("slow")
+        Handler._locations = {
+            "/small": MockLocation("small"),
+            "/big": MockLocation("x" * 100000),
+            "/stream": MockStreamingLocation("y" * 20000),
+            "/broken": MockBrokenLocation("z" * 100),
+            "/style.css": MockAssetLocation(self.asset),
+            "/slow": self.slow}
+        Handler._sessions = server.Sessions(self.application)
+        Handler.keep_alive_timeout = self.keep_alive_timeout
+        Handler.max_requests = self.max_requests
+        self.handler_class = Handler
+        self.httpd = server.ThreadPoolHTTPServer(("127.0.0.1", 0), Handler,
+                                                 self.n_threads)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.sockets = []
+
+    def tearDown(self):
+        self.slow.go.set()
+        for s in self.sockets:
+            s.close()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def connect(self):
+        s = socket.create_connection(self.httpd.server_address, 5)
+        self.sockets.append(s)
+        return s, s.makefile("rb")
+
+    def send(self, s, path, version="HTTP/1.1", headers=()):
+        lines = ["GET %s %s" % (path, version), "Host: localhost"]
+        lines.extend(headers)
+        s.sendall("\r\n".join(lines) + "\r\n\r\n")
+
+    def read(self, rfile):
+        """Read a response, delimited as its headers say."""
+        status = int(rfile.readline().split()[1])
+        headers = {}
+        while True:
+            line = rfile.readline()
+            if line in ("\r\n", ""):
+                break
+            name, value = line.split(":", 1)
+            headers[name.lower()] = value.strip()
+        if "content-length" in headers:
+            body = rfile.read(int(headers["content-length"]))
+        elif headers.get("transfer-encoding", None) == "chunked":
+            body = ""
+            while True:
+                size = int(rfile.readline(), 16)
+                chunk = rfile.read(size + 2)
+                self.assertEqual(chunk[-2:], "\r\n")
+                if size == 0:
+                    break
+                body += chunk[:-2]
+        elif status == 304:
+            body = ""
+        else:
+            body = rfile.read()
+        return Response(status, headers, body)
+
+    def get(self, path, headers=()):
+        s, rfile = self.connect()
+        self.send(s, path, headers=headers)
+        return self.read(rfile)
+
+
+class ServerTests(BaseTest):
+
+    def test_keep_alive(self):
+        """Check several requests are served over one connection"""
+        s, rfile = self.connect()
+        for path, body in (("/small", "small"), ("/stream", "y" * 20000),
+                           ("/small", "small")):
+            self.send(s, path)
+            response = self.read(rfile)
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.body, body)
+            self.assertEqual(response.headers.get("connection", None), None)
+        self.assertEqual(self.application.n_releases, 3)
+
+    def test_content_length(self):
+        """Check buffered responses are delimited by their length"""
+        response = self.get("/small")
+        self.assertEqual(response.headers["content-length"], "5")
+        self.failIf("transfer-encoding" in response.headers)
+        self.assertEqual(response.body, "small")
+
+    def test_chunked(self):
+        """Check streamed responses are sent in chunks to HTTP/1.1"""
+        response = self.get("/stream")
+        self.assertEqual(response.headers["transfer-encoding"], "chunked")
+        self.failIf("content-length" in response.headers)
+        self.assertEqual(response.body, "y" * 20000)
+
+    def test_http_1_0(self):
+        """Check streamed responses end by closing for HTTP/1.0"""
+        s, rfile = self.connect()
+        self.send(s, "/stream", "HTTP/1.0")
+        response = self.read(rfile)
+        self.assertEqual(response.headers["connection"], "close")
+        self.failIf("transfer-encoding" in response.headers)
+        self.assertEqual(response.body, "y" * 20000)
+
+    def test_abandoned_response(self):
+        """Check a response failing after its headers is cut short"""
+        s, rfile = self.connect()
+        self.send(s, "/broken")
+        status = rfile.readline()
+        self.assert_(status.startswith("HTTP/1.1 200"))
+        response = rfile.read()
+        self.assert_("Transfer-Encoding: chunked\r\n" in response)
+        # The one chunk sent, but no last chunk after it.
+        self.assert_(response.endswith("\r\n\r\n64\r\n%s\r\n" %
+                                       ("z" * 100)))
+        self.assertEqual(self.application.n_releases, 1)
+        self.assertEqual(self.handler_class._sessions._session_locks, {})
+        # The server carries on serving other requests.
+        self.assertEqual(self.get("/small").body, "small")
+
+    def test_no_such_location(self):
+        """Check unknown locations are not found"""
+        response = self.get("/missing")
+        self.assertEqual(response.status, 404)
+        self.assert_("/missing" in response.body)
+
+
+class MaxRequestsTests(BaseTest):
+
+    max_requests = 2
+
+    def test_max_requests(self):
+        """Check the connection is closed after max_requests"""
+        s, rfile = self.connect()
+        self.send(s, "/small")
+        self.assertEqual(self.read(rfile).headers.get("connection", None),
+                         None)
+        self.send(s, "/small")
+        response = self.read(rfile)
+        self.assertEqual(response.headers["connection"], "close")
+        self.assertEqual(rfile.read(), "")
+
+
+class KeepAliveTimeoutTests(BaseTest):
+
+    keep_alive_timeout = 1
+
+    def test_idle_connection_closed(self):
+        """Check an idle connection is closed after keep_alive_timeout"""
+        s, rfile = self.connect()
+        self.send(s, "/small")
+        self.assertEqual(self.read(rfile).body, "small")
+        t0 = time.time()
+        self.assertEqual(rfile.read(), "")
+        self.assert_(time.time() - t0 < 3)
+
+    def test_slow_post(self):
+        """Check a POST body may arrive after keep_alive_timeout"""
+        s, rfile = self.connect()
+        body = "text=slowly"
+        s.sendall("POST /small HTTP/1.1\r\nHost: localhost\r\n"
+                  "Content-Length: %d\r\n\r\n" % len(body))
+        time.sleep(1.5)
+        s.sendall(body)
+        response = self.read(rfile)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.body, "small slowly")
+
+
+class OneThreadTests(BaseTest):
+
+    n_threads = 1
+
+    def test_idle_connection_yields(self):
+        """Check a connection is closed when others wait for a thread"""
+        s, rfile = self.connect()
+        self.send(s, "/slow")
+        other, other_rfile = self.connect()
+        self.send(other, "/small")
+        while not self.httpd.has_waiting_requests():
+            time.sleep(0.01)
+        self.slow.go.set()
+        response = self.read(rfile)
+        self.assertEqual(response.body, "slow")
+        self.assertEqual(response.headers["connection"], "close")
+        self.assertEqual(rfile.read(), "")
+        self.assertEqual(self.read(other_rfile).body, "small")
+
+
+class CompressionTests(BaseTest):
+
+    def setUp(self):
+        BaseTest.setUp(self)
+        self.level = config.Server.compression_level
+        self.threshold = config.Server.compression_threshold
+        config.Server.compression_level = 6
+        config.Server.compression_threshold = 1024
+
+    def tearDown(self):
+        config.Server.compression_level = self.level
+        config.Server.compression_threshold = self.threshold
+        BaseTest.tearDown(self)
+
+    def decompress(self, data):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+    def test_compressed(self):
+        """Check big responses are compressed for clients accepting gzip"""
+        response = self.get("/big", ["Accept-Encoding: deflate, gzip"])
+        self.assertEqual(response.headers["content-encoding"], "gzip")
+        self.assertEqual(response.headers["vary"], "Accept-Encoding")
+        self.assert_(len(response.body) < 100000)
+        self.assertEqual(self.decompress(response.body), "x" * 100000)
+
+    def test_streamed_compressed(self):
+        """Check streamed responses are compressed chunk by chunk"""
+        response = self.get("/stream", ["Accept-Encoding: gzip"])
+        self.assertEqual(response.headers["content-encoding"], "gzip")
+        self.assertEqual(response.headers["transfer-encoding"], "chunked")
+        self.assertEqual(self.decompress(response.body), "y" * 20000)
+
+    def test_below_threshold(self):
+        """Check responses below compression_threshold are not compressed"""
+        response = self.get("/small", ["Accept-Encoding: gzip"])
+        self.failIf("content-encoding" in response.headers)
+        self.assertEqual(response.headers["vary"], "Accept-Encoding")
+        self.assertEqual(response.body, "small")
+        config.Server.compression_threshold = 5
+        response = self.get("/small", ["Accept-Encoding: gzip"])
+        self.assertEqual(response.headers["content-encoding"], "gzip")
+        self.assertEqual(self.decompress(response.body), "small")
+
+    def test_not_accepted(self):
+        """Check responses are not compressed unless gzip is accepted"""
+        s, rfile = self.connect()
+        for headers in ([], ["Accept-Encoding: deflate"],
+                        ["Accept-Encoding: gzip;q=0"],
+                        ["Accept-Encoding: identity, gzip; q=0.0"],
+                        ["Accept-Encoding: gzip;q=bad"]):
+            self.send(s, "/big", headers=headers)
+            response = self.read(rfile)
+            self.failIf("content-encoding" in response.headers, headers)
+            self.assertEqual(response.body, "x" * 100000)
+        self.send(s, "/big", headers=["Accept-Encoding: gzip;q=0.5"])
+        response = self.read(rfile)
+        self.assertEqual(response.headers["content-encoding"], "gzip")
+
+    def test_disabled(self):
+        """Check nothing is compressed when compression_level is 0"""
+        config.Server.compression_level = 0
+        response = self.get("/big", ["Accept-Encoding: gzip"])
+        self.failIf("content-encoding" in response.headers)
+        self.failIf("vary" in response.headers)
+        self.assertEqual(response.body, "x" * 100000)
+
+    def test_asset(self):
+        """Check static files are compressed, with their own ETag"""
+        response = self.get("/style.css", ["Accept-Encoding: gzip"])
+        self.assertEqual(response.headers["content-encoding"], "gzip")
+        self.assertEqual(response.headers["etag"], self.asset.gzip_etag)
+        self.assertEqual(response.headers["vary"], "Accept-Encoding")
+        self.assertEqual(self.decompress(response.body), self.asset.data)
+
+    def test_asset_not_modified(self):
+        """Check a 304 sends only the headers describing the client's copy"""
+        s, rfile = self.connect()
+        for accept, etag in (("gzip", self.asset.gzip_etag),
+                             ("gzip;q=0", self.asset.etag)):
+            self.send(s, "/style.css",
+                      headers=["Accept-Encoding: %s" % accept,
+                               "If-None-Match: %s" % etag])
+            response = self.read(rfile)
+            self.assertEqual(response.status, 304)
+            self.assertEqual(response.body, "")
+            self.assertEqual(response.headers["etag"], etag)
+            self.assertEqual(response.headers["cache-control"], "no-cache")
+            self.assertEqual(response.headers["last-modified"],
+                             self.asset.last_modified)
+            self.assertEqual(response.headers["vary"], "Accept-Encoding")
+            for name in ("content-encoding", "content-type",
+                         "content-length", "transfer-encoding"):
+                self.failIf(name in response.headers, name)
@@ -0,0 +1,425 @@
+# $Id$
+# (C) Timothy Corbett-Clark, 2004
+
+"""Stores of sessions, and of the user (if any) logged-in to each.
+
+A session is identified by its session_id, and is known to the
+browser by a cookie, whose value is given by the store. Every session
+expires after config.Server.session_timeout minutes of inactivity.
+
+Three stores are provided, chosen by config.Server.session_store:
+
+  memory    Sessions are held by the midged process. Simple and fast,
+            but restarting midged logs everyone out.
+
+  database  Sessions are held in the sessions table, so that they
+            survive restarts and may be shared by several midged
+            processes. Refreshing a session's expiry is written back
+            in batches by flush(), rather than on every request.
+
+  cookie    Sessions are held in the cookie itself, signed with
+            config.Server.session_secret so they cannot be forged.
+            Any midged process with the same secret can serve any
+            request, and nothing need be stored at all. However,
+            logging out cannot invalidate a copy of an earlier cookie.
+
+Every store provides the methods of MemoryStore: load() (once per
+request) returns the session_id of a cookie if its session is valid,
+refreshing its expiry; create(), remove(), get_user_id() and
+set_user_id() manage the sessions; get_cookie() gives the cookie to
+send for a session; get_expired() returns the sessions to be retired
+(by calling the application's expired_session()); and flush() writes
+any buffered changes.
+
+"""
+
+import hmac
+import heapq
+import os
+import sha
+import threading
+import time
+
+import midge.config as config
+import midge.connection as connection
+import midge.logger as logger
+
+
+def _generate_session_id():
+    return os.urandom(16).encode("hex")
+
+
+def _get_expire_time():
+    return time.time() + 60 * config.Server.session_timeout
+
+
+class MemoryStore(object):
+
+    """Sessions held in memory.
+
+    Expiry is tracked by a heap of (expire_time, session_id). A refresh
+    pushes a new entry rather than moving the old one, which is
+    ignored once popped as it no longer matches the session. As every
+    session has the same timeout, the heap is also in order of least
+    recent use, so when there are too many sessions the least recently
+    used is evicted, and returned by the next get_expired() so that
+    it is retired like any other.
+
+    """
+    def __init__(self):
+        self._sessions = {}
+        self._expiry_heap = []
+        self._evicted = []
+        self._lock = threading.Lock()
+
+    def _refresh(self, session_id, user_id):
+        expire_time = _get_expire_time()
+        self._sessions[session_id] = (expire_time, user_id)
+        heapq.heappush(self._expiry_heap, (expire_time, session_id))
+        if len(self._expiry_heap) > 2 * len(self._sessions) + 100:
+            self._compact_expiry_heap()
+
+    def _compact_expiry_heap(self):
+        """Discard the entries superseded by later refreshes."""
+        self._expiry_heap = [(expire_time, session_id)
+                             for session_id, (expire_time, user_id)
+                             in self._sessions.iteritems()]
+        heapq.heapify(self._expiry_heap)
+
+    def _pop_oldest(self):
+        """Remove and return the id of the session next to expire."""
+        while self._expiry_heap:
+            expire_time, session_id = heapq.heappop(self._expiry_heap)
+            session = self._sessions.get(session_id, None)
+            if session is not None and session[0] == expire_time:
+                return session_id
+        return None
+
+    def load(self, cookie):
+        """Return the session_id of the cookie, or None if not valid.
+
+        A valid session has its expiry refreshed.
+
+        """
+        self._lock.acquire()
+        try:
+            session = self._sessions.get(cookie, None)
+            if session is None or session[0] < time.time():
+                return None
+            self._refresh(cookie, session[1])
+            return cookie
+        finally:
+            self._lock.release()
+
+    def create(self):
+        """Create a new session (without a user), returning its id."""
+        self._lock.acquire()
+        try:
+            while len(self._sessions) >= config.Server.max_sessions:
+                session_id = self._pop_oldest()
+                if session_id is None:
+                    break
+                logger.info("Too many sessions, so evicting: %s" % session_id)
+                del self._sessions[session_id]
+                self._evicted.append(session_id)
+            session_id = _generate_session_id()
+            self._refresh(session_id, None)
+            return session_id
+        finally:
+            self._lock.release()
+
+    def remove(self, session_id):
+        self._lock.acquire()
+        try:
+            self._sessions.pop(session_id, None)
+        finally:
+            self._lock.release()
+
+    def get_user_id(self, session_id):
+        session = self._sessions.get(session_id, None)
+        if session is None:
+            return None
+        return session[1]
+
+    def set_user_id(self, session_id, user_id):
+        """Set the user of the session, creating it if need be."""
+        self._lock.acquire()
+        try:
+            session = self._sessions.get(session_id, None)
+            if session is None:
+                self._refresh(session_id, user_id)
+            else:
+                self._sessions[session_id] = (session[0], user_id)
+        finally:
+            self._lock.release()
+
+    def get_cookie(self, session_id):
+        """Return the cookie value to send for the session."""
+        return session_id
+
+    def get_expired(self):
+        """Return a list of ids of sessions which should be removed.
+
+        These are those which have expired, and any least recently
+        used in excess of config.Server.max_sessions.
+
+        """
+        self._lock.acquire()
+        try:
+            expired = self._evicted
+            self._evicted = []
+            t0 = time.time()
+            while self._expiry_heap and self._expiry_heap[0][0] < t0:
+                session_id = self._pop_oldest()
+                if session_id is not None:
+                    expired.append(session_id)
+            return expired
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        """Write any buffered changes."""
+        pass
+
+
+class CookieStore(MemoryStore):
+
+    """Sessions held in signed cookies.
+
+    The cookie holds the session_id, user_id and expire time, plus an
+    HMAC of them all. The sessions are also held in memory, but only
+    as a cache of the cookies seen; the cookie is always definitive.
+
+    """
+    def __init__(self):
+        MemoryStore.__init__(self)
+        self.secret = config.Server.session_secret
+        if not self.secret:
+            logger.warn("No session_secret, so sessions will not survive "
+                        "a restart or be shared between processes")
+            self.secret = os.urandom(32)
+
+    def _sign(self, text):
+        return hmac.new(self.secret, text, sha).hexdigest()
+
+    def _equal(self, a, b):
+        """Compare strings in a time independent of where they differ."""
+        if len(a) != len(b):
+            return False
+        difference = 0
+        for x, y in zip(a, b):
+            difference |= ord(x) ^ ord(y)
+        return difference == 0
+
+    def load(self, cookie):
+        try:
+            text, signature = cookie.rsplit(":", 1)
+            session_id, user_id, expire_time = text.split(":")
+            expire_time = float(expire_time)
+            user_id = user_id and int(user_id) or None
+        except ValueError:
+            return None
+        if not self._equal(signature, self._sign(text)):
+            logger.warn("Session cookie with invalid signature")
+            return None
+        if expire_time < time.time():
+            return None
+        self._lock.acquire()
+        try:
+            self._refresh(session_id, user_id)
+        finally:
+            self._lock.release()
+        return session_id
+
+    def get_cookie(self, session_id):
+        expire_time, user_id = self._sessions.get(session_id,
+                                                  (_get_expire_time(), None))
+        if user_id is None:
+            user_id = ""
+        text = "%s:%s:%d" % (session_id, user_id, expire_time)
+        return "%s:%s" % (text, self._sign(text))
+
+
+class DatabaseStore(object):
+
+    """Sessions held in the sessions table of the database.
+
+    Every request reads its session (and user) from the table, so a
+    session may be used by any midged process sharing the database.
+    The user read is remembered for the rest of the request, and each
+    refresh of a session's expiry is only remembered until flush()
+    writes them all in one go.
+
+    As with MemoryStore, creating a session beyond
+    config.Server.max_sessions evicts those least recently used (as
+    of their last flush()), which the next get_expired() returns.
+
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self._refreshed = {}
+        self._user_ids = {}
+        self._evicted = []
+        self._lock = threading.Lock()
+
+    def _remember_user_id(self, session_id, user_id):
+        self._lock.acquire()
+        try:
+            self._user_ids[session_id] = user_id
+        finally:
+            self._lock.release()
+
+    def load(self, cookie):
+        cursor = self.connection.cursor()
+        try:
+            connection.execute_prepared(cursor, """
+                SELECT user_id FROM sessions
+                WHERE session_id=$1 AND expires>$2
+                """, (cookie, time.ctime()))
+            ans = cursor.fetchone()
+        finally:
+            cursor.close()
+        if ans is None:
+            return None
+        self._lock.acquire()
+        try:
+            self._refreshed[cookie] = _get_expire_time()
+            self._user_ids[cookie] = ans[0]
+        finally:
+            self._lock.release()
+        return cookie
+
+    def create(self):
+        session_id = _generate_session_id()
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("""
+                INSERT INTO sessions (session_id, expires)
+                VALUES (%s, %s);
+                DELETE FROM sessions WHERE session_id IN
+                    (SELECT session_id FROM sessions
+                     ORDER BY expires DESC OFFSET %s)
+                RETURNING session_id;
+                """, (session_id, time.ctime(_get_expire_time()),
+                      config.Server.max_sessions))
+            evicted = [evicted_id for (evicted_id,) in cursor.fetchall()]
+            self.connection.commit()
+        finally:
+            cursor.close()
+        if evicted:
+            logger.info("Too many sessions, so evicting: %s" %
+                        ", ".join(evicted))
+            self._lock.acquire()
+            try:
+                self._evicted.extend(evicted)
+            finally:
+                self._lock.release()
+        return session_id
+
+    def remove(self, session_id):
+        self._lock.acquire()
+        try:
+            self._refreshed.pop(session_id, None)
+            self._user_ids.pop(session_id, None)
+        finally:
+            self._lock.release()
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("""
+                DELETE FROM sessions WHERE session_id=%s;
+                """, (session_id,))
+            self.connection.commit()
+        finally:
+            cursor.close()
+
+    def get_user_id(self, session_id):
+        """Return the user of the session, as read by its last load()."""
+        try:
+            return self._user_ids[session_id]
+        except KeyError:
+            pass
+        cursor = self.connection.cursor()
+        try:
+            connection.execute_prepared(cursor, """
+                SELECT user_id FROM sessions WHERE session_id=$1
+                """, (session_id,))
+            ans = cursor.fetchone()
+        finally:
+            cursor.close()
+        if ans is None:
+            return None
+        self._remember_user_id(session_id, ans[0])
+        return ans[0]
+
+    def set_user_id(self, session_id, user_id):
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("""
+                INSERT INTO sessions (session_id, user_id, expires)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (session_id)
+                DO UPDATE SET user_id=EXCLUDED.user_id;
+                """, (session_id, user_id, time.ctime(_get_expire_time())))
+            self.connection.commit()
+        finally:
+            cursor.close()
+        self._remember_user_id(session_id, user_id)
+
+    def get_cookie(self, session_id):
+        return session_id
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            refreshed = self._refreshed
+            self._refreshed = {}
+            # Forget the users of sessions no longer in use, which will
+            # be read afresh by the next load() of any which are.
+            self._user_ids = {}
+        finally:
+            self._lock.release()
+        if not refreshed:
+            return
+        cursor = self.connection.cursor()
+        try:
+            cursor.executemany("""
+                UPDATE sessions SET expires=%s WHERE session_id=%s;
+                """, [(time.ctime(expire_time), session_id)
+                      for session_id, expire_time in refreshed.iteritems()])
+            self.connection.commit()
+        finally:
+            cursor.close()
+
+    def get_expired(self):
+        self._lock.acquire()
+        try:
+            expired = self._evicted
+            self._evicted = []
+        finally:
+            self._lock.release()
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("""
+                SELECT session_id FROM sessions WHERE expires<%s
+                UNION
+                (SELECT session_id FROM sessions
+                 ORDER BY expires DESC OFFSET %s);
+                """, (time.ctime(), config.Server.max_sessions))
+            expired.extend([session_id
+                            for (session_id,) in cursor.fetchall()])
+        finally:
+            cursor.close()
+        return expired
+
+
+def make_store(connection):
+    """Return the store of sessions chosen by config.Server.session_store."""
+    kind = config.Server.session_store
+    if kind == "memory":
+        return MemoryStore()
+    elif kind == "cookie":
+        return CookieStore()
+    elif kind == "database":
+        return DatabaseStore(connection)
+    else:
+        raise ValueError, "Unknown session_store: %s" % kind
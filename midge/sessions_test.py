@@ -0,0 +1,163 @@
+# $Id$
+# (C) Timothy Corbett-Clark, 2004
+
+import time
+import unittest
+
+import midge.config as config
+import midge.connection as connection
+import midge.sessions as sessions
+
+
+class MemoryStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        config.read()
+        self.store = sessions.MemoryStore()
+
+    def test_create(self):
+        """Check new sessions are valid and have no user"""
+        session_id = self.store.create()
+        self.assertEqual(self.store.load(session_id), session_id)
+        self.assertEqual(self.store.get_user_id(session_id), None)
+        self.assertEqual(self.store.load("no-such-session"), None)
+
+    def test_user(self):
+        """Check the user of a session is remembered until removed"""
+        session_id = self.store.create()
+        self.store.set_user_id(session_id, 42)
+        self.assertEqual(self.store.get_user_id(session_id), 42)
+        self.store.remove(session_id)
+        self.assertEqual(self.store.load(session_id), None)
+
+    def test_expired(self):
+        """Check expired sessions are found and no longer valid"""
+        timeout = config.Server.session_timeout
+        config.Server.session_timeout = -1
+        try:
+            session_id = self.store.create()
+        finally:
+            config.Server.session_timeout = timeout
+        self.assertEqual(self.store.load(session_id), None)
+        self.assertEqual(self.store.get_expired(), [session_id])
+        self.assertEqual(self.store.get_expired(), [])
+
+    def test_eviction(self):
+        """Check the least recently used sessions are evicted"""
+        max_sessions = config.Server.max_sessions
+        config.Server.max_sessions = 2
+        try:
+            first = self.store.create()
+            second = self.store.create()
+            time.sleep(0.01)
+            self.store.load(first)
+            third = self.store.create()
+        finally:
+            config.Server.max_sessions = max_sessions
+        self.assertEqual(self.store.load(second), None)
+        self.assertEqual(self.store.load(first), first)
+        self.assertEqual(self.store.load(third), third)
+        self.assertEqual(self.store.get_expired(), [second])
+        self.assertEqual(self.store.get_expired(), [])
+
+
+class CookieStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        config.read()
+        self.store = sessions.CookieStore()
+
+    def test_cookie(self):
+        """Check a session is recovered from its cookie alone"""
+        session_id = self.store.create()
+        self.store.set_user_id(session_id, 42)
+        cookie = self.store.get_cookie(session_id)
+        other_store = sessions.CookieStore()
+        other_store.secret = self.store.secret
+        self.assertEqual(other_store.load(cookie), session_id)
+        self.assertEqual(other_store.get_user_id(session_id), 42)
+
+    def test_forged_cookie(self):
+        """Check cookies with a bad signature are rejected"""
+        session_id = self.store.create()
+        cookie = self.store.get_cookie(session_id)
+        text, signature = cookie.rsplit(":", 1)
+        session_id, user_id, expire_time = text.split(":")
+        forged = "%s:1:%s:%s" % (session_id, expire_time, signature)
+        self.assertEqual(self.store.load(forged), None)
+        self.assertEqual(self.store.load("garbage"), None)
+
+
+class DatabaseStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        config.read()
+        self.connection = connection.TestConnection()
+        self.store = sessions.DatabaseStore(self.connection)
+
+    def tearDown(self):
+        self.connection.close()
+
+    def _add_user(self, username):
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            INSERT INTO users (username, password, name, email)
+            VALUES (%s, 'password', 'name', 'email') RETURNING user_id;
+            """, (username,))
+        user_id = cursor.fetchone()[0]
+        self.connection.commit()
+        cursor.close()
+        return user_id
+
+    def _set_user_id_in_table(self, session_id, user_id):
+        cursor = self.connection.cursor()
+        cursor.execute("UPDATE sessions SET user_id=%s WHERE session_id=%s",
+                       (user_id, session_id))
+        self.connection.commit()
+        cursor.close()
+
+    def test_user(self):
+        """Check the user of a session is remembered until removed"""
+        user_id = self._add_user("username")
+        session_id = self.store.create()
+        self.assertEqual(self.store.load(session_id), session_id)
+        self.assertEqual(self.store.get_user_id(session_id), None)
+        self.store.set_user_id(session_id, user_id)
+        self.assertEqual(self.store.get_user_id(session_id), user_id)
+        self.store.remove(session_id)
+        self.assertEqual(self.store.load(session_id), None)
+        self.assertEqual(self.store.get_user_id(session_id), None)
+
+    def test_user_read_by_load(self):
+        """Check the user is read once per load of the session"""
+        first = self._add_user("first")
+        second = self._add_user("second")
+        session_id = self.store.create()
+        self.store.set_user_id(session_id, first)
+        self.store.load(session_id)
+        self._set_user_id_in_table(session_id, second)
+        self.assertEqual(self.store.get_user_id(session_id), first)
+        self.store.load(session_id)
+        self.assertEqual(self.store.get_user_id(session_id), second)
+
+    def test_eviction(self):
+        """Check the least recently used sessions are evicted"""
+        first = self.store.create()
+        second = self.store.create()
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            UPDATE sessions SET expires = expires - interval '1 minute'
+            WHERE session_id=%s;
+            """, (second,))
+        self.connection.commit()
+        cursor.close()
+        max_sessions = config.Server.max_sessions
+        config.Server.max_sessions = 2
+        try:
+            third = self.store.create()
+            self.assertEqual(self.store.get_expired(), [second])
+        finally:
+            config.Server.max_sessions = max_sessions
+        self.assertEqual(self.store.load(second), None)
+        self.assertEqual(self.store.load(first), first)
+        self.assertEqual(self.store.load(third), third)
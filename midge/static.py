@@ -0,0 +1,86 @@
+# $Id$
+# (C) Timothy Corbett-Clark, 2004
+
+"""Static files (style sheets and images), preloaded into memory.
+
+Every file in the presentation directory is read once, by load(), and
+thereafter served from memory, along with a gzip compressed copy if
+that is any smaller. Each is identified by the md5 digest
+of its contents, used both as its ETag and to version its URLs: a
+URL which includes the current version of a file may be cached by
+browsers indefinitely, as a changed file gets a different URL.
+
+"""
+
+import email.Utils
+import md5
+import mimetypes
+import os
+
+import midge.lib as lib
+import midge.logger as logger
+
+
+class Asset(object):
+
+    """A single static file."""
+
+    def __init__(self, name, data, mtime):
+        self.name = name
+        self.data = data
+        self.mime_type = mimetypes.guess_type(name)[0] or \
+                         "application/octet-stream"
+        digest = md5.new(data).hexdigest()
+        self.etag = '"%s"' % digest
+        self.version = digest[:12]
+        self.last_modified = email.Utils.formatdate(mtime, usegmt=True)
+        self.gzip_data = lib.gzip_compress(data, 9)
+        self.gzip_etag = '"%s-gzip"' % digest
+        if len(self.gzip_data) >= len(data):
+            self.gzip_data = None
+
+    def matches(self, if_none_match, if_modified_since):
+        """Return whether a client's copy (per its headers) is current."""
+        if if_none_match is not None:
+            etags = [etag.strip() for etag in if_none_match.split(",")]
+            return self.etag in etags or self.gzip_etag in etags or \
+                   "*" in etags
+        return if_modified_since == self.last_modified
+
+
+_assets = {}
+
+
+def load(directory):
+    """Read every file in the directory, replacing any loaded before."""
+    global _assets
+    assets = {}
+    for name in os.listdir(directory):
+        filename = os.path.join(directory, name)
+        if os.path.isfile(filename):
+            f = file(filename, "rb")
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            assets[name] = Asset(name, data, os.path.getmtime(filename))
+            logger.info("Loaded static file %s" % name)
+    _assets = assets
+
+
+def get(name):
+    """Return the Asset of the given name, or None if there is none."""
+    return _assets.get(name, None)
+
+
+def versioned_url(url, name):
+    """Return the url with the current version of the named file added.
+
+    The version makes the url unique to the file's current contents,
+    so that the response may be cached for ever.
+
+    """
+    asset = get(name)
+    if asset is None:
+        return url
+    return lib.join_url(url, {"v": asset.version})
@@ -0,0 +1,57 @@
+# $Id$
+# (C) Timothy Corbett-Clark, 2004
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import midge.static as static
+
+
+class StaticTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        f = file(os.path.join(self.directory, "style.css"), "w")
+        f.write("body { color: black }")
+        f.close()
+        static.load(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get(self):
+        """Check static files are loaded"""
+        asset = static.get("style.css")
+        self.assertEqual(asset.data, "body { color: black }")
+        self.assertEqual(asset.mime_type, "text/css")
+        self.assertEqual(static.get("missing.css"), None)
+
+    def test_compressed(self):
+        """Check static files are compressed only where worthwhile"""
+        self.assertEqual(static.get("style.css").gzip_data, None)
+        f = file(os.path.join(self.directory, "big.css"), "w")
+        f.write("body { color: black }\n" * 100)
+        f.close()
+        static.load(self.directory)
+        asset = static.get("big.css")
+        self.assert_(len(asset.gzip_data) < len(asset.data))
+        self.assert_(asset.matches(asset.gzip_etag, None))
+
+    def test_matches(self):
+        """Check conditional requests match the current version only"""
+        asset = static.get("style.css")
+        self.assert_(asset.matches(asset.etag, None))
+        self.assert_(asset.matches('"old", %s' % asset.etag, None))
+        self.assert_(asset.matches(None, asset.last_modified))
+        self.failIf(asset.matches('"old"', asset.last_modified))
+        self.failIf(asset.matches(None, None))
+
+    def test_versioned_url(self):
+        """Check urls of static files include their version"""
+        asset = static.get("style.css")
+        self.assertEqual(static.versioned_url("/style.css", "style.css"),
+                         "/style.css?v=%s" % asset.version)
+        self.assertEqual(static.versioned_url("/images?name=x.gif", "x.gif"),
+                         "/images?name=x.gif")
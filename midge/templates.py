@@ -4,12 +4,139 @@
 """Functions for generating html."""
 
 import re
+import sre_parse
 
 import midge.config as config
 import midge.lib as lib
+import midge.static as static
 
 
-def format_comment(text):
+# The newline and leading spaces of each line of a comment, replaced in
+# a single scan.
+_comment_line_start = re.compile(r"\n *")
+
+
+def _break_line(match):
+    return "\n<br/>\n" + "&nbsp;" * (len(match.group()) - 1)
+
+
+# The most groups the regex engine allows in one regex.
+_MAX_GROUPS = 99
+
+# Backreferences (\1, (?P=name)) and conditionals ((?(1)...)) in a
+# pattern, which would refer to the wrong groups once combined. Some
+# octal escapes also match, which only costs speed.
+_group_reference = re.compile(r"\\\d|\(\?P=|\(\?\(")
+
+
+def _can_combine(pattern):
+    """Return whether the pattern can be an alternative of a larger regex.
+
+    It must not refer to its own groups by number, nor name any (which
+    may clash with those of another pattern), nor set any flags (as
+    inline flags apply to the whole regex).
+
+    """
+    return (not pattern.flags and not pattern.groupindex
+            and _group_reference.search(pattern.pattern) is None)
+
+
+class _CommentMapper(object):
+
+    """The comment mappings of midge.conf, combined into a single regex.
+
+    Each mapping's pattern is an alternative of the combined regex,
+    followed by an empty group of its own. That group is the last to
+    close, so its number identifies the mapping which matched. (Being
+    at the end, it leaves each alternative starting as its pattern
+    does, which the regex engine uses to skip those which cannot match
+    quickly.) Each substitute is parsed once, into literals and the
+    numbers of the groups to fill in, renumbered to those of the
+    combined regex.
+
+    Where several mappings match at the same place, the first (in
+    alphabetical order) is used. Unlike applying each mapping in turn,
+    the text substituted by one mapping is never mapped by another.
+
+    The patterns which cannot be combined (see _can_combine), or which
+    would take the combined regex past the engine's limit on groups,
+    are instead applied afterwards, each in turn.
+
+    """
+    def __init__(self, mappings, generation):
+        self.generation = generation
+        self._dispatch = {}
+        self._separate = []
+        alternatives = []
+        n_groups = 0
+        for name, pattern, substitute in mappings:
+            if (not _can_combine(pattern)
+                or n_groups + pattern.groups + 1 > _MAX_GROUPS):
+                self._separate.append((pattern, substitute))
+                continue
+            alternatives.append("(?:%s)()" % pattern.pattern)
+            groups, literals = sre_parse.parse_template(substitute, pattern)
+            self._dispatch[n_groups + pattern.groups + 1] = (
+                [(index, group + n_groups) for index, group in groups],
+                literals)
+            n_groups += pattern.groups + 1
+        if alternatives:
+            self._regex = re.compile("|".join(alternatives))
+        else:
+            self._regex = None
+
+    def _substitute(self, match):
+        groups, literals = self._dispatch[match.lastindex]
+        literals = list(literals)
+        for index, group in groups:
+            literals[index] = match.group(group) or ""
+        return "".join(literals)
+
+    def map(self, text):
+        if self._regex is not None:
+            text = self._regex.sub(self._substitute, text)
+        for pattern, substitute in self._separate:
+            text = pattern.sub(substitute, text)
+        return text
+
+
+_comment_mapper = None
+
+
+def _get_comment_mapper():
+    """Return the mapper of the comment mappings most recently read."""
+    global _comment_mapper
+    generation = config.CommentMappings.generation
+    mapper = _comment_mapper
+    if mapper is None or mapper.generation != generation:
+        mapper = _CommentMapper(config.CommentMappings.mappings, generation)
+        _comment_mapper = mapper
+    return mapper
+
+
+# The version of the html rendered by format_comment. Increment it
+# whenever that html changes (other than by the comment mappings), so
+# that the html kept for each comment is rendered afresh.
+COMMENT_FORMAT_VERSION = 1
+
+
+def get_comment_digest():
+    """Return the digest identifying the html of format_comment.
+
+    This covers both the comment mappings and COMMENT_FORMAT_VERSION,
+    and is kept with the html of each comment.
+
+    """
+    return "%d:%s" % (COMMENT_FORMAT_VERSION, config.CommentMappings.digest)
+
+
+# The comments already formatted, by the generation of the comment
+# mappings and the text, bounded by the number of characters of both
+# the text and the result.
+_formatted_comments = lib.LRUCache(4 * 1024 * 1024)
+
+
+def format_comment(text, remember=True):
     """Return text suitable for displaying as comment.
 
     This means:
@@ -21,25 +148,27 @@ def format_comment(text):
 
     Also replace text to provide hyperlinks, as per midge.conf.
 
-    """
-    text = text.lstrip("\n")
-    text = text.rstrip()
-    text = lib.html_entity_escape(text)
-    rows = []
-    for row in text.split("\n"):
-        n_leading_spaces = 0
-        for c in row:
-            if c == " ":
-                n_leading_spaces += 1
-            else:
-                break
-        rows.append(row.replace(" ", "&nbsp;", n_leading_spaces))
-    text = "\n<br/>\n".join(rows)
-
-    for name, pattern, substitute in config.CommentMappings.mappings:
-        text = re.sub(pattern, substitute, text)
+    Unless remember is false, the result is remembered, so a comment
+    already formatted (with the current comment mappings) is not
+    formatted again.
 
-    return text
+    """
+    key = (config.CommentMappings.generation, text)
+    formatted = None
+    if remember:
+        formatted = _formatted_comments.get(key)
+    if formatted is None:
+        # Start with a newline, so that the leading spaces of the first
+        # line are replaced like those of the others.
+        formatted = _comment_line_start.sub(
+            _break_line,
+            "\n" + lib.html_entity_escape(text.lstrip("\n").rstrip()))
+        formatted = formatted[len("\n<br/>\n"):]
+        formatted = _get_comment_mapper().map(formatted)
+        if remember:
+            _formatted_comments.set(key, formatted,
+                                    len(text) + len(formatted))
+    return formatted
 
 
 def get_version():
@@ -53,16 +182,19 @@ def get_version():
         return "&lt;unknown&gt;"
 
 
-def header(wfile, title=None):
-    if title:
-        title = "%s - Midge (%s)" % (title, config.Project.name)
-    else:
-        title = "Midge (%s)" % config.Project.name
-    wfile.write('''
+# The header, pre-rendered either side of its title, by project name and
+# style sheet (whose url changes with its contents).
+_headers = {}
+
+
+def _get_header(project, css):
+    header = _headers.get((project, css), None)
+    if header is None:
+        html = '''
 <html>
  <head>
   <title>%(title)s</title>
-  <link rel="stylesheet" type="text/css" href="default.css"/>
+  <link rel="stylesheet" type="text/css" href="%(css_url)s"/>
   <script>
   <!--
   function set_focus() {
@@ -103,7 +235,24 @@ def header(wfile, title=None):
    </table>
   </form>
   <div id="body">
-''' % {"title": title, "project":config.Project.name})
+''' % {
+            "title": "\0",
+            "project": project,
+            "css_url": lib.html_entity_escape(
+                static.versioned_url("/default.css", "default.css"))}
+        header = tuple(html.split("\0"))
+        _headers[(project, css)] = header
+    return header
+
+
+def header(wfile, title=None):
+    if title:
+        title = "%s - Midge (%s)" % (title, config.Project.name)
+    else:
+        title = "Midge (%s)" % config.Project.name
+    before_title, after_title = _get_header(config.Project.name,
+                                            static.get("default.css"))
+    wfile.write(before_title + title + after_title)
 
 def vspace(wfile):
     wfile.write("<br/>")
@@ -131,8 +280,8 @@ def possible_actions(wfile, *possible_actions):
         wfile.write('<li><a href="%s">%s</a></li>' % (href, label))
     wfile.write('</ul>')
 
-def footer(wfile):
-    wfile.write('''
+
+_footer = '''
   </div>
   <p></p>
   <table id="footer">
@@ -148,7 +297,11 @@ def footer(wfile):
    </tr>
   </table>
  </body>
-</html>''' % {"version": get_version()})
+</html>''' % {"version": get_version()}
+
+
+def footer(wfile):
+    wfile.write(_footer)
 
 
 def login_form(wfile, path, usernames):
@@ -374,6 +527,11 @@ class StatusHints(object):
 
 def show_comments(wfile, bug):
     for comment in bug.comments:
+        # The html is rendered when the comment is added, so need only
+        # be formatted here if rendered by different comment mappings.
+        text = comment.html
+        if text is None:
+            text = format_comment(comment.text)
         wfile.write('''
   <table class="comments-heading"">
    <tr>
@@ -390,7 +548,7 @@ def show_comments(wfile, bug):
          "username": comment.username,
          "date":lib.pretty_format_date(comment.date),
          "time":lib.format_time(comment.date),
-         "text":format_comment(comment.text)})
+         "text": text})
 
 
 def bug_status_summary(wfile, bug):
@@ -698,8 +856,11 @@ def _sortable_table_headings(wfile, path, titles,
         if variable == sorted_by:
             direction = {"ascending": "up",
                          "descending": "down"}[ordered]
+            image_url = lib.html_entity_escape(static.versioned_url(
+                "/images?name=%s.gif" % direction, "%s.gif" % direction))
             wfile.write('''
-      <img src="/images?name=%(direction)s.gif" alt="%(direction)s"/>''' % {"direction": direction})
+      <img src="%(url)s" alt="%(direction)s"/>''' % {"direction": direction,
+                                                     "url": image_url})
         wfile.write('''
      </th>''')
     wfile.write('''                
@@ -717,29 +878,70 @@ def _table_headings(wfile, titles, variables):
     wfile.write('''                
     </tr>''')
 
-def _table_rows(wfile, rows):
-    styles = ("odd-row", "even-row")
-    row_index = 0
-    for row in rows:
-        row_index += 1
-        wfile.write('''
-    <tr class="row">''')
-        for variable, value in row.get():
+# The compiled templates of rows, by their columns (see _table_rows).
+_row_templates = {}
+
+# The number of rows rendered before each write, so that streamed rows
+# still reach the browser as they are rendered.
+_rows_per_write = 20
+
+
+def _compile_row_template(variables):
+    """Return the templates of a row of the given columns.
+
+    These are the format strings of odd and even rows (as indexed by
+    row_index % 2 in _table_rows), and the index in the row's values
+    of each value formatted into them.
+
+    """
+    templates = []
+    for style in ("odd-row", "even-row"):
+        cells = ["""
+    <tr class="row">"""]
+        for variable in variables:
             if variable == "bug_id":
-                value = '<a href="/view?bug_id=%(bug_id)s">%(bug_id)s</a>' % \
-                        {"bug_id": value}
+                value = '<a href="/view?bug_id=%s">%s</a>'
+            else:
+                value = "%s"
             if variable == "title":
-                style = styles[row_index % 2] + "-last"
+                cell_style = style + "-last"
             else:
-                style = styles[row_index % 2] + "-not-last"
-            wfile.write('''
-     <td class="%(style)s">
-      %(value)s
+                cell_style = style + "-not-last"
+            cells.append("""
+     <td class="%s">
+      %s
      </td>
-  ''' % {"style": style,
-         "value": value})
-        wfile.write('''
-    </tr>''') 
+  """ % (cell_style, value))
+        cells.append("""
+    </tr>""")
+        templates.append("".join(cells))
+    indices = []
+    for index, variable in enumerate(variables):
+        indices.append(index)
+        if variable == "bug_id":
+            indices.append(index)
+    return tuple(templates), indices
+
+
+def _table_rows(wfile, rows, variables):
+    """Write the rows, each rendered by a template of its columns."""
+    variables = tuple(variables)
+    row_template = _row_templates.get(variables, None)
+    if row_template is None:
+        row_template = _compile_row_template(variables)
+        _row_templates[variables] = row_template
+    templates, indices = row_template
+    pieces = []
+    row_index = 0
+    for row in rows:
+        row_index += 1
+        values = row.get_values()
+        pieces.append(templates[row_index % 2] %
+                      tuple([values[i] for i in indices]))
+        if len(pieces) == _rows_per_write:
+            wfile.write("".join(pieces))
+            pieces = []
+    wfile.write("".join(pieces))
 
 
 def table_of_progress(wfile, progress):
@@ -753,7 +955,24 @@ def table_of_progress(wfile, progress):
     wfile.write('''
     </thead>
     <tbody>''')
-    _table_rows(wfile, progress.rows)
+    _table_rows(wfile, progress.rows, progress.variables)
+    wfile.write('''
+    </tbody>
+   </table>''')
+
+
+def table_of_jobs(wfile, jobs):
+    assert len(jobs.rows) > 0
+    wfile.write('''
+   <table class="list-of-bugs">
+    <thead>''')
+    _table_headings(wfile,
+                    jobs.titles,
+                    jobs.variables)
+    wfile.write('''
+    </thead>
+    <tbody>''')
+    _table_rows(wfile, jobs.rows, jobs.variables)
     wfile.write('''
     </tbody>
    </table>''')
@@ -772,14 +991,15 @@ def table_of_changes(wfile, path, recent_changes):
     wfile.write('''
     </thead>
     <tbody>''')
-    _table_rows(wfile, recent_changes.rows)
+    _table_rows(wfile, recent_changes.rows, recent_changes.variables)
     wfile.write('''
     </tbody>
    </table>''')
 
 
 def table_of_bugs(wfile, path, search):
-    assert len(search.rows) > 0
+    assert search.total > 0
+    _page_links(wfile, path, search)
     wfile.write('''
    <table class="list-of-bugs">
     <thead>''')
@@ -791,10 +1011,46 @@ def table_of_bugs(wfile, path, search):
     wfile.write('''
     </thead>
     <tbody>''')
-    _table_rows(wfile, search.rows)
+    _table_rows(wfile, search.rows, search.variables)
     wfile.write('''
     </tbody>
    </table>''')
+    _page_links(wfile, path, search)
+
+
+def _page_links(wfile, path, search):
+    """Write links to the neighbouring pages of a paginated search."""
+    if not search.page_size or search.n_pages == 1:
+        return
+
+    def link(page, text):
+        url = lib.html_entity_escape(
+            lib.join_url(path, {"sort_by": search.sort_by,
+                                "order": search.order,
+                                "page": str(page)}))
+        return '<a href="%s">%s</a>' % (url, text)
+
+    links = []
+    if search.page > 1:
+        links.append(link(search.page - 1, "Previous"))
+    shown = [page for page in range(1, search.n_pages + 1)
+             if page in (1, search.n_pages) or abs(page - search.page) <= 4]
+    previous = 0
+    for page in shown:
+        if page != previous + 1:
+            links.append("...")
+        if page == search.page:
+            links.append("<b>%d</b>" % page)
+        else:
+            links.append(link(page, page))
+        previous = page
+    if search.page < search.n_pages:
+        links.append(link(search.page + 1, "Next"))
+    links.append(link("all", "Show all"))
+    wfile.write('''
+   <p class="page-links">
+    Page %d of %d: %s
+   </p>''' % (search.page, search.n_pages, " ".join(links)))
 
 
 def search_form(wfile, path, values,
@@ -806,16 +1062,28 @@ def search_form(wfile, path, values,
    <tr>
     <td class="form-tab">Text</td>
    </tr> 
+   <tr class="form">
+    <td class="form-row-heading">Words</td>
+    <td>
+     <input name="text" value="%(text)s" type="text"/>
+    </td>
+   </tr>
    <tr class="form">
     <td class="form-row-heading">Title</td>
+    <td></td>
     <td>
+     <small>&nbsp;(regex</small>
      <input name="title" value="%(title)s" type="text"/>
+     <small>)</small>
     </td>
    </tr>
    <tr class="form">
     <td class="form-row-heading">Comments</td>
+    <td></td>
     <td>
+     <small>&nbsp;(regex</small>
      <input name="comments" value="%(comments)s" type="text"/>
+     <small>)</small>
     </td>
    </tr>
 
@@ -829,6 +1097,9 @@ def search_form(wfile, path, values,
     <td class="form-row-heading">Status</td>
     <td>
      <select name="status" size="1">''' % {"path": path,
+                                           "text": lib.html_entity_escape(
+                                               values.get("text", "")
+                                               ).replace('"', "&quot;"),
                                            "title": values.get("title", ""),
                                            "comments": values.get("comments", "")})
     for status in statuses:
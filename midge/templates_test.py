@@ -5,9 +5,11 @@
 
 import cStringIO
 import mx.DateTime
+import re
 import unittest
 import xml.sax
 
+import midge.config as config
 import midge.templates as templates
 
 
@@ -62,6 +64,66 @@ class TemplatesTests(unittest.TestCase):
         self.assertEqual("&nbsp;foobar", templates.format_comment(" foobar"))
         self.assertEqual("&nbsp;&nbsp;foo", templates.format_comment("  foo"))
 
+    def test_format_comment_mappings(self):
+        """Check format comment applies the comment mappings"""
+        mappings = config.CommentMappings.mappings
+        config.CommentMappings.mappings = [
+            ("m1_url", re.compile(r"http://(\S*)"),
+             r'<a href="http://\1">\1</a>'),
+            ("m2_bug", re.compile(r"(\s|^)[Bb]ug\s?#(\d+)"),
+             r'\1<a href="/view?bug_id=\2">Bug \2</a>'),
+            ("m3_bug", re.compile(r"bug"), "insect")]
+        config.CommentMappings.generation += 1
+        try:
+            self.assertEqual(
+                templates.format_comment("See bug #12 and\n http://x/bug"),
+                'See <a href="/view?bug_id=12">Bug 12</a> and\n<br/>\n'
+                '&nbsp;<a href="http://x/bug">x/bug</a>')
+            self.assertEqual(templates.format_comment("bug"), "insect")
+        finally:
+            config.CommentMappings.mappings = mappings
+            config.CommentMappings.generation += 1
+
+    def check_mappings(self, mappings, text, expected):
+        old_mappings = config.CommentMappings.mappings
+        config.CommentMappings.mappings = [
+            (name, re.compile(pattern), substitute)
+            for name, pattern, substitute in mappings]
+        config.CommentMappings.generation += 1
+        try:
+            self.assertEqual(templates.format_comment(text), expected)
+        finally:
+            config.CommentMappings.mappings = old_mappings
+            config.CommentMappings.generation += 1
+
+    def test_format_comment_backreferences(self):
+        """Check comment mappings may use backreferences"""
+        self.check_mappings(
+            [("m1_bug", r"(\d+)", r"#\1"),
+             ("m2_twice", r"(\w)\1", r"[\1]"),
+             ("m3_named", r"(?P<x>z)-(?P=x)", r"<\g<x>>")],
+            "aa 12 bb z-z", "[a] #12 [b] <z>")
+
+    def test_format_comment_same_group_names(self):
+        """Check comment mappings may use the same group names"""
+        self.check_mappings(
+            [("m1_bug", r"bug (?P<id>\d+)", r"B\g<id>"),
+             ("m2_task", r"task (?P<id>\d+)", r"T\g<id>")],
+            "bug 1 task 2", "B1 T2")
+
+    def test_format_comment_inline_flags(self):
+        """Check inline flags apply only to their own comment mapping"""
+        self.check_mappings(
+            [("m1_bug", r"(?i)bug", "insect"),
+             ("m2_task", r"task", "job")],
+            "BUG bug TASK task", "insect insect TASK job")
+
+    def test_format_comment_many_groups(self):
+        """Check comment mappings with more groups than a regex allows"""
+        self.check_mappings(
+            [("m%03d" % i, "(w)(%03d)" % i, r"\2") for i in range(60)],
+            "w001 w059", "001 059")
+
     def test_hrule(self):
         """Check hrule"""
         wfile = self.get_wfile()
@@ -151,6 +213,7 @@ class TemplatesTests(unittest.TestCase):
             username = "my username"
             date = mx.DateTime.now()
             text = "this is a comment"
+            html = None
 
         class MockBug:
             bug_id = 3
@@ -245,15 +308,51 @@ class TemplatesTests(unittest.TestCase):
             
             bug_id = "334"
             
-            def get(self):
-                return [("variable1", "value1"), ("variable2", "value2")]
+            def get_values(self):
+                return ["value1", "value2"]
 
         wfile = self.get_wfile()
         wfile.write("<test>\n")
-        templates._table_rows(wfile, [MockRow(), MockRow()])
+        templates._table_rows(wfile, [MockRow(), MockRow()],
+                              ["variable1", "variable2"])
         wfile.write("</test>")
         self.assert_(self.is_well_formed(wfile))
 
+    def test_table_rows_html(self):
+        """Check table rows render exactly as before being compiled"""
+        class MockRow:
+
+            def __init__(self, *values):
+                self.values = values
+
+            def get_values(self):
+                return list(self.values)
+
+        wfile = self.get_wfile()
+        templates._table_rows(wfile, [MockRow(7, "a title"), MockRow(8, "")],
+                              ("bug_id", "title"))
+        self.assertEqual(wfile.getvalue(), """
+    <tr class="row">
+     <td class="even-row-not-last">
+      <a href="/view?bug_id=7">7</a>
+     </td>
+  
+     <td class="even-row-last">
+      a title
+     </td>
+  
+    </tr>
+    <tr class="row">
+     <td class="odd-row-not-last">
+      <a href="/view?bug_id=8">8</a>
+     </td>
+  
+     <td class="odd-row-last">
+      
+     </td>
+  
+    </tr>""")
+
     def test_table_of_bugs(self):
         """Check table of bugs"""
         class MockRow:
@@ -298,8 +397,8 @@ class TemplatesTests(unittest.TestCase):
             sorted_by = "variable2"
             ordered = "descending"
             
-            def get(self):
-                return [("variable1", "value1"), ("variable2", "value2")]
+            def get_values(self):
+                return ["334", "username", "date", "description"]
             
         class MockRecentChanges:
 
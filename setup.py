@@ -17,10 +17,12 @@ distutils.core.setup(
                 ("/etc/init.d", ["etc/init.d/midge"]),
                 ("/usr/local/bin", ["bin/midged",
                                     "bin/midge-test",
+                                    "bin/midge-benchmark",
                                     "bin/midge-config",
                                     "bin/midge-export",
                                     "bin/midge-import"]),
-                ("/usr/local/sbin", ["bin/midge-admin"]),
+                ("/usr/local/sbin", ["bin/midge-admin",
+                                     "bin/midge-upgrade"]),
                 ("/usr/local/share/midge",
                  ["share/up.gif",
                   "share/down.gif",